@@ -0,0 +1,111 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Utilities to fine-tune the Nucleotide Transformer with LoRA or IA³ adapters.
+
+The adapters are enabled through the adapter fields of NucleotideTransformerConfig.
+Only the adapter parameters (and optionally the head) are trained, the pretrained
+parameters are kept frozen:
+
+    config = replace(config, adapter_type="lora", adapter_rank=8)
+    forward_fn = hk.transform(build_nucleotide_transformer_with_head_fn(...))
+    initial_params = forward_fn.init(random_key, tokens)
+    # pretrained weights override the random ones, adapters keep their init
+    params = hk.data_structures.merge(initial_params, pretrained_params)
+    trainable_params, frozen_params = partition_adapter_params(
+        params, trainable_modules=("head",)
+    )
+    optimizer_state = optimizer.init(trainable_params)
+
+    def loss_fn(trainable_params, frozen_params, ...):
+        params = hk.data_structures.merge(trainable_params, frozen_params)
+        ...
+
+    grads = jax.grad(loss_fn)(trainable_params, frozen_params, ...)
+"""
+
+import os
+from typing import Tuple
+
+import haiku as hk
+import jax
+import joblib
+
+from nucleotide_transformer.layers import ADAPTER_PARAMETERS_NAMES
+
+
+def partition_adapter_params(
+    params: hk.Params, trainable_modules: Tuple[str, ...] = ()
+) -> Tuple[hk.Params, hk.Params]:
+    """
+    Splits the parameters between the trainable adapter parameters and the frozen
+    pretrained ones.
+
+    Args:
+        params: Full model parameters.
+        trainable_modules: Modules to keep trainable on top of the adapters, for
+            instance the fine-tuning head. A module is trainable if its name contains
+            one of these strings.
+
+    Returns:
+        Trainable parameters (adapters and trainable modules).
+        Frozen parameters.
+    """
+    return hk.data_structures.partition(
+        lambda module_name, name, _: name in ADAPTER_PARAMETERS_NAMES
+        or any(module in module_name for module in trainable_modules),
+        params,
+    )
+
+
+def save_adapter_params(
+    params: hk.Params, filename: str, trainable_modules: Tuple[str, ...] = ()
+) -> None:
+    """
+    Saves the adapter parameters only, a few MBs instead of the full checkpoint.
+
+    Args:
+        params: Model parameters. Either the full parameters or the trainable ones,
+            the pretrained parameters are filtered out before saving.
+        filename: Path of the .joblib file to write.
+        trainable_modules: Modules saved on top of the adapters, for instance the
+            fine-tuning head.
+    """
+    adapter_params, _ = partition_adapter_params(
+        params, trainable_modules=trainable_modules
+    )
+    adapter_params = jax.device_get(adapter_params)
+
+    save_dir = os.path.dirname(filename)
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    with open(filename, "wb") as f:
+        joblib.dump(hk.data_structures.to_mutable_dict(adapter_params), f)
+
+
+def load_adapter_params(filename: str) -> hk.Params:
+    """
+    Loads adapter parameters saved with save_adapter_params. They can be merged with
+    the pretrained parameters with hk.data_structures.merge.
+
+    Args:
+        filename: Path of the .joblib file.
+
+    Returns:
+        Adapter parameters.
+    """
+    with open(filename, "rb") as f:
+        params = joblib.load(f)
+    return params
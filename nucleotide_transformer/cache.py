@@ -0,0 +1,277 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed cache of embeddings, with a memory tier and a disk tier."""
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from nucleotide_transformer.utils import write_atomically
+
+
+def compute_config_hash(config: Any) -> str:
+    """
+    Hashes a model config, so that embeddings computed with different
+    hyperparameters never share a cache entry.
+
+    Args:
+        config: Dataclass config, e.g. a NucleotideTransformerConfig.
+
+    Returns:
+        Hexadecimal hash of the config.
+    """
+    serialized = json.dumps(dataclasses.asdict(config), sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def compute_cache_key(
+    model_name: str,
+    config_hash: str,
+    layers: Tuple[int, ...],
+    pooling: str,
+    sequence: str,
+    compute_dtype: Any = np.float32,
+    param_dtype: Any = np.float32,
+    output_dtype: Any = np.float32,
+) -> str:
+    """
+    Computes the content address of the embedding of a sequence.
+
+    Args:
+        model_name: Name of the model.
+        config_hash: Hash of the model config, see compute_config_hash.
+        layers: Layers whose embeddings are computed.
+        pooling: Pooling of the embeddings.
+        sequence: Nucleotide sequence.
+        compute_dtype: Type of the activations of the model.
+        param_dtype: Type of the parameters of the model.
+        output_dtype: Type of the outputs of the model.
+
+    Returns:
+        Hexadecimal key.
+    """
+    sequence_hash = hashlib.sha256(sequence.encode()).hexdigest()
+    description = json.dumps(
+        [
+            model_name,
+            config_hash,
+            list(layers),
+            pooling,
+            np.dtype(compute_dtype).name,
+            np.dtype(param_dtype).name,
+            np.dtype(output_dtype).name,
+            sequence_hash,
+        ]
+    )
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier key-value store of embeddings. The memory tier is an LRU bounded in
+    bytes, the entries it evicts are spilled to a disk tier made of .npy files that
+    are memory-mapped when read. Entries read from disk are promoted back to memory.
+    The cache is thread-safe.
+    """
+
+    def __init__(self, max_memory_bytes: int = 2**30, disk_dir: Optional[str] = None):
+        """
+        Args:
+            max_memory_bytes: Maximum number of bytes held by the memory tier.
+            disk_dir: Directory of the disk tier. If None, evicted entries are
+                dropped.
+        """
+        self._max_memory_bytes = max_memory_bytes
+        self._disk_dir = disk_dir
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(self._stats)
+
+    def _disk_path(self, key: str) -> str:
+        assert self._disk_dir is not None
+        return os.path.join(self._disk_dir, key[:2], f"{key}.npy")
+
+    def _write_to_disk(self, key: str, value: np.ndarray) -> None:
+        filename = self._disk_path(key)
+        if os.path.exists(filename):
+            return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        write_atomically(filename, functools.partial(np.save, arr=value))
+
+    def _put_in_memory(self, key: str, value: np.ndarray) -> None:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = value
+        self._memory_bytes += value.nbytes
+        while self._memory_bytes > self._max_memory_bytes and self._memory:
+            evicted_key, evicted_value = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_value.nbytes
+            if self._disk_dir is not None:
+                self._write_to_disk(evicted_key, evicted_value)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Args:
+            key: Key of the entry.
+
+        Returns:
+            The cached embedding, or None if it is not in the cache.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return self._memory[key]
+
+            if self._disk_dir is not None and os.path.exists(self._disk_path(key)):
+                value = np.load(self._disk_path(key), mmap_mode="r")
+                self._stats["disk_hits"] += 1
+                self._put_in_memory(key, np.array(value))
+                return value
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        """
+        Args:
+            key: Key of the entry.
+            value: Embedding to cache.
+        """
+        with self._lock:
+            self._put_in_memory(key, np.asarray(value))
+
+    def flush(self) -> None:
+        """
+        Writes all the entries of the memory tier to the disk tier, e.g. before the
+        end of a job so that the next ones can reuse its embeddings.
+        """
+        if self._disk_dir is None:
+            return
+        with self._lock:
+            for key, value in self._memory.items():
+                self._write_to_disk(key, value)
+
+
+class CachedEmbedder:
+    """
+    Wraps a batch embedding function with an EmbeddingCache: only the sequences
+    missing from the cache are embedded, and the results are reassembled in the
+    order of the inputs.
+
+    Example:
+        cache = EmbeddingCache(max_memory_bytes=2**32, disk_dir="/data/nt_cache")
+        embedder = CachedEmbedder(
+            embed_fn=my_batch_embedding_fn,
+            cache=cache,
+            model_name="500M_multi_species_v2",
+            config=config,
+            layers=(24,),
+            pooling="mean",
+            compute_dtype=jnp.bfloat16,
+            param_dtype=jnp.bfloat16,
+        )
+        embeddings = embedder(sequences)
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], Sequence[np.ndarray]],
+        cache: EmbeddingCache,
+        model_name: str,
+        config: Any,
+        layers: Tuple[int, ...],
+        pooling: str,
+        compute_dtype: Any = np.float32,
+        param_dtype: Any = np.float32,
+        output_dtype: Any = np.float32,
+    ):
+        """
+        Args:
+            embed_fn: Function computing the embeddings of a list of sequences.
+            cache: Cache storing the embeddings.
+            model_name: Name of the model, part of the cache keys.
+            config: Model config, its hash is part of the cache keys.
+            layers: Layers computed by embed_fn, part of the cache keys.
+            pooling: Pooling applied by embed_fn, part of the cache keys.
+            compute_dtype: Type of the activations of the model, part of the cache
+                keys.
+            param_dtype: Type of the parameters of the model, part of the cache keys.
+            output_dtype: Type of the outputs of the model, part of the cache keys.
+        """
+        self._embed_fn = embed_fn
+        self._cache = cache
+        self._model_name = model_name
+        self._config_hash = compute_config_hash(config)
+        self._layers = tuple(layers)
+        self._pooling = pooling
+        self._dtypes = (compute_dtype, param_dtype, output_dtype)
+
+    def __call__(self, sequences: List[str]) -> List[np.ndarray]:
+        """
+        Args:
+            sequences: Nucleotide sequences.
+
+        Returns:
+            Embedding of each sequence.
+        """
+        keys = [
+            compute_cache_key(
+                self._model_name,
+                self._config_hash,
+                self._layers,
+                self._pooling,
+                sequence,
+                *self._dtypes,
+            )
+            for sequence in sequences
+        ]
+        results: List[Optional[np.ndarray]] = [self._cache.get(key) for key in keys]
+
+        # Sequences repeated within the batch are embedded once
+        missing: Dict[str, List[int]] = {}
+        for index, (key, result) in enumerate(zip(keys, results)):
+            if result is None:
+                missing.setdefault(key, []).append(index)
+
+        if missing:
+            missing_indices = [indices[0] for indices in missing.values()]
+            embeddings = self._embed_fn([sequences[i] for i in missing_indices])
+            for (key, indices), embedding in zip(missing.items(), embeddings):
+                embedding = np.asarray(embedding)
+                self._cache.put(key, embedding)
+                for index in indices:
+                    results[index] = embedding
+
+        return results  # type: ignore
@@ -0,0 +1,116 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Memory-mappable checkpoint format.
+
+The file starts with the length of a JSON header as a little-endian uint64, followed
+by the header and by the raw buffers of the parameters. The header maps each module
+and parameter name to the dtype, shape and offset of its buffer. Buffers are aligned
+on ALIGNMENT bytes, so that loading maps the file instead of reading it: processes
+loading the same checkpoint share a single page-cached copy of the weights.
+"""
+
+import json
+import os
+import struct
+from typing import IO, Any, Dict
+
+import haiku as hk
+import jax.numpy as jnp
+import numpy as np
+
+from nucleotide_transformer.utils import write_atomically
+
+ALIGNMENT = 64
+_HEADER_LENGTH_FORMAT = "<Q"
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_memmap_checkpoint(params: hk.Params, filename: str) -> None:
+    """
+    Saves parameters in the memory-mappable format. The file is written under a
+    temporary name and renamed once complete.
+
+    Args:
+        params: Parameters to save.
+        filename: Path of the checkpoint.
+    """
+    arrays: Dict[str, Dict[str, np.ndarray]] = {}
+    header: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    offset = 0
+    for module_name, module_params in params.items():
+        arrays[module_name] = {}
+        header[module_name] = {}
+        for name, param in module_params.items():
+            array = np.asarray(param, order="C")
+            offset = _align(offset)
+            arrays[module_name][name] = array
+            header[module_name][name] = {
+                "dtype": array.dtype.name,
+                "shape": list(array.shape),
+                "offset": offset,
+            }
+            offset += array.nbytes
+
+    header_bytes = json.dumps(header).encode()
+    header_size = struct.calcsize(_HEADER_LENGTH_FORMAT)
+    # Pads the header with spaces so that the first buffer is aligned
+    data_start = _align(header_size + len(header_bytes))
+    header_bytes = header_bytes.ljust(data_start - header_size, b" ")
+
+    def write(f: IO[bytes]) -> None:
+        f.write(struct.pack(_HEADER_LENGTH_FORMAT, len(header_bytes)))
+        f.write(header_bytes)
+        for module_name, module_header in header.items():
+            for name, description in module_header.items():
+                f.seek(data_start + description["offset"])
+                f.write(arrays[module_name][name].tobytes())
+
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    write_atomically(filename, write)
+
+
+def load_memmap_checkpoint(filename: str) -> hk.Params:
+    """
+    Loads parameters saved with save_memmap_checkpoint. The arrays are read-only
+    views on a memory map of the file, their pages are read from disk lazily.
+
+    Args:
+        filename: Path of the checkpoint.
+
+    Returns:
+        Parameters.
+    """
+    with open(filename, "rb") as f:
+        header_size = struct.calcsize(_HEADER_LENGTH_FORMAT)
+        (header_length,) = struct.unpack(_HEADER_LENGTH_FORMAT, f.read(header_size))
+        header = json.loads(f.read(header_length))
+    data_start = header_size + header_length
+
+    buffer = np.memmap(filename, dtype=np.uint8, mode="r")
+    params: Dict[str, Dict[str, np.ndarray]] = {}
+    for module_name, module_header in header.items():
+        params[module_name] = {}
+        for name, description in module_header.items():
+            # jnp.dtype resolves the names of the ml_dtypes types, e.g. bfloat16
+            dtype = jnp.dtype(description["dtype"])
+            shape = tuple(description["shape"])
+            start = data_start + description["offset"]
+            end = start + int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            params[module_name][name] = buffer[start:end].view(dtype).reshape(shape)
+    return params
@@ -0,0 +1,433 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Computes Nucleotide Transformer embeddings of the records of a FASTA file, or of
+the regions of a BED file, into an embedding store (see store.py).
+
+The store is written chunk by chunk: a job that crashed is resumed by running the
+same command again, and chunks are split across processes or nodes sharing the
+output directory with --shard-index and --num-shards. Embeddings can be stored in
+float16 or int8 with --codec, and projected on their first principal components
+with --pca-components: the projection is fit by shard 0 on --pca-num-regions
+regions spread over the inputs, and applied on device before the transfer. The
+other shards wait for it at most --projection-timeout seconds.
+
+Example:
+    nt-embed --fasta hg38.fa --bed peaks.bed --model-name 500M_multi_species_v2 \\
+        --layers 20 24 --pooling mean --output-dir /data/peaks_embeddings \\
+        --shard-index $SLURM_PROCID --num-shards $SLURM_NTASKS \\
+        --codec int8 --pca-components 256
+"""
+import argparse
+import gzip
+import logging
+import time
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from nucleotide_transformer.data import prefetch_in_background
+from nucleotide_transformer.inference import (
+    SUPPORTED_POOLINGS,
+    pool_embeddings,
+    run_scheduled,
+)
+from nucleotide_transformer.store import (
+    SUPPORTED_CODECS,
+    EmbeddingStoreWriter,
+    IncrementalPCA,
+    Projection,
+)
+from nucleotide_transformer.types import Tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Region(NamedTuple):
+    """Genomic interval, in 0-based half-open coordinates."""
+
+    name: str
+    chromosome: str
+    start: int
+    end: int
+
+
+def read_fasta(filename: str) -> Dict[str, str]:
+    """
+    Args:
+        filename: Path of a FASTA file, optionally gzipped.
+
+    Returns:
+        Upper-cased sequence of each record, by record name.
+    """
+    open_fn = gzip.open if filename.endswith(".gz") else open
+    records: Dict[str, List[str]] = {}
+    lines: Optional[List[str]] = None
+    with open_fn(filename, "rt") as f:  # type: ignore
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                lines = records.setdefault(line[1:].split()[0], [])
+            elif line:
+                if lines is None:
+                    raise ValueError(f"{filename} does not start with a FASTA header.")
+                lines.append(line.upper())
+    return {name: "".join(lines) for name, lines in records.items()}
+
+
+def read_bed(filename: str) -> List[Region]:
+    """
+    Args:
+        filename: Path of a BED file, optionally gzipped, e.g. a peak list. Only the
+            first four columns are read.
+
+    Returns:
+        Regions of the file. Regions without a name column are named
+        chromosome:start-end.
+    """
+    open_fn = gzip.open if filename.endswith(".gz") else open
+    regions = []
+    with open_fn(filename, "rt") as f:  # type: ignore
+        for line in f:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            chromosome, start, end = fields[0], int(fields[1]), int(fields[2])
+            name = fields[3] if len(fields) > 3 else f"{chromosome}:{start}-{end}"
+            regions.append(Region(name, chromosome, start, end))
+    return regions
+
+
+def tile_records(
+    genome: Dict[str, str], window_length: Optional[int] = None
+) -> List[Region]:
+    """
+    Args:
+        genome: Sequence of each record.
+        window_length: Length of the non-overlapping windows the records are cut
+            into, the last window of a record may be shorter. If None, each record
+            is a single region.
+
+    Returns:
+        Regions covering the records.
+    """
+    regions = []
+    for chromosome, sequence in genome.items():
+        step = window_length or len(sequence)
+        for start in range(0, len(sequence), step):
+            end = min(start + step, len(sequence))
+            regions.append(
+                Region(f"{chromosome}:{start}-{end}", chromosome, start, end)
+            )
+    return regions
+
+
+def build_layers_embedding_fn(
+    apply_fn: Callable,
+    layers: Tuple[int, ...],
+    pooling: str,
+    pad_token_id: int,
+    class_token_id: Optional[int] = None,
+    projections: Optional[Sequence[Projection]] = None,
+) -> Callable:
+    """
+    Creates a jitted function computing the embeddings of several layers in a single
+    forward pass.
+
+    Args:
+        apply_fn: Apply function of the transformed Nucleotide Transformer.
+        layers: Layers whose embeddings are returned, among the
+            embeddings_layers_to_save of the model config.
+        pooling: Pooling mode, see pool_embeddings.
+        pad_token_id: Id of the pad token.
+        class_token_id: Optional id of the class token, excluded from the mean.
+        projections: Optional projection of the embeddings of each layer, applied
+            on device. They must have the same number of components.
+
+    Returns:
+        Function mapping (params, random_key, tokens) to the embeddings, of shape
+        (batch_size, num_layers, embed_dim), or (batch_size, seq_len, num_layers,
+        embed_dim) if pooling is "none". embed_dim is the number of components of
+        the projections, if any.
+    """
+
+    def embedding_fn(
+        params: hk.Params, random_key: jnp.ndarray, tokens: Tokens
+    ) -> jnp.ndarray:
+        outs = apply_fn(params, random_key, tokens)
+        embeddings = [
+            pool_embeddings(
+                outs[f"embeddings_{layer}"],
+                tokens,
+                pooling=pooling,
+                pad_token_id=pad_token_id,
+                class_token_id=class_token_id,
+            )
+            for layer in layers
+        ]
+        if projections is not None:
+            embeddings = [
+                projection.project(layer_embeddings)
+                for projection, layer_embeddings in zip(projections, embeddings)
+            ]
+        return jnp.stack(embeddings, axis=-2)
+
+    return jax.jit(embedding_fn)
+
+
+def main() -> None:
+    """Embeds a FASTA or BED file, see --help for the arguments."""
+    from nucleotide_transformer.pretrained import get_pretrained_model
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--fasta", required=True)
+    parser.add_argument("--bed", default=None)
+    parser.add_argument("--window-length", type=int, default=None)
+    parser.add_argument("--model-name", required=True)
+    parser.add_argument("--layers", type=int, nargs="+", required=True)
+    parser.add_argument("--pooling", default="mean", choices=SUPPORTED_POOLINGS)
+    parser.add_argument("--max-positions", type=int, default=1000)
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--max-tokens-per-batch", type=int, default=16384)
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--codec", default="float32", choices=SUPPORTED_CODECS)
+    parser.add_argument("--pca-components", type=int, default=None)
+    parser.add_argument("--pca-num-regions", type=int, default=10000)
+    parser.add_argument("--projection-timeout", type=float, default=6 * 3600)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(
+            f"Shard index {args.shard_index} out of range for {args.num_shards} "
+            "shards."
+        )
+
+    genome = read_fasta(args.fasta)
+    regions = (
+        read_bed(args.bed)
+        if args.bed is not None
+        else tile_records(genome, args.window_length)
+    )
+    layers = tuple(args.layers)
+    writer = EmbeddingStoreWriter(
+        args.output_dir,
+        manifest={
+            "model_name": args.model_name,
+            "layers": list(layers),
+            "pooling": args.pooling,
+            "max_positions": args.max_positions,
+            "chunk_size": args.chunk_size,
+            "codec": args.codec,
+            "pca_components": args.pca_components,
+        },
+        region_names=[region.name for region in regions],
+    )
+
+    # Chunks are assigned round-robin, so that shards get similar workloads
+    chunk_indices = [
+        i
+        for i in range(args.shard_index, writer.num_chunks, args.num_shards)
+        if not writer.is_chunk_complete(i)
+    ]
+    logger.info(
+        "Shard %d/%d: %d chunks to compute, out of %d.",
+        args.shard_index,
+        args.num_shards,
+        len(chunk_indices),
+        len(range(args.shard_index, writer.num_chunks, args.num_shards)),
+    )
+    names = [f"embeddings_{layer}" for layer in layers]
+    fit_projections = (
+        args.pca_components is not None
+        and args.shard_index == 0
+        and any(writer.read_projection(name) is None for name in names)
+    )
+    if not chunk_indices and not fit_projections:
+        return
+
+    parameters, forward_fn, tokenizer, _ = get_pretrained_model(
+        model_name=args.model_name,
+        embeddings_layers_to_save=layers,
+        max_positions=args.max_positions,
+    )
+    apply_fn = hk.transform(forward_fn).apply
+    random_key = jax.random.PRNGKey(0)
+
+    def tokenize_regions(region_indices: Sequence[int]) -> Tuple[List[List[int]], int]:
+        tokens_ids = []
+        num_nucleotides = 0
+        for region_index in region_indices:
+            region = regions[region_index]
+            if region.chromosome not in genome:
+                raise ValueError(
+                    f"Region {region.name} is on {region.chromosome}, which is "
+                    f"not in {args.fasta}."
+                )
+            sequence = genome[region.chromosome][region.start : region.end]
+            _, sequence_tokens_ids = tokenizer.tokenize(sequence)
+            if len(sequence_tokens_ids) > args.max_positions:
+                raise ValueError(
+                    f"Region {region.name} has {len(sequence_tokens_ids)} tokens, "
+                    f"more than --max-positions ({args.max_positions}). Split "
+                    "the regions, e.g. with --window-length."
+                )
+            tokens_ids.append(sequence_tokens_ids)
+            num_nucleotides += len(sequence)
+        return tokens_ids, num_nucleotides
+
+    def embed(
+        embedding_fn: Callable, tokens_ids: List[List[int]]
+    ) -> Tuple[List[np.ndarray], Dict[str, float]]:
+        return run_scheduled(
+            lambda tokens: embedding_fn(parameters, random_key, tokens),
+            tokens_ids,
+            tokenizer.pad_token_id,
+            max_tokens_per_batch=args.max_tokens_per_batch,
+            max_length=args.max_positions,
+            crop_to_length=args.pooling == "none",
+            deduplicate=True,
+        )
+
+    projections = None
+    if args.pca_components is not None:
+        if fit_projections:
+            fit_projection_fn = build_layers_embedding_fn(
+                apply_fn,
+                layers,
+                pooling=args.pooling,
+                pad_token_id=tokenizer.pad_token_id,
+                class_token_id=tokenizer.class_token_id,
+            )
+            pcas = [IncrementalPCA(args.pca_components) for _ in layers]
+            sample = np.unique(
+                np.linspace(
+                    0, len(regions) - 1, min(args.pca_num_regions, len(regions))
+                ).astype(int)
+            )
+            for start in range(0, len(sample), args.chunk_size):
+                tokens_ids, _ = tokenize_regions(
+                    sample[start : start + args.chunk_size]
+                )
+                outputs, _ = embed(fit_projection_fn, tokens_ids)
+                for i, pca in enumerate(pcas):
+                    pca.partial_fit(
+                        np.concatenate(
+                            [
+                                np.reshape(output[..., i, :], (-1, output.shape[-1]))
+                                for output in outputs
+                            ]
+                        )
+                    )
+            for name, pca in zip(names, pcas):
+                projection = pca.projection()
+                writer.write_projection(name, projection)
+                logger.info(
+                    "Projection of %s fit on %d regions, explained variance %.2f%%.",
+                    name,
+                    len(sample),
+                    100 * projection.explained_variance_ratio,
+                )
+
+        # Shard 0 fits the projections, the other shards wait for them. A timeout
+        # keeps them from waiting forever on a shard 0 that failed
+        deadline = time.monotonic() + args.projection_timeout
+        while any(writer.read_projection(name) is None for name in names):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Shard 0 did not write the projections to {args.output_dir} "
+                    f"within {args.projection_timeout:.0f} seconds. Check that it "
+                    "did not fail, or increase --projection-timeout."
+                )
+            logger.info("Waiting for shard 0 to fit the projections.")
+            time.sleep(min(30, remaining))
+        projections = [writer.read_projection(name) for name in names]
+
+    embedding_fn = build_layers_embedding_fn(
+        apply_fn,
+        layers,
+        pooling=args.pooling,
+        pad_token_id=tokenizer.pad_token_id,
+        class_token_id=tokenizer.class_token_id,
+        projections=projections,  # type: ignore
+    )
+
+    def tokenized_chunks() -> Iterator[Tuple[int, List[List[int]], int]]:
+        for chunk_index in chunk_indices:
+            yield chunk_index, *tokenize_regions(writer.chunk_regions(chunk_index))
+
+    # The next chunk is tokenized while the current one is computed
+    start_time = time.perf_counter()
+    total_regions = 0
+    total_nucleotides = 0
+    for chunk_index, tokens_ids, num_nucleotides in prefetch_in_background(
+        tokenized_chunks(), buffer_size=1
+    ):
+        chunk_start_time = time.perf_counter()
+        outputs, stats = embed(embedding_fn, tokens_ids)
+        writer.write_chunk(
+            chunk_index,
+            {
+                f"embeddings_{layer}": [output[..., i, :] for output in outputs]
+                for i, layer in enumerate(layers)
+            },
+            metadata={
+                "seconds": time.perf_counter() - chunk_start_time,
+                "num_nucleotides": num_nucleotides,
+                **stats,
+            },
+        )
+
+        total_regions += len(tokens_ids)
+        total_nucleotides += num_nucleotides
+        elapsed = time.perf_counter() - start_time
+        logger.info(
+            "Chunk %d written: %.1f regions/s, %.0f nucleotides/s, padding "
+            "efficiency %.1f%%, dedup ratio %.1f%%.",
+            chunk_index,
+            total_regions / elapsed,
+            total_nucleotides / elapsed,
+            100 * stats["padding_efficiency"],
+            100 * stats["dedup_ratio"],
+        )
+
+    logger.info(
+        "Shard %d/%d done: %d regions in %.0fs.",
+        args.shard_index,
+        args.num_shards,
+        total_regions,
+        time.perf_counter() - start_time,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Data pipelines feeding the Nucleotide Transformer."""
+import queue
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import jax
+import numpy as np
+
+from nucleotide_transformer.model import NucleotideTransformerConfig
+from nucleotide_transformer.tokenizers import StandardTokenizer
+
+# Sentinel put in the prefetch queue once the source iterator is exhausted
+_END_OF_ITERATOR = object()
+
+
+class _ExceptionWrapper:
+    """Carries an exception raised in the prefetch thread to the consumer."""
+
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+def prefetch_in_background(iterator: Iterable[Any], buffer_size: int = 2) -> Iterator:
+    """
+    Consumes an iterator in a background thread, so that the elements are ready when
+    the consumer (e.g. the jitted train step) asks for them. Exceptions raised by the
+    iterator are re-raised in the consumer thread.
+
+    Args:
+        iterator: Iterable to consume.
+        buffer_size: Maximum number of elements computed ahead.
+
+    Yields:
+        The elements of the iterator, in order.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=buffer_size)
+    stop_event = threading.Event()
+
+    def put(element: Any) -> bool:
+        # Gives up if the consumer stopped iterating
+        while not stop_event.is_set():
+            try:
+                buffer.put(element, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer() -> None:
+        try:
+            for element in iterator:
+                if not put(element):
+                    return
+        except Exception as exception:
+            put(_ExceptionWrapper(exception))
+            return
+        put(_END_OF_ITERATOR)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            element = buffer.get()
+            if element is _END_OF_ITERATOR:
+                break
+            if isinstance(element, _ExceptionWrapper):
+                raise element.exception
+            yield element
+    finally:
+        # Stops the producer if the consumer leaves early
+        stop_event.set()
+
+
+def prefetch_to_device(
+    iterator: Iterable[Any], buffer_size: int = 2, device: Optional[Any] = None
+) -> Iterator:
+    """
+    Prepares the elements of an iterator (e.g. tokenization and padding) and copies
+    them to the device in a background thread, so that the next buffer_size batches
+    are already on device while the current one is computed.
+
+    Args:
+        iterator: Iterable of arrays or pytrees of arrays.
+        buffer_size: Maximum number of elements transferred ahead.
+        device: Device to transfer to. If None, the default device.
+
+    Yields:
+        The elements of the iterator, as device arrays.
+    """
+    return prefetch_in_background(
+        (jax.device_put(element, device) for element in iterator),
+        buffer_size=buffer_size,
+    )
+
+
+class MLMMasker:
+    """
+    Applies the BERT masking scheme to whole batches of token ids: a fraction
+    masking_ratio of the standard tokens of each sequence is selected, a fraction
+    masking_prob of the selected tokens is replaced by the mask token, half of the
+    remaining ones by a random token and the other half is left unchanged (80/10/10
+    with the default masking_prob=0.8). Special and pad tokens are never selected.
+    """
+
+    def __init__(
+        self,
+        tokenizer: StandardTokenizer,
+        masking_ratio: float = 0.15,
+        masking_prob: float = 0.8,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            tokenizer: Tokenizer used to tokenize the sequences.
+            masking_ratio: Fraction of the tokens selected for the loss.
+            masking_prob: Fraction of the selected tokens replaced by the mask token.
+            seed: Seed of the random generator.
+        """
+        if not 0.0 < masking_ratio <= 1.0:
+            raise ValueError(f"masking_ratio should be in (0, 1], got {masking_ratio}.")
+        if not 0.0 <= masking_prob <= 1.0:
+            raise ValueError(f"masking_prob should be in [0, 1], got {masking_prob}.")
+
+        self._masking_ratio = masking_ratio
+        self._masking_prob = masking_prob
+        self._random_prob = (1.0 - masking_prob) / 2
+        self._mask_token_id = tokenizer.mask_token_id
+        self._standard_tokens_ids = np.asarray(
+            [tokenizer.token_to_id(token) for token in tokenizer.standard_tokens],
+            dtype=np.int32,
+        )
+        self._random_generator = np.random.default_rng(seed)
+
+    @classmethod
+    def from_config(
+        cls,
+        tokenizer: StandardTokenizer,
+        config: NucleotideTransformerConfig,
+        seed: int = 0,
+    ) -> "MLMMasker":
+        """
+        Creates a masker following the masking hyperparameters of a model.
+
+        Args:
+            tokenizer: Tokenizer of the model.
+            config: Model hyperparameters, their masking_ratio and masking_prob are
+                used.
+            seed: Seed of the random generator.
+
+        Returns:
+            The masker.
+        """
+        return cls(
+            tokenizer=tokenizer,
+            masking_ratio=config.masking_ratio,
+            masking_prob=config.masking_prob,
+            seed=seed,
+        )
+
+    def __call__(self, tokens: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Masks a batch of token ids.
+
+        Args:
+            tokens: Token ids of shape (batch_size, seq_len).
+
+        Returns:
+            Dictionary containing:
+                "tokens": the masked token ids, of shape (batch_size, seq_len).
+                "targets": the original token ids, of shape (batch_size, seq_len).
+                "loss_mask": True at the selected tokens, of shape
+                    (batch_size, seq_len).
+                "masked_positions": positions of the selected tokens, of shape
+                    (batch_size, num_masked) with num_masked =
+                    ceil(masking_ratio * seq_len), to be passed to the model to
+                    compute the logits at these positions only.
+                "masked_positions_mask": validity of the masked positions, of shape
+                    (batch_size, num_masked).
+        """
+        tokens = np.asarray(tokens)
+        batch_size, seq_len = tokens.shape
+        rng = self._random_generator
+
+        maskable = np.isin(tokens, self._standard_tokens_ids)
+        num_maskable = maskable.sum(axis=-1)
+        # Stochastic rounding keeps the expected ratio exact for short sequences
+        num_selected = np.floor(
+            self._masking_ratio * num_maskable + rng.random(batch_size)
+        ).astype(np.int32)
+        num_selected = np.minimum(num_selected, num_maskable)
+        num_masked = int(np.ceil(self._masking_ratio * seq_len))
+
+        # Random permutation of the maskable positions, non-maskable ones last
+        scores = np.where(maskable, rng.random((batch_size, seq_len)), 2.0)
+        masked_positions = np.argsort(scores, axis=-1)[:, :num_masked]
+        masked_positions = masked_positions.astype(np.int32)
+        masked_positions_mask = np.arange(num_masked)[None] < num_selected[:, None]
+
+        rows = np.repeat(np.arange(batch_size)[:, None], num_masked, axis=1)
+        rows = rows[masked_positions_mask]
+        selected_positions = masked_positions[masked_positions_mask]
+
+        loss_mask = np.zeros((batch_size, seq_len), dtype=bool)
+        loss_mask[rows, selected_positions] = True
+
+        # 80/10/10 replacement of the selected tokens
+        replacement = rng.random(len(rows))
+        use_mask_token = replacement < self._masking_prob
+        use_random_token = (~use_mask_token) & (
+            replacement < self._masking_prob + self._random_prob
+        )
+        masked_tokens = tokens.copy()
+        masked_tokens[rows[use_mask_token], selected_positions[use_mask_token]] = (
+            self._mask_token_id
+        )
+        masked_tokens[rows[use_random_token], selected_positions[use_random_token]] = (
+            rng.choice(self._standard_tokens_ids, size=int(use_random_token.sum()))
+        )
+
+        return {
+            "tokens": masked_tokens,
+            "targets": tokens,
+            "loss_mask": loss_mask,
+            "masked_positions": masked_positions,
+            "masked_positions_mask": masked_positions_mask,
+        }
+
+
+def _batch_sequences(sequences: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    """Groups sequences in lists of batch_size, the last one possibly shorter."""
+    batch: List[str] = []
+    for sequence in sequences:
+        batch.append(sequence)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_mlm_batches(
+    sequences: Iterable[str],
+    tokenizer: StandardTokenizer,
+    masker: MLMMasker,
+    batch_size: int,
+    drop_remainder: bool = True,
+    prefetch_size: Optional[int] = 2,
+) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Tokenizes and masks a stream of sequences into MLM training batches. Tokenization
+    and masking run in a background thread, ahead of the training step.
+
+    Args:
+        sequences: Nucleotide sequences.
+        tokenizer: Tokenizer of the model. A FixedSizeNucleotidesKmersTokenizer
+            yields batches of static shape.
+        masker: Masker applied to each batch of token ids.
+        batch_size: Number of sequences per batch.
+        drop_remainder: Whether to drop the last incomplete batch.
+        prefetch_size: Number of batches prepared ahead. If None, batches are
+            prepared in the calling thread.
+
+    Yields:
+        Masked batches, see MLMMasker.__call__.
+
+    Example:
+        masker = MLMMasker.from_config(tokenizer, config)
+        batches = build_mlm_batches(sequences, tokenizer, masker, batch_size=32)
+        state = trainer.fit(state, batches)
+    """
+
+    def batches() -> Iterator[Dict[str, np.ndarray]]:
+        for batch_sequences in _batch_sequences(sequences, batch_size):
+            if drop_remainder and len(batch_sequences) < batch_size:
+                return
+            tokens = np.asarray(
+                [
+                    tokens_ids
+                    for _, tokens_ids in tokenizer.batch_tokenize(batch_sequences)
+                ],
+                dtype=np.int32,
+            )
+            yield masker(tokens)
+
+    if prefetch_size is None:
+        return batches()
+    return prefetch_in_background(batches(), buffer_size=prefetch_size)
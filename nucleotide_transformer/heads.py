@@ -55,12 +55,37 @@ class DownSample1D(hk.Module):
 
         self._activation_fn = get_activation_fn(activation_name=activation_fn)
 
-    def __call__(self, x: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    def __call__(
+        self, x: jnp.ndarray, mask: Optional[jnp.ndarray] = None
+    ) -> Tuple[jnp.ndarray, jnp.ndarray, Optional[jnp.ndarray]]:
+        """
+        Args:
+            x: Input of shape (batch_size, seq_len, channels).
+            mask: Optional mask of shape (batch_size, seq_len, 1), 1 at the valid
+                positions. The masked positions are zeroed before each convolution
+                and excluded from the average pooling.
+
+        Returns:
+            Pooled output of shape (batch_size, ceil(seq_len / 2), output_channels).
+            Hidden state before pooling, for the skip connection.
+            Mask of the pooled output, or None if mask is None.
+        """
         for _, conv_layer in enumerate(self._conv_layers):
+            if mask is not None:
+                x = x * mask
             x = self._activation_fn(conv_layer(x))
         hidden = x
-        x = self._avg_pool(hidden)
-        return x, hidden
+        if mask is None:
+            return self._avg_pool(hidden), hidden, None
+
+        hidden = hidden * mask
+        # Both averages divide by the window size, which cancels out in the ratio. A
+        # window with a single valid position pools to that position and stays
+        # valid: padding the input further never changes the windows of the valid
+        # positions, so the predictions do not depend on the padded length
+        pooled_mask = self._avg_pool(mask)
+        x = self._avg_pool(hidden) / jnp.maximum(pooled_mask, 1e-6)
+        return x, hidden, (pooled_mask > 0).astype(mask.dtype)
 
 
 class UpSample1D(hk.Module):
@@ -104,8 +129,21 @@ class UpSample1D(hk.Module):
         self._interpolation_method = interpolation_method
         self._activation_fn = get_activation_fn(activation_name=activation_fn)
 
-    def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
+    def __call__(
+        self, x: jnp.ndarray, mask: Optional[jnp.ndarray] = None
+    ) -> jnp.ndarray:
+        """
+        Args:
+            x: Input of shape (batch_size, seq_len, channels).
+            mask: Optional mask of shape (batch_size, seq_len, 1), 1 at the valid
+                positions. The masked positions are zeroed before each convolution.
+
+        Returns:
+            Output of shape (batch_size, 2 * seq_len, output_channels).
+        """
         for _, conv_layer in enumerate(self._conv_layers):
+            if mask is not None:
+                x = x * mask
             x = self._activation_fn(conv_layer(x))
         x = jax.image.resize(
             x,
@@ -153,8 +191,21 @@ class FinalConv1D(hk.Module):
 
         self._activation_fn = get_activation_fn(activation_name=activation_fn)
 
-    def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
+    def __call__(
+        self, x: jnp.ndarray, mask: Optional[jnp.ndarray] = None
+    ) -> jnp.ndarray:
+        """
+        Args:
+            x: Input of shape (batch_size, seq_len, channels).
+            mask: Optional mask of shape (batch_size, seq_len, 1), 1 at the valid
+                positions. The masked positions are zeroed before each convolution.
+
+        Returns:
+            Output of shape (batch_size, seq_len, output_channels).
+        """
         for i, conv_layer in enumerate(self._conv_layers):
+            if mask is not None:
+                x = x * mask
             x = conv_layer(x)
             if i < len(self._conv_layers) - 1:
                 x = self._activation_fn(x)
@@ -219,24 +270,51 @@ class UNET1DSegmentationHead(hk.Module):
             num_layers=num_conv_layers_per_block,
         )
 
-    def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
+    def __call__(
+        self, x: jnp.ndarray, sequence_mask: Optional[SequenceMask] = None
+    ) -> jnp.ndarray:
+        """
+        Inputs whose length is not divisible by 2 to the power of the number of
+        pooling layers are padded, and the output is cropped back to the input
+        length.
 
-        if x.shape[1] % 2**self._num_pooling_layers:
-            raise ValueError(
-                "Input length must be divisible by the 2 to the power of"
-                " number of poolign layers."
-            )
+        Args:
+            x: Input of shape (batch_size, seq_len, embed_dim).
+            sequence_mask: Optional mask of shape (batch_size, seq_len), 1 at the
+                valid positions. The masked positions (e.g. pad tokens) do not
+                contribute to the predictions at the valid ones.
 
-        hiddens = []
+        Returns:
+            Output of shape (batch_size, seq_len, 2 * num_classes).
+        """
+        seq_len = x.shape[1]
+        multiple = 2**self._num_pooling_layers
+        pad_length = -seq_len % multiple
+        if pad_length or sequence_mask is not None:
+            if sequence_mask is None:
+                sequence_mask = jnp.ones(x.shape[:2])
+            mask = sequence_mask[:, :, None].astype(x.dtype)
+            x = jnp.pad(x, ((0, 0), (0, pad_length), (0, 0)))
+            mask = jnp.pad(mask, ((0, 0), (0, pad_length), (0, 0)))
+        else:
+            mask = None
+
+        hiddens, masks = [], []
         for downsample_block in self._downsample_blocks:
-            x, hidden = downsample_block(x)
+            masks.append(mask)
+            x, hidden, mask = downsample_block(x, mask)
             hiddens.append(hidden)
 
-        for upsample_block, hidden in zip(self._upsample_blocks, reversed(hiddens)):
-            x = upsample_block(x) + hidden
+        for upsample_block, hidden, hidden_mask in zip(
+            self._upsample_blocks, reversed(hiddens), reversed(masks)
+        ):
+            x = upsample_block(x, mask) + hidden
+            mask = hidden_mask
+            if mask is not None:
+                x = x * mask
 
-        x = self._final_block(x)
-        return x
+        x = self._final_block(x, mask)
+        return x[:, :seq_len]
 
 
 class UNetHead(hk.Module):
@@ -268,10 +346,10 @@ class UNetHead(hk.Module):
                 embed_dimension * (2**i) for i in range(num_layers)
             ),
         )
-        fc = hk.Linear(
+        self._unet = unet
+        self._fc = hk.Linear(
             6 * 2 * self._num_features, w_init=w_init, b_init=b_init, name="fc"
         )
-        self._fc = hk.Sequential([unet, jax.nn.swish, fc])
 
     def __call__(
         self, x: jnp.ndarray, sequence_mask: SequenceMask
@@ -279,8 +357,14 @@ class UNetHead(hk.Module):
         """
         Input shape: (batch_size, sequence_length + 1, embed_dim)
         Output_shape: (batch_size, 6 * sequence_length, 2)
+
+        The sequence length does not need to be divisible by 2 to the power of the
+        number of UNet pooling layers, and the positions masked by sequence_mask
+        (of shape (batch_size, sequence_length + 1)) do not affect the others.
         """
         batch_size, seq_len = x.shape[0], x.shape[1] - 1
-        logits = self._fc(x[:, 1:])  # remove CLS token
+        # remove CLS token
+        x = self._unet(x[:, 1:], sequence_mask=sequence_mask[:, 1:])
+        logits = self._fc(jax.nn.swish(x))
         logits = jnp.reshape(logits, (batch_size, seq_len * 6, self._num_features, 2))
         return {"logits": logits}
@@ -0,0 +1,667 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers to compute embeddings with the Nucleotide Transformer."""
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from nucleotide_transformer.data import prefetch_to_device
+from nucleotide_transformer.tokenizers import StandardTokenizer
+from nucleotide_transformer.types import Embedding, Tokens
+
+SUPPORTED_POOLINGS = ["mean", "cls", "none"]
+
+# IUPAC complements, other characters (e.g. N) are kept unchanged
+_COMPLEMENT = str.maketrans("ATCGMKRYBVDHatcgmkrybvdh", "TAGCKMYRVBHDtagckmyrvbhd")
+
+
+def reverse_complement(sequence: str) -> str:
+    """
+    Args:
+        sequence: Nucleotide sequence.
+
+    Returns:
+        Reverse complement of the sequence.
+    """
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def deduplicate_tokens_ids(
+    tokens_ids: List[List[int]],
+    reverse_tokens_ids: Optional[List[List[int]]] = None,
+) -> Tuple[List[List[int]], np.ndarray]:
+    """
+    Removes the repeated sequences from token ids.
+
+    Args:
+        tokens_ids: Token ids of each sequence.
+        reverse_tokens_ids: Optional token ids of the reverse complement of each
+            sequence. If given, a sequence and its reverse complement are repeats.
+
+    Returns:
+        Token ids of the unique sequences, in order of first occurrence.
+        Index of each input sequence in the unique ones, of shape (num_sequences,).
+    """
+    unique_indices: Dict[bytes, int] = {}
+    unique_tokens_ids: List[List[int]] = []
+    inverse = np.empty(len(tokens_ids), dtype=np.int64)
+    for i, sequence_tokens_ids in enumerate(tokens_ids):
+        key = np.asarray(sequence_tokens_ids, dtype=np.int32).tobytes()
+        if reverse_tokens_ids is not None:
+            # Both strands of a region map to the smallest of their two keys
+            reverse_key = np.asarray(reverse_tokens_ids[i], dtype=np.int32).tobytes()
+            key = min(key, reverse_key)
+        if key not in unique_indices:
+            unique_indices[key] = len(unique_tokens_ids)
+            unique_tokens_ids.append(sequence_tokens_ids)
+        inverse[i] = unique_indices[key]
+    return unique_tokens_ids, inverse
+
+
+def pad_tokens_ids(
+    tokens_ids: List[List[int]], pad_token_id: int, length: int
+) -> np.ndarray:
+    """
+    Pads token ids of sequences of different lengths into a single array.
+
+    Args:
+        tokens_ids: Token ids of each sequence.
+        pad_token_id: Id of the pad token.
+        length: Length of the padded sequences.
+
+    Returns:
+        Padded token ids of shape (num_sequences, length).
+    """
+    padded = np.full((len(tokens_ids), length), pad_token_id, dtype=np.int32)
+    for i, sequence_tokens_ids in enumerate(tokens_ids):
+        if len(sequence_tokens_ids) > length:
+            raise ValueError(
+                f"Found a sequence with {len(sequence_tokens_ids)} tokens that "
+                f"exceeds the padding length ({length})."
+            )
+        padded[i, : len(sequence_tokens_ids)] = sequence_tokens_ids
+    return padded
+
+
+def pool_embeddings(
+    embeddings: Embedding,
+    tokens: Tokens,
+    pooling: str,
+    pad_token_id: int,
+    class_token_id: Optional[int] = None,
+) -> jnp.ndarray:
+    """
+    Pools per-token embeddings into per-sequence embeddings.
+
+    Args:
+        embeddings: Embeddings of shape (batch_size, seq_len, embed_dim).
+        tokens: Token ids of shape (batch_size, seq_len).
+        pooling: "mean" averages the embeddings of the tokens that are neither pad
+            nor class tokens, "cls" takes the embedding of the first token and
+            "none" returns the per-token embeddings.
+        pad_token_id: Id of the pad token.
+        class_token_id: Optional id of the class token, excluded from the mean.
+
+    Returns:
+        Embeddings of shape (batch_size, embed_dim), or (batch_size, seq_len,
+        embed_dim) if pooling is "none".
+    """
+    if pooling not in SUPPORTED_POOLINGS:
+        raise ValueError(
+            f"Pooling {pooling} not supported. Supported poolings are "
+            f"{SUPPORTED_POOLINGS}."
+        )
+    if pooling == "none":
+        return embeddings
+    if pooling == "cls":
+        return embeddings[:, 0]
+
+    mask = tokens != pad_token_id
+    if class_token_id is not None:
+        mask = mask & (tokens != class_token_id)
+    mask = mask[:, :, None].astype(jnp.float32)
+    summed = jnp.sum(embeddings.astype(jnp.float32) * mask, axis=1)
+    mean = summed / jnp.maximum(jnp.sum(mask, axis=1), 1.0)
+    return mean.astype(embeddings.dtype)
+
+
+def build_embedding_fn(
+    apply_fn: Callable,
+    embeddings_layer: int,
+    pooling: str,
+    pad_token_id: int,
+    class_token_id: Optional[int] = None,
+) -> Callable:
+    """
+    Creates a jitted function computing pooled embeddings, so that only the pooled
+    embeddings are transferred back to the host.
+
+    Args:
+        apply_fn: Apply function of the transformed Nucleotide Transformer. The layer
+            must be among the embeddings_layers_to_save of the model config.
+        embeddings_layer: Layer whose embeddings are returned.
+        pooling: Pooling mode, see pool_embeddings.
+        pad_token_id: Id of the pad token.
+        class_token_id: Optional id of the class token, excluded from the mean.
+
+    Returns:
+        Function mapping (params, random_key, tokens) to the embeddings.
+    """
+    if pooling not in SUPPORTED_POOLINGS:
+        raise ValueError(
+            f"Pooling {pooling} not supported. Supported poolings are "
+            f"{SUPPORTED_POOLINGS}."
+        )
+
+    def embedding_fn(
+        params: hk.Params, random_key: jnp.ndarray, tokens: Tokens
+    ) -> jnp.ndarray:
+        outs = apply_fn(params, random_key, tokens)
+        return pool_embeddings(
+            outs[f"embeddings_{embeddings_layer}"],
+            tokens,
+            pooling=pooling,
+            pad_token_id=pad_token_id,
+            class_token_id=class_token_id,
+        )
+
+    return jax.jit(embedding_fn)
+
+
+class ScheduledBatch(NamedTuple):
+    """Batch of sequences padded to a common length."""
+
+    indices: np.ndarray
+    length: int
+    batch_size: int
+
+
+def schedule_batches(
+    lengths: Sequence[int],
+    max_tokens_per_batch: int,
+    length_multiple: int = 64,
+    max_batch_size: Optional[int] = None,
+    max_length: Optional[int] = None,
+) -> List[ScheduledBatch]:
+    """
+    Groups sequences of similar lengths into batches, so that little compute is
+    spent on padding. Sequences are sorted by decreasing length and added to the
+    current batch as long as its padded size stays within max_tokens_per_batch.
+    Padded lengths are rounded up to a multiple of length_multiple and batch sizes
+    to a power of two (capped to max_batch_size), to bound the number of compiled
+    shapes.
+
+    Args:
+        lengths: Number of tokens of each sequence.
+        max_tokens_per_batch: Maximum number of tokens, padding included, per batch.
+        length_multiple: Padded lengths are multiples of this value.
+        max_batch_size: Optional maximum number of sequences per batch.
+        max_length: Optional maximum padded length, e.g. the max_positions of the
+            model, padded lengths are capped to it.
+
+    Returns:
+        Batches, each with the indices of its sequences in lengths, its padded
+        length and its padded batch size.
+    """
+
+    def round_length(length: int) -> int:
+        rounded = max(-(-length // length_multiple) * length_multiple, length_multiple)
+        return rounded if max_length is None else min(rounded, max_length)
+
+    if max_length is not None and max(lengths, default=0) > max_length:
+        raise ValueError(
+            f"Found a sequence with {max(lengths)} tokens that exceeds max_length "
+            f"({max_length})."
+        )
+
+    def round_batch_size(batch_size: int) -> int:
+        rounded = int(2 ** np.ceil(np.log2(batch_size)))
+        return rounded if max_batch_size is None else min(rounded, max_batch_size)
+
+    if round_length(max(lengths, default=0)) > max_tokens_per_batch:
+        raise ValueError(
+            f"Found a sequence with {max(lengths)} tokens that exceeds "
+            f"max_tokens_per_batch ({max_tokens_per_batch}) once padded to a "
+            f"multiple of {length_multiple}."
+        )
+
+    batches: List[ScheduledBatch] = []
+    current: List[int] = []
+    current_length = 0
+
+    def close_batch() -> None:
+        batches.append(
+            ScheduledBatch(
+                np.asarray(current), current_length, round_batch_size(len(current))
+            )
+        )
+
+    for index in np.argsort(-np.asarray(lengths), kind="stable"):
+        if current:
+            fits = (
+                round_batch_size(len(current) + 1) * current_length
+                <= max_tokens_per_batch
+            )
+            full = max_batch_size is not None and len(current) == max_batch_size
+            if not fits or full:
+                close_batch()
+                current = []
+        if not current:
+            # Sequences are sorted, the first one of a batch sets its padded length
+            current_length = round_length(lengths[index])
+        current.append(int(index))
+    if current:
+        close_batch()
+    return batches
+
+
+def run_scheduled(
+    batch_fn: Callable[[jnp.ndarray], Any],
+    tokens_ids: List[List[int]],
+    pad_token_id: int,
+    max_tokens_per_batch: int,
+    length_multiple: int = 64,
+    max_batch_size: Optional[int] = None,
+    max_length: Optional[int] = None,
+    crop_to_length: bool = False,
+    deduplicate: bool = False,
+    reverse_tokens_ids: Optional[List[List[int]]] = None,
+    num_nucleotides: Optional[Sequence[int]] = None,
+    deduplicate_strands: bool = False,
+    prefetch_size: Optional[int] = 2,
+) -> Tuple[List[np.ndarray], Dict[str, float]]:
+    """
+    Runs a batched function over sequences of different lengths, with the batches
+    of schedule_batches, and returns the results in the order of the inputs.
+
+    In the strand-symmetric mode, i.e. when reverse_tokens_ids is given, each
+    scheduled batch is built for both strands and batch_fn receives the padded
+    tokens of the sequences, those of their reverse complements and the number of
+    nucleotides of each sequence, as the function of build_strand_symmetric_fn.
+
+    Args:
+        batch_fn: Function mapping padded tokens of shape (batch_size, length) to
+            an array whose first axis is the batch, e.g. a jitted embedding_fn of
+            build_embedding_fn with its parameters and key bound. In the
+            strand-symmetric mode, function mapping (forward_tokens,
+            reverse_tokens, num_nucleotides) to the outputs.
+        tokens_ids: Token ids of each sequence, e.g. from a tokenizer that does
+            not pad. The batches are formed from the numbers of tokens, so the
+            sequences are tokenized before scheduling. See run_batched to tokenize
+            in the background thread instead.
+        pad_token_id: Id of the pad token.
+        max_tokens_per_batch: See schedule_batches.
+        length_multiple: See schedule_batches.
+        max_batch_size: See schedule_batches.
+        max_length: See schedule_batches.
+        crop_to_length: Whether to crop the second axis of the results to the
+            length of each sequence, e.g. for per-token embeddings.
+        deduplicate: Whether to run batch_fn once per unique sequence, repeated
+            sequences then share the same result array.
+        reverse_tokens_ids: Token ids of the reverse complement of each sequence,
+            see tokenize_strands. Enables the strand-symmetric mode.
+        num_nucleotides: Number of nucleotides of each sequence, required in the
+            strand-symmetric mode.
+        deduplicate_strands: Whether to deduplicate, and to also run batch_fn once
+            for a sequence and its reverse complement. Only allowed in the
+            strand-symmetric mode with pooled outputs, which do not depend on the
+            strand.
+        prefetch_size: Number of batches padded and transferred to the device
+            ahead of the current one, in a background thread. If None, batches are
+            prepared in the calling thread.
+
+    Returns:
+        Result of each sequence, in the order of tokens_ids.
+        Statistics: "num_tokens" (tokens of the unique sequences, and of their
+        reverse complements in the strand-symmetric mode), "num_computed_tokens"
+        (tokens processed, padding included), "padding_efficiency" (ratio of the
+        two), "num_batches" and "dedup_ratio" (fraction of the sequences that were
+        not computed as duplicates).
+
+    Example:
+        embedding_fn = build_embedding_fn(apply_fn, 20, "mean", tokenizer.pad_token_id)
+        tokens_ids = [b[1] for b in tokenizer.batch_tokenize(sequences)]
+        embeddings, stats = run_scheduled(
+            lambda tokens: embedding_fn(params, random_key, tokens),
+            tokens_ids,
+            tokenizer.pad_token_id,
+            max_tokens_per_batch=32768,
+        )
+        print(f"Padding efficiency: {stats['padding_efficiency']:.1%}")
+
+        # Strand-symmetric pooled embeddings, a sequence and its reverse
+        # complement are computed once
+        symmetric_fn = build_strand_symmetric_fn(embedding_fn)
+        tokens_ids, reverse_tokens_ids, num_nucleotides = tokenize_strands(
+            tokenizer, sequences
+        )
+        embeddings, stats = run_scheduled(
+            lambda *strands: symmetric_fn(params, random_key, *strands),
+            tokens_ids,
+            tokenizer.pad_token_id,
+            max_tokens_per_batch=32768,
+            reverse_tokens_ids=reverse_tokens_ids,
+            num_nucleotides=num_nucleotides,
+            deduplicate_strands=True,
+        )
+    """
+    strand_symmetric = reverse_tokens_ids is not None
+    if strand_symmetric and num_nucleotides is None:
+        raise ValueError("num_nucleotides is required with reverse_tokens_ids.")
+    if deduplicate_strands and (not strand_symmetric or crop_to_length):
+        raise ValueError(
+            "deduplicate_strands requires the strand-symmetric mode and pooled "
+            "outputs: a sequence and its reverse complement only share their "
+            "outputs when they are averaged over both strands and pooled."
+        )
+
+    num_sequences = len(tokens_ids)
+    if deduplicate or deduplicate_strands:
+        unique_tokens_ids, inverse = deduplicate_tokens_ids(
+            tokens_ids, reverse_tokens_ids if deduplicate_strands else None
+        )
+        # Keeps the first occurrence of each unique sequence
+        first_indices = np.unique(inverse, return_index=True)[1]
+        tokens_ids = unique_tokens_ids
+        if strand_symmetric:
+            reverse_tokens_ids = [reverse_tokens_ids[i] for i in first_indices]
+            num_nucleotides = [num_nucleotides[i] for i in first_indices]
+    else:
+        inverse = np.arange(num_sequences)
+
+    lengths = [len(sequence_tokens_ids) for sequence_tokens_ids in tokens_ids]
+    # The reverse complement of a sequence can have one more token, e.g. when its
+    # 6-mers do not start at the same offset
+    scheduled_lengths = (
+        [max(length, len(t)) for length, t in zip(lengths, reverse_tokens_ids)]
+        if strand_symmetric
+        else lengths
+    )
+    batches = schedule_batches(
+        scheduled_lengths,
+        max_tokens_per_batch=max_tokens_per_batch,
+        length_multiple=length_multiple,
+        max_batch_size=max_batch_size,
+        max_length=max_length,
+    )
+
+    def pad_batch(batch: ScheduledBatch, batch_tokens_ids: List[List[int]]) -> Any:
+        batch_tokens_ids = batch_tokens_ids + [[]] * (
+            batch.batch_size - len(batch.indices)
+        )
+        return pad_tokens_ids(batch_tokens_ids, pad_token_id, batch.length)
+
+    def padded_batches() -> Iterator[Any]:
+        for batch in batches:
+            tokens = pad_batch(batch, [tokens_ids[i] for i in batch.indices])
+            if not strand_symmetric:
+                yield tokens
+                continue
+            reverse_tokens = pad_batch(
+                batch, [reverse_tokens_ids[i] for i in batch.indices]
+            )
+            batch_num_nucleotides = np.zeros(batch.batch_size, dtype=np.int32)
+            batch_num_nucleotides[: len(batch.indices)] = [
+                num_nucleotides[i] for i in batch.indices
+            ]
+            yield tokens, reverse_tokens, batch_num_nucleotides
+
+    tokens_iterator: Iterator = (
+        padded_batches()
+        if prefetch_size is None
+        else prefetch_to_device(padded_batches(), buffer_size=prefetch_size)
+    )
+
+    results: List[Optional[np.ndarray]] = [None] * len(tokens_ids)
+
+    def collect(batch: ScheduledBatch, outputs: jnp.ndarray) -> None:
+        for index, output in zip(batch.indices, np.asarray(outputs)):
+            results[index] = output[: lengths[index]] if crop_to_length else output
+
+    # The outputs of a batch are copied to the host once the next batch has been
+    # dispatched, so that the device does not wait for the transfer
+    pending: Optional[Tuple[ScheduledBatch, jnp.ndarray]] = None
+    num_computed_tokens = 0
+    for batch, tokens in zip(batches, tokens_iterator):
+        if strand_symmetric:
+            outputs = batch_fn(*(jnp.asarray(x) for x in tokens))
+            num_computed_tokens += 2 * batch.batch_size * batch.length
+        else:
+            outputs = batch_fn(jnp.asarray(tokens))
+            num_computed_tokens += batch.batch_size * batch.length
+        if pending is not None:
+            collect(*pending)
+        pending = (batch, outputs)
+    if pending is not None:
+        collect(*pending)
+
+    num_tokens = sum(lengths)
+    if strand_symmetric:
+        num_tokens += sum(len(t) for t in reverse_tokens_ids)  # type: ignore
+    stats = {
+        "num_tokens": float(num_tokens),
+        "num_computed_tokens": float(num_computed_tokens),
+        "padding_efficiency": num_tokens / max(num_computed_tokens, 1),
+        "num_batches": float(len(batches)),
+        "dedup_ratio": 1 - len(tokens_ids) / max(num_sequences, 1),
+    }
+    return [results[i] for i in inverse], stats  # type: ignore
+
+
+def run_batched(
+    batch_fn: Callable[[jnp.ndarray], Any],
+    sequences: Sequence[str],
+    tokenizer: StandardTokenizer,
+    batch_size: int,
+    prefetch_size: Optional[int] = 2,
+) -> List[np.ndarray]:
+    """
+    Runs a batched function over sequences, in batches of batch_size sequences in
+    the order of the inputs. The tokenization, padding and transfer to the device
+    of the next prefetch_size batches run in a background thread while the current
+    batch is computed, so that the device does not wait for the host.
+
+    Args:
+        batch_fn: Function mapping tokens of shape (batch_size, length) to an array
+            whose first axis is the batch.
+        sequences: Nucleotide sequences.
+        tokenizer: Tokenizer of the model. A FixedSizeNucleotidesKmersTokenizer
+            pads all the batches to the same length, so batch_fn is compiled once.
+        batch_size: Number of sequences per batch. The last batch is padded with
+            pad tokens to this size.
+        prefetch_size: Number of batches prepared ahead of the current one. If
+            None, batches are prepared in the calling thread.
+
+    Returns:
+        Result of each sequence, in the order of sequences.
+    """
+
+    def tokenized_batches() -> Iterator[np.ndarray]:
+        for start in range(0, len(sequences), batch_size):
+            batch_sequences = list(sequences[start : start + batch_size])
+            tokens = np.asarray(
+                [
+                    tokens_ids
+                    for _, tokens_ids in tokenizer.batch_tokenize(batch_sequences)
+                ],
+                dtype=np.int32,
+            )
+            yield np.pad(
+                tokens,
+                ((0, batch_size - len(batch_sequences)), (0, 0)),
+                constant_values=tokenizer.pad_token_id,
+            )
+
+    tokens_iterator: Iterator = (
+        tokenized_batches()
+        if prefetch_size is None
+        else prefetch_to_device(tokenized_batches(), buffer_size=prefetch_size)
+    )
+
+    results: List[np.ndarray] = []
+
+    def collect(outputs: jnp.ndarray) -> None:
+        num_results = min(batch_size, len(sequences) - len(results))
+        results.extend(np.asarray(outputs)[:num_results])
+
+    # Outputs are copied to the host once the next batch has been dispatched
+    pending: Optional[jnp.ndarray] = None
+    for tokens in tokens_iterator:
+        outputs = batch_fn(jnp.asarray(tokens))
+        if pending is not None:
+            collect(pending)
+        pending = outputs
+    if pending is not None:
+        collect(pending)
+    return results
+
+
+def tokenize_strands(
+    tokenizer: StandardTokenizer, sequences: List[str]
+) -> Tuple[List[List[int]], List[List[int]], List[int]]:
+    """
+    Tokenizes sequences and their reverse complements, without padding, e.g. for
+    the strand-symmetric mode of run_scheduled.
+
+    Args:
+        tokenizer: Tokenizer of the model.
+        sequences: Nucleotide sequences.
+
+    Returns:
+        Token ids of the sequences.
+        Token ids of their reverse complements.
+        Number of nucleotides of each sequence.
+    """
+    forward_tokens_ids = [
+        tokens_ids for _, tokens_ids in tokenizer.batch_tokenize(sequences)
+    ]
+    reverse_tokens_ids = [
+        tokens_ids
+        for _, tokens_ids in tokenizer.batch_tokenize(
+            [reverse_complement(sequence) for sequence in sequences]
+        )
+    ]
+    return (
+        forward_tokens_ids,
+        reverse_tokens_ids,
+        [len(sequence) for sequence in sequences],
+    )
+
+
+def tokenize_both_strands(
+    tokenizer: StandardTokenizer, sequences: List[str]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Tokenizes sequences and their reverse complements to a common padded length.
+
+    Args:
+        tokenizer: Tokenizer of the model.
+        sequences: Nucleotide sequences.
+
+    Returns:
+        Token ids of the sequences, of shape (num_sequences, length).
+        Token ids of their reverse complements, of the same shape.
+        Number of nucleotides of each sequence, of shape (num_sequences,).
+    """
+    forward_tokens_ids, reverse_tokens_ids, num_nucleotides = tokenize_strands(
+        tokenizer, sequences
+    )
+    length = max(len(t) for t in forward_tokens_ids + reverse_tokens_ids)
+    return (
+        pad_tokens_ids(forward_tokens_ids, tokenizer.pad_token_id, length),
+        pad_tokens_ids(reverse_tokens_ids, tokenizer.pad_token_id, length),
+        np.asarray(num_nucleotides, dtype=np.int32),
+    )
+
+
+def build_strand_symmetric_fn(fn: Callable, per_nucleotide: bool = False) -> Callable:
+    """
+    Creates a jitted function averaging the outputs of a model over both strands:
+    the sequences and their reverse complements are stacked in a single batch, run
+    in one call, and realigned and averaged on device.
+
+    Args:
+        fn: Function mapping (params, random_key, tokens) to an array whose first
+            axis is the batch, e.g. the embedding_fn of build_embedding_fn with a
+            pooling, or build_probabilities_fn for Segment-NT.
+        per_nucleotide: Whether the second axis of the outputs is the nucleotide
+            position, e.g. Segment-NT probabilities or nucleotide embeddings. The
+            outputs of the reverse complements are then reversed over the length
+            of each sequence before averaging. Otherwise the outputs are averaged
+            as they are, which suits pooled embeddings.
+
+    Returns:
+        Function mapping (params, random_key, forward_tokens, reverse_tokens,
+        lengths), see tokenize_both_strands, to the averaged outputs.
+
+    Example:
+        symmetric_fn = build_strand_symmetric_fn(build_embedding_fn(...))
+        embeddings = symmetric_fn(
+            params, random_key, *tokenize_both_strands(tokenizer, sequences)
+        )
+    """
+
+    def strand_symmetric_fn(
+        params: hk.Params,
+        random_key: jnp.ndarray,
+        forward_tokens: Tokens,
+        reverse_tokens: Tokens,
+        lengths: jnp.ndarray,
+    ) -> jnp.ndarray:
+        batch_size = forward_tokens.shape[0]
+        outputs = fn(
+            params, random_key, jnp.concatenate([forward_tokens, reverse_tokens])
+        )
+        forward_outputs, reverse_outputs = outputs[:batch_size], outputs[batch_size:]
+
+        if per_nucleotide:
+            # Position i of a sequence is position length - 1 - i of its reverse
+            positions = jnp.arange(forward_outputs.shape[1])[None]
+            indices = jnp.where(
+                positions < lengths[:, None], lengths[:, None] - 1 - positions, 0
+            )
+            indices = jnp.reshape(
+                indices, indices.shape + (1,) * (reverse_outputs.ndim - 2)
+            )
+            reverse_outputs = jnp.take_along_axis(reverse_outputs, indices, axis=1)
+            # Positions past the end of the sequences keep their forward outputs
+            reverse_outputs = jnp.where(
+                jnp.reshape(
+                    positions < lengths[:, None],
+                    indices.shape,
+                ),
+                reverse_outputs,
+                forward_outputs,
+            )
+
+        averaged = (
+            forward_outputs.astype(jnp.float32) + reverse_outputs.astype(jnp.float32)
+        ) / 2
+        return averaged.astype(outputs.dtype)
+
+    return jax.jit(strand_symmetric_fn)
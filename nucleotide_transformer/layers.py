@@ -13,7 +13,7 @@
 # limitations under the License.
 
 from dataclasses import dataclass
-from typing import Dict, Optional, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 import haiku as hk
 import jax
@@ -37,6 +37,12 @@ from nucleotide_transformer.utils import get_activation_fn
 # by key_size//2
 UPPER_FREQ = 10000
 
+SUPPORTED_ADAPTERS = ["lora", "ia3"]
+# Names of the parameters created by the adapters. They are stored next to the
+# pretrained "w" and "b" of the adapted linear layers, which keeps the pretrained
+# checkpoints loadable as they are.
+ADAPTER_PARAMETERS_NAMES = ("lora_a", "lora_b", "ia3_scale")
+
 
 @dataclass
 class RotaryEmbeddingConfig:
@@ -52,6 +58,138 @@ class RotaryEmbeddingConfig:
     rescaling_factor: Optional[float]
 
 
+@dataclass
+class AdapterConfig:
+    """
+    Parameters to initialize the parameter-efficient fine-tuning adapters injected in
+    the linear layers of the attention blocks.
+
+    Args:
+        adapter_type: Type of adapter, either "lora" (low-rank update of the weights,
+            see https://arxiv.org/abs/2106.09685) or "ia3" (learned rescaling of the
+            outputs, see https://arxiv.org/abs/2205.05638).
+        rank: Rank of the LoRA update. Ignored for IA³.
+        alpha: LoRA scaling, the low-rank update is multiplied by alpha / rank.
+            Ignored for IA³.
+        target_modules: Names of the linear layers to adapt, among "query", "key",
+            "value", "mha_output", "fc1" and "fc2".
+    """
+
+    adapter_type: str
+    rank: int = 8
+    alpha: float = 16.0
+    target_modules: Tuple[str, ...] = (
+        "query",
+        "key",
+        "value",
+        "mha_output",
+        "fc1",
+        "fc2",
+    )
+
+
+class AdaptedLinear(hk.Linear):
+    """
+    Linear layer augmented with a LoRA or IA³ adapter. The pretrained weights are
+    created under the usual "w" and "b" names, the adapter parameters are created in
+    the same module under the names listed in ADAPTER_PARAMETERS_NAMES.
+    """
+
+    def __init__(
+        self,
+        output_size: int,
+        adapter_config: AdapterConfig,
+        with_bias: bool = True,
+        w_init: Optional[hk.initializers.Initializer] = None,
+        b_init: Optional[hk.initializers.Initializer] = None,
+        name: Optional[str] = None,
+    ):
+        """
+        Args:
+            output_size: Output dimensionality.
+            adapter_config: Configuration of the adapter.
+            with_bias: Whether to add a bias to the output.
+            w_init: Optional initializer for weights.
+            b_init: Optional initializer for bias.
+            name: Name of the layer.
+        """
+        super().__init__(
+            output_size=output_size,
+            with_bias=with_bias,
+            w_init=w_init,
+            b_init=b_init,
+            name=name,
+        )
+        self._adapter_config = adapter_config
+
+    def __call__(self, inputs: jnp.ndarray, *, precision: Any = None) -> jnp.ndarray:
+        outputs = super().__call__(inputs, precision=precision)
+
+        if self._adapter_config.adapter_type == "lora":
+            rank = self._adapter_config.rank
+            # lora_b is initialized at zero so that the adapted layer matches the
+            # pretrained one at the beginning of the fine-tuning
+            lora_a = hk.get_parameter(
+                "lora_a",
+                [inputs.shape[-1], rank],
+                dtype=inputs.dtype,
+                init=initializers.VarianceScaling(1.0, "fan_in", "uniform"),
+            )
+            lora_b = hk.get_parameter(
+                "lora_b", [rank, self.output_size], dtype=inputs.dtype, init=jnp.zeros
+            )
+            scaling = self._adapter_config.alpha / rank
+            outputs = outputs + scaling * jnp.dot(
+                jnp.dot(inputs, lora_a, precision=precision),
+                lora_b,
+                precision=precision,
+            )
+        else:
+            ia3_scale = hk.get_parameter(
+                "ia3_scale", [self.output_size], dtype=inputs.dtype, init=jnp.ones
+            )
+            outputs = outputs * ia3_scale
+
+        return outputs
+
+
+def build_linear(
+    output_size: int,
+    name: Optional[str],
+    adapter_config: Optional[AdapterConfig] = None,
+    with_bias: bool = True,
+    w_init: Optional[hk.initializers.Initializer] = None,
+    b_init: Optional[hk.initializers.Initializer] = None,
+) -> hk.Linear:
+    """
+    Creates a linear layer, adapted if its name is targeted by the adapter config.
+
+    Args:
+        output_size: Output dimensionality.
+        name: Name of the layer.
+        adapter_config: Optional adapter configuration. If None, a plain linear layer
+            is returned.
+        with_bias: Whether to add a bias to the output.
+        w_init: Optional initializer for weights.
+        b_init: Optional initializer for bias.
+
+    Returns:
+        The linear layer.
+    """
+    if adapter_config is not None and name in adapter_config.target_modules:
+        return AdaptedLinear(
+            output_size=output_size,
+            adapter_config=adapter_config,
+            with_bias=with_bias,
+            w_init=w_init,
+            b_init=b_init,
+            name=name,
+        )
+    return hk.Linear(
+        output_size, with_bias=with_bias, w_init=w_init, b_init=b_init, name=name
+    )
+
+
 class RotaryEmbedding(hk.Module):
     """
     Rotary Positional Embedding inspired by RoFormer:
@@ -183,6 +321,7 @@ class MultiHeadAttention(hk.MultiHeadAttention):
         add_bias_kv: bool = False,
         value_size: Optional[int] = None,
         model_size: Optional[int] = None,
+        adapter_config: Optional[AdapterConfig] = None,
         name: Optional[str] = None,
     ):
         """
@@ -200,6 +339,8 @@ class MultiHeadAttention(hk.MultiHeadAttention):
                 to the key size.
             model_size: Optional size of the output embedding. If None, defaults
                 to the key size multiplied by the number of heads.
+            adapter_config: Optional configuration of the adapters injected in the
+                query, key, value and output projections.
             name: Optional name for this module.
         """
         w_init = hk.initializers.VarianceScaling(2.0, "fan_in", "uniform")
@@ -223,6 +364,7 @@ class MultiHeadAttention(hk.MultiHeadAttention):
             self._bias_k = None
             self._bias_v = None
         self._rotary_embedding_config = rotary_embedding_config
+        self._adapter_config = adapter_config
 
     @hk.transparent
     def attention_weights(
@@ -337,8 +479,12 @@ class MultiHeadAttention(hk.MultiHeadAttention):
 
         # Concatenate attention matrix of all heads into a single vector.
         attention_vec = jnp.reshape(attention, (*attention.shape[:-2], -1))
-        return hk.Linear(
-            self.model_size, w_init=w_init, b_init=b_init, name="mha_output"
+        return build_linear(
+            self.model_size,
+            name="mha_output",
+            adapter_config=self._adapter_config,
+            w_init=w_init,
+            b_init=b_init,
         )(attention_vec)
 
     def __call__(
@@ -393,8 +539,12 @@ class MultiHeadAttention(hk.MultiHeadAttention):
         w_init = initializers.VarianceScaling(2.0, "fan_in", "uniform")
         b_init = initializers.VarianceScaling(2.0, "fan_in", "uniform")
 
-        y = hk.Linear(
-            self.num_heads * head_size, w_init=w_init, b_init=b_init, name=name
+        y = build_linear(
+            self.num_heads * head_size,
+            name=name,
+            adapter_config=self._adapter_config,
+            w_init=w_init,
+            b_init=b_init,
         )(x)
         return y.reshape((*x.shape[:-1], self.num_heads, head_size))
 
@@ -417,6 +567,7 @@ class SelfAttentionBlock(hk.Module):
         use_glu_in_ffn: bool = False,
         layer_norm_eps: float = 1e-5,  # this is the default haiku value
         pre_layer_norm: bool = True,
+        adapter_config: Optional[AdapterConfig] = None,
         name: Optional[str] = None,
     ):
         super().__init__(name=name)
@@ -444,8 +595,18 @@ class SelfAttentionBlock(hk.Module):
             # we multiply by 2 here as the output will be split in 2 for GLU
             ffn_embed_dim = int(2 * ffn_embed_dim)
 
-        self.fc1 = hk.Linear(ffn_embed_dim, name="fc1", with_bias=add_bias_fnn)
-        self.fc2 = hk.Linear(embed_dim, name="fc2", with_bias=add_bias_fnn)
+        self.fc1 = build_linear(
+            ffn_embed_dim,
+            name="fc1",
+            adapter_config=adapter_config,
+            with_bias=add_bias_fnn,
+        )
+        self.fc2 = build_linear(
+            embed_dim,
+            name="fc2",
+            adapter_config=adapter_config,
+            with_bias=add_bias_fnn,
+        )
 
         self.layer_norm_self_attention = hk.LayerNorm(
             axis=-1,
@@ -467,6 +628,7 @@ class SelfAttentionBlock(hk.Module):
             model_size=embed_dim,
             add_bias_kv=add_bias_kv,
             rotary_embedding_config=rotary_embedding_config,
+            adapter_config=adapter_config,
             name="self_attention",
         )
 
@@ -601,10 +763,31 @@ class RobertaLMHead(hk.Module):
             axis=-1, create_scale=True, create_offset=True, name="lm_head_layer_norm"
         )
 
-    def __call__(self, x: jnp.ndarray) -> Dict[str, jnp.ndarray]:
+    def __call__(
+        self, x: jnp.ndarray, positions: Optional[jnp.ndarray] = None
+    ) -> Dict[str, jnp.ndarray]:
+        """
+        Computes the final embeddings and the logits.
+
+        Args:
+            x: Embeddings of shape (batch_size, seq_len, embed_dim).
+            positions: Optional positions of shape (batch_size, num_positions) at
+                which the logits are computed. If None, logits are computed at every
+                position.
+
+        Returns:
+            Dictionary containing the embeddings of shape (batch_size, seq_len,
+            embed_dim) and the logits of shape (batch_size, seq_len, alphabet_size),
+            or (batch_size, num_positions, alphabet_size) if positions are given.
+        """
         x = self._first_layer_norm(x)
         # Embeddings are computed after the first layer norm to be consistent with ESM
         embeddings = x
+
+        if positions is not None:
+            # Only the gathered positions are projected to the vocabulary
+            x = jnp.take_along_axis(x, positions[:, :, None], axis=1)
+
         x = self._fc1(x)
         x = jax.nn.gelu(x, approximate=False)
         x = self._second_layer_norm(x)
@@ -17,10 +17,14 @@ from dataclasses import dataclass, field, replace
 from typing import Callable, Dict, List, Optional, Tuple
 
 import haiku as hk
+import jax
 import jax.numpy as jnp
 import jmp
+import numpy as np
 
 from nucleotide_transformer.layers import (
+    SUPPORTED_ADAPTERS,
+    AdapterConfig,
     ESMLearnedPositionalEmbeddings,
     RobertaLMHead,
     RotaryEmbeddingConfig,
@@ -87,6 +91,14 @@ class NucleotideTransformerConfig:
         use_rotary_embedding: Whether to use rotary embeddings (for ESM2). Requires:
             positional_embeddings = None.
         rescaling_factor: Scaling factor to use for rotary embeddings.
+        adapter_type: Optional parameter-efficient fine-tuning adapter injected in the
+            linear layers of the attention blocks, either "lora" or "ia3". If None,
+            no adapter is used.
+        adapter_rank: Rank of the LoRA adapters.
+        adapter_alpha: Scaling of the LoRA adapters (the update is multiplied by
+            adapter_alpha / adapter_rank).
+        adapter_target_modules: Names of the linear layers to adapt, among "query",
+            "key", "value", "mha_output", "fc1" and "fc2".
     """
 
     alphabet_size: int
@@ -118,6 +130,19 @@ class NucleotideTransformerConfig:
     masking_ratio: float = 0.1
     masking_prob: float = 0.8
 
+    # parameter-efficient fine-tuning
+    adapter_type: Optional[str] = None
+    adapter_rank: int = 8
+    adapter_alpha: float = 16.0
+    adapter_target_modules: Tuple[str, ...] = (
+        "query",
+        "key",
+        "value",
+        "mha_output",
+        "fc1",
+        "fc2",
+    )
+
     # logging
     use_gradient_checkpointing: bool = False
 
@@ -139,6 +164,15 @@ class NucleotideTransformerConfig:
                 )
             self.key_size = self.embed_dim // self.attention_heads
 
+        if (
+            self.adapter_type is not None
+            and self.adapter_type not in SUPPORTED_ADAPTERS
+        ):
+            raise ValueError(
+                f"Adapter {self.adapter_type} not supported. Supported adapters are "
+                f"{SUPPORTED_ADAPTERS}."
+            )
+
 
 class NucleotideTransformer(hk.Module):
     """
@@ -189,6 +223,16 @@ class NucleotideTransformer(hk.Module):
         else:
             self._rotary_embedding_config = None  # type: ignore
 
+        if config.adapter_type is not None:
+            self._adapter_config = AdapterConfig(
+                adapter_type=config.adapter_type,
+                rank=config.adapter_rank,
+                alpha=config.adapter_alpha,
+                target_modules=config.adapter_target_modules,
+            )
+        else:
+            self._adapter_config = None  # type: ignore
+
         # Process attention maps to save requirement into more suitable format
         attention_maps_to_save = config.attention_maps_to_save
         self._attention_layers_to_save = list({t[0] for t in attention_maps_to_save})
@@ -274,6 +318,7 @@ class NucleotideTransformer(hk.Module):
             rotary_embedding_config=self._rotary_embedding_config,
             layer_norm_eps=self._config.layer_norm_eps,
             pre_layer_norm=self._config.pre_layer_norm,
+            adapter_config=self._adapter_config,
             name=f"attention_layer_{layer_idx}",
         )
 
@@ -281,6 +326,7 @@ class NucleotideTransformer(hk.Module):
         self,
         tokens: Tokens,
         attention_mask: Optional[AttentionMask] = None,
+        masked_positions: Optional[jnp.ndarray] = None,
     ) -> TransformerOutput:
         """
         Computes the embeddings based on the input tokens.
@@ -290,6 +336,11 @@ class NucleotideTransformer(hk.Module):
             attention_mask: Attention mask of shape (batch_size, 1, seq_len, seq_len).
                 If no mask is provided, a mask by default which equals 1 over all non
                 pad tokens and 0 over pad tokens is computed.
+            masked_positions: Optional positions of shape (batch_size, num_positions)
+                at which the LM head is applied, e.g. the masked tokens during MLM
+                training or scoring. The logits are then of shape (batch_size,
+                num_positions, alphabet_size), which saves the projection of all the
+                other tokens to the vocabulary.
 
         Returns:
             Dictionary containing the final embeddings and logits.
@@ -346,8 +397,12 @@ class NucleotideTransformer(hk.Module):
         )
 
         # Language Model Head
-        lm_head_outs = self._lm_head(x)
+        lm_head_outs = self._lm_head(x, positions=masked_positions)
         sequence_mask = attention_mask[:, 0, :, 0][:, :, None]
+        if masked_positions is not None:
+            sequence_mask = jnp.take_along_axis(
+                sequence_mask, masked_positions[:, :, None], axis=1
+            )
         outs["logits"] = jnp.where(sequence_mask, lm_head_outs["logits"], 0)
 
         embeddings = lm_head_outs["embeddings"]
@@ -358,12 +413,76 @@ class NucleotideTransformer(hk.Module):
         return outs  # type: ignore
 
 
+def compute_nucleotide_embeddings(
+    embeddings: Embedding,
+    tokens: Tokens,
+    nucleotide_lengths: jnp.ndarray,
+    bin_size: Optional[int] = None,
+) -> Tuple[Embedding, jnp.ndarray]:
+    """
+    Maps token embeddings to nucleotide resolution: each nucleotide gets the
+    embedding of the token covering it. Tokens of any length are supported, e.g.
+    the single nucleotides and N tokens ending a sequence tokenized in 6-mers.
+
+    Args:
+        embeddings: Token embeddings of shape (batch_size, seq_len, embed_dim).
+        tokens: Token ids of shape (batch_size, seq_len).
+        nucleotide_lengths: Number of nucleotides of each token id, see
+            StandardTokenizer.compute_nucleotide_lengths.
+        bin_size: If given, the nucleotide embeddings are averaged over bins of
+            bin_size nucleotides.
+
+    Returns:
+        Embeddings of shape (batch_size, num_positions, embed_dim), with
+        num_positions = seq_len * max(nucleotide_lengths), or
+        ceil(num_positions / bin_size) with binning.
+        Mask of shape (batch_size, num_positions), True at the nucleotides (or bins)
+        of the sequences.
+    """
+    num_positions = tokens.shape[1] * int(np.max(nucleotide_lengths))
+    nucleotide_lengths = jnp.asarray(nucleotide_lengths)
+    ends = jnp.cumsum(nucleotide_lengths[tokens], axis=-1)
+    positions = jnp.arange(num_positions)
+    # Index of the token covering each nucleotide
+    token_indices = jax.vmap(
+        lambda row_ends: jnp.searchsorted(row_ends, positions, side="right")
+    )(ends)
+    token_indices = jnp.minimum(token_indices, tokens.shape[1] - 1)
+    mask = positions[None] < ends[:, -1:]
+    nucleotide_embeddings = jnp.take_along_axis(
+        embeddings, token_indices[:, :, None], axis=1
+    ) * mask[:, :, None].astype(embeddings.dtype)
+
+    if bin_size is None:
+        return nucleotide_embeddings, mask
+
+    pad_length = -num_positions % bin_size
+    nucleotide_embeddings = jnp.pad(
+        nucleotide_embeddings, ((0, 0), (0, pad_length), (0, 0))
+    )
+    mask = jnp.pad(mask, ((0, 0), (0, pad_length)))
+    batch_size, embed_dim = embeddings.shape[0], embeddings.shape[-1]
+    num_bins = (num_positions + pad_length) // bin_size
+    binned_sum = jnp.sum(
+        jnp.reshape(
+            nucleotide_embeddings.astype(jnp.float32),
+            (batch_size, num_bins, bin_size, embed_dim),
+        ),
+        axis=2,
+    )
+    binned_count = jnp.sum(jnp.reshape(mask, (batch_size, num_bins, bin_size)), -1)
+    binned_embeddings = binned_sum / jnp.maximum(binned_count, 1)[:, :, None]
+    return binned_embeddings.astype(embeddings.dtype), binned_count > 0
+
+
 def build_nucleotide_transformer_fn(
     model_config: NucleotideTransformerConfig,
     compute_dtype: jnp.dtype = jnp.float32,
     param_dtype: jnp.dtype = jnp.float32,
     output_dtype: jnp.dtype = jnp.float32,
     model_name: Optional[str] = None,
+    nucleotide_lengths: Optional[np.ndarray] = None,
+    nucleotide_bin_size: Optional[int] = None,
 ) -> Callable:
     """
     Creates the model's forward pass.
@@ -381,6 +500,12 @@ def build_nucleotide_transformer_fn(
         output_dtype: the output type of the model. it determines the float precioson
             of the gradient when training the model.
         model_name: Model's name.
+        nucleotide_lengths: Optional number of nucleotides of each token id, see
+            StandardTokenizer.compute_nucleotide_lengths. If given, the outputs
+            also contain "nucleotide_embeddings_{layer}" for every saved layer and
+            "nucleotide_mask", computed in-graph by compute_nucleotide_embeddings.
+        nucleotide_bin_size: Optional bin size, in nucleotides, over which the
+            nucleotide embeddings are averaged. Only used with nucleotide_lengths.
 
     Returns:
         Nucleotide Transformer model forward function.
@@ -398,7 +523,9 @@ def build_nucleotide_transformer_fn(
     hk.mixed_precision.set_policy(hk.LayerNorm, norm_policy)
 
     def nucleotide_transformer_fn(
-        tokens: Tokens, attention_mask: Optional[AttentionMask] = None
+        tokens: Tokens,
+        attention_mask: Optional[AttentionMask] = None,
+        masked_positions: Optional[jnp.ndarray] = None,
     ) -> TransformerOutput:
         """Forward pass."""
         # Run the encoder over the inputs.
@@ -406,7 +533,20 @@ def build_nucleotide_transformer_fn(
         outs = encoder(
             tokens=tokens,
             attention_mask=attention_mask,
+            masked_positions=masked_positions,
         )
+
+        if nucleotide_lengths is not None:
+            for layer in model_config.embeddings_layers_to_save:
+                (
+                    outs[f"nucleotide_embeddings_{layer}"],
+                    outs["nucleotide_mask"],
+                ) = compute_nucleotide_embeddings(
+                    outs[f"embeddings_{layer}"],
+                    tokens,
+                    nucleotide_lengths,
+                    bin_size=nucleotide_bin_size,
+                )
         return outs
 
     return nucleotide_transformer_fn
@@ -457,16 +597,19 @@ def build_nucleotide_transformer_with_head_fn(
 
     Example of the function being used with a classification head:
         The classification head is wrapped inside head_fn because
-        haiku modules cannot be instantiated outside hk.transform.
+        haiku modules cannot be instantiated outside hk.transform. IA³ rescaling
+        (or LoRA) is enabled through the adapter fields of the config, see
+        nucleotide_transformer.adapters to freeze the pretrained parameters.
         def head_fn():
             return SimpleClassificationHead(num_classes=num_classes)
-        finetune_forward_fn = build_esm_ia3_rescaling_with_head_fn(
+        config = replace(config, adapter_type="ia3")
+        finetune_forward_fn = build_nucleotide_transformer_with_head_fn(
             model_config=config, head_fn=head_fn, model_name=model_name,
         )
         finetune_forward_fn = hk.transform(finetune_forward_fn)
 
     Returns:
-        ESM model forward function with IA³ rescaling and indicated head.
+        Nucleotide Transformer model forward function with the indicated head.
     """
     # Adding final layer embedding if missing to be used as classification head input.
     num_layers = model_config.num_layers
@@ -506,7 +649,7 @@ def build_nucleotide_transformer_with_head_fn(
         head = head_fn()
 
         if sequence_mask is None:
-            sequence_mask = jnp.ones_like(tokens)
+            sequence_mask = tokens != model_config.pad_token_id
 
         head_outs = head(  # type: ignore[call-arg]
             x=embeddings, sequence_mask=sequence_mask
@@ -0,0 +1,266 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-silico saturation mutagenesis working directly on token ids."""
+from typing import Callable, Iterator, Optional, Sequence, Tuple
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from nucleotide_transformer.constants import NUCLEOTIDES
+from nucleotide_transformer.tokenizers import StandardTokenizer
+
+SUPPORTED_MUTAGENESIS_SCORES = ["embedding_distance", "logits_delta"]
+
+
+def compute_substitution_table(tokenizer: StandardTokenizer) -> np.ndarray:
+    """
+    Computes, for every token of the vocabulary, the id of the token obtained when
+    substituting one of its nucleotides.
+
+    Args:
+        tokenizer: Nucleotides tokenizer.
+
+    Returns:
+        Table of shape (vocabulary_size, max_token_length, 4) where
+        table[token_id, offset, i] is the id of the token with the nucleotide at
+        offset replaced by NUCLEOTIDES[i], or -1 if the token cannot be mutated
+        there (special tokens, N, offset past the token length).
+    """
+    max_token_length = max(len(token) for token in tokenizer.standard_tokens)
+    table = -np.ones(
+        (tokenizer.vocabulary_size, max_token_length, len(NUCLEOTIDES)), dtype=np.int32
+    )
+    for token in tokenizer.standard_tokens:
+        if not set(token) <= set(NUCLEOTIDES):
+            continue
+        token_id = tokenizer.token_to_id(token)
+        for offset in range(len(token)):
+            for i, nucleotide in enumerate(NUCLEOTIDES):
+                mutated_token = token[:offset] + nucleotide + token[offset + 1 :]
+                table[token_id, offset, i] = tokenizer.token_to_id(mutated_token)
+    return table
+
+
+def map_nucleotides_to_tokens(
+    tokens: Sequence[str], tokenizer: StandardTokenizer
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Locates every nucleotide of a tokenized sequence.
+
+    Args:
+        tokens: Tokens of the sequence, as returned by the tokenizer.
+        tokenizer: Tokenizer used to tokenize the sequence.
+
+    Returns:
+        Index of the token covering each nucleotide, of shape (num_nucleotides,).
+        Offset of each nucleotide within its token, of shape (num_nucleotides,).
+    """
+    token_indices, offsets = [], []
+    special_tokens = set(tokenizer.special_tokens)
+    for token_index, token in enumerate(tokens):
+        if token in special_tokens:
+            continue
+        token_indices.extend([token_index] * len(token))
+        offsets.extend(range(len(token)))
+    return np.asarray(token_indices, dtype=np.int32), np.asarray(offsets, np.int32)
+
+
+def generate_mutated_tokens(
+    tokens_ids: np.ndarray,
+    token_indices: np.ndarray,
+    offsets: np.ndarray,
+    substitution_table: np.ndarray,
+    positions: np.ndarray,
+    batch_size: int,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]:
+    """
+    Generates batches of single-nucleotide mutants of a sequence. Only the id of the
+    token covering the mutated nucleotide is changed, the sequence is never
+    re-tokenized.
+
+    Args:
+        tokens_ids: Token ids of the reference sequence, of shape (seq_len,).
+        token_indices: Index of the token covering each nucleotide.
+        offsets: Offset of each nucleotide within its token.
+        substitution_table: Table returned by compute_substitution_table.
+        positions: Nucleotide positions to mutate.
+        batch_size: Number of mutants per batch.
+
+    Yields:
+        Token ids of the mutants, of shape (batch_size, seq_len). The last batch is
+            completed with the reference sequence to keep a static shape.
+        Mutated nucleotide positions of the valid rows.
+        Index in NUCLEOTIDES of the alternative nucleotides of the valid rows.
+        Number of valid rows in the batch.
+    """
+    mutated_ids = substitution_table[
+        tokens_ids[token_indices[positions]], offsets[positions]
+    ]
+    reference_ids = tokens_ids[token_indices[positions]]
+
+    # All (position, alternative) pairs that change the token
+    valid = (mutated_ids >= 0) & (mutated_ids != reference_ids[:, None])
+    mutant_rows, alternatives = np.nonzero(valid)
+    mutant_positions = positions[mutant_rows]
+    mutant_ids = mutated_ids[mutant_rows, alternatives]
+    mutant_token_indices = token_indices[mutant_positions]
+
+    for start in range(0, len(mutant_rows), batch_size):
+        end = min(start + batch_size, len(mutant_rows))
+        num_valid = end - start
+        batch = np.repeat(tokens_ids[None], batch_size, axis=0)
+        batch[np.arange(num_valid), mutant_token_indices[start:end]] = mutant_ids[
+            start:end
+        ]
+        yield batch, mutant_positions[start:end], alternatives[start:end], num_valid
+
+
+def build_pooled_outputs_fn(
+    apply_fn: Callable, output_key: str, pad_token_id: int
+) -> Callable:
+    """
+    Creates a jitted function returning the model outputs pooled over the sequence,
+    so that only small arrays are transferred back to the host.
+
+    Args:
+        apply_fn: Apply function of the transformed model.
+        output_key: Output to pool, e.g. "embeddings_24" or "logits".
+        pad_token_id: Id of the pad token, excluded from the pooling of per-token
+            outputs.
+
+    Returns:
+        Function mapping (params, random_key, tokens) to the pooled outputs of shape
+        (batch_size, ...). Per-token outputs (batch_size, seq_len, ...) are averaged
+        over the non-pad tokens, other outputs with more than two dimensions are
+        averaged over their second axis.
+    """
+
+    def pooled_outputs_fn(
+        params: hk.Params, random_key: jnp.ndarray, tokens: jnp.ndarray
+    ) -> jnp.ndarray:
+        outputs = apply_fn(params, random_key, tokens)[output_key]
+        outputs = outputs.astype(jnp.float32)
+        if outputs.ndim <= 2:
+            return outputs
+        if outputs.shape[1] == tokens.shape[1]:
+            mask = (tokens != pad_token_id).astype(outputs.dtype)
+            mask = jnp.reshape(mask, mask.shape + (1,) * (outputs.ndim - 2))
+            return jnp.sum(outputs * mask, axis=1) / jnp.sum(mask, axis=1)
+        return jnp.mean(outputs, axis=1)
+
+    return jax.jit(pooled_outputs_fn)
+
+
+def in_silico_mutagenesis(
+    apply_fn: Callable,
+    params: hk.Params,
+    tokenizer: StandardTokenizer,
+    sequence: str,
+    output_key: str,
+    score: str = "embedding_distance",
+    positions: Optional[Sequence[int]] = None,
+    batch_size: int = 32,
+    random_key: Optional[jnp.ndarray] = None,
+) -> np.ndarray:
+    """
+    Scores every single-nucleotide substitution of a sequence. The mutants are built
+    at the token id level and streamed through the jitted model in batches of
+    batch_size, so memory stays bounded whatever the sequence length.
+
+    Args:
+        apply_fn: Apply function of the transformed model.
+        params: Model parameters.
+        tokenizer: Tokenizer of the model.
+        sequence: Reference nucleotide sequence.
+        output_key: Model output used to compute the effects, e.g. "embeddings_24"
+            for embedding distances or "logits" for a classification head.
+        score: Either "embedding_distance" (euclidean distance between the
+            mean-pooled outputs of the mutant and of the reference) or
+            "logits_delta" (pooled outputs of the mutant minus the reference ones).
+        positions: Nucleotide positions to mutate. Defaults to all of them.
+        batch_size: Number of mutants per forward pass.
+        random_key: Random key passed to apply_fn.
+
+    Returns:
+        Effect scores of shape (num_nucleotides, 4) for "embedding_distance" and
+        (num_nucleotides, 4, ...) for "logits_delta", where the second axis follows
+        NUCLEOTIDES. Scores of reference nucleotides, of positions that were not
+        scanned and of nucleotides that cannot be substituted (e.g. N) are NaN.
+
+    Example:
+        parameters, forward_fn, tokenizer, config = get_pretrained_model(
+            model_name="500M_multi_species_v2", embeddings_layers_to_save=(24,),
+        )
+        forward_fn = hk.transform(forward_fn)
+        scores = in_silico_mutagenesis(
+            forward_fn.apply, parameters, tokenizer, sequence,
+            output_key="embeddings_24",
+        )
+    """
+    if score not in SUPPORTED_MUTAGENESIS_SCORES:
+        raise ValueError(
+            f"Score {score} not supported. Supported scores are "
+            f"{SUPPORTED_MUTAGENESIS_SCORES}."
+        )
+
+    tokens, tokens_ids = tokenizer.batch_tokenize([sequence])[0]
+    tokens_ids = np.asarray(tokens_ids, dtype=np.int32)
+    token_indices, offsets = map_nucleotides_to_tokens(tokens, tokenizer)
+    substitution_table = compute_substitution_table(tokenizer)
+
+    num_nucleotides = len(token_indices)
+    if positions is None:
+        positions = np.arange(num_nucleotides)
+    positions = np.asarray(positions, dtype=np.int32)
+    if np.any((positions < 0) | (positions >= num_nucleotides)):
+        raise ValueError(
+            f"Positions to mutate should be in [0, {num_nucleotides}), the length of "
+            f"the sequence."
+        )
+
+    pooled_outputs_fn = build_pooled_outputs_fn(
+        apply_fn, output_key=output_key, pad_token_id=tokenizer.pad_token_id
+    )
+    reference_batch = np.repeat(tokens_ids[None], batch_size, axis=0)
+    reference_outputs = np.asarray(
+        pooled_outputs_fn(params, random_key, reference_batch)[0]
+    )
+
+    if score == "embedding_distance":
+        scores = np.full((num_nucleotides, len(NUCLEOTIDES)), np.nan, np.float32)
+    else:
+        scores = np.full(
+            (num_nucleotides, len(NUCLEOTIDES)) + reference_outputs.shape,
+            np.nan,
+            np.float32,
+        )
+
+    for batch, mutant_positions, alternatives, num_valid in generate_mutated_tokens(
+        tokens_ids=tokens_ids,
+        token_indices=token_indices,
+        offsets=offsets,
+        substitution_table=substitution_table,
+        positions=positions,
+        batch_size=batch_size,
+    ):
+        outputs = np.asarray(pooled_outputs_fn(params, random_key, batch))
+        deltas = outputs[:num_valid] - reference_outputs[None]
+        if score == "embedding_distance":
+            deltas = np.linalg.norm(deltas.reshape(num_valid, -1), axis=-1)
+        scores[mutant_positions, alternatives] = deltas
+
+    return scores
@@ -12,18 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import fcntl
+import hashlib
 import json
 import os
-from typing import Any, Callable, Dict, Optional, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
-import boto3
 import haiku as hk
 import jax.numpy as jnp
-import joblib
-import tqdm
-from botocore import UNSIGNED
-from botocore.config import Config
+import numpy as np
 
+from nucleotide_transformer.checkpoints import (
+    load_memmap_checkpoint,
+    save_memmap_checkpoint,
+)
 from nucleotide_transformer.heads import UNetHead
 from nucleotide_transformer.model import (
     NucleotideTransformerConfig,
@@ -35,15 +51,29 @@ from nucleotide_transformer.tokenizers import (
     FixedSizeNucleotidesKmersTokenizer,
     compute_tokens_to_ids_v2,
 )
+from nucleotide_transformer.utils import write_atomically
+
+# boto3, botocore, joblib and tqdm are imported when a checkpoint is downloaded or
+# loaded, to keep importing this module fast
+if TYPE_CHECKING:
+    import boto3
 
 ENV_XDG_CACHE_HOME = "XDG_CACHE_HOME"
+# Overrides the cache directory, e.g. with a directory on a cluster filesystem
+ENV_NT_CACHE_DIR = "NUCLEOTIDE_TRANSFORMER_CACHE_DIR"
+# If set to 1, the cache directory is only read: nothing is downloaded, converted or
+# locked, the checkpoints must have been downloaded beforehand
+ENV_NT_CACHE_READ_ONLY = "NUCLEOTIDE_TRANSFORMER_CACHE_READ_ONLY"
 DEFAULT_CACHE_DIR = "~/.cache"
+_IO_BLOCK_SIZE = 2**20
 
 
 def _get_dir() -> str:
     """
     Get directory to save files on user machine.
     """
+    if os.getenv(ENV_NT_CACHE_DIR):
+        return os.path.expanduser(os.environ[ENV_NT_CACHE_DIR])
     return os.path.expanduser(
         os.path.join(
             os.getenv(ENV_XDG_CACHE_HOME, DEFAULT_CACHE_DIR), "nucleotide_transformer"
@@ -51,124 +81,367 @@ def _get_dir() -> str:
     )
 
 
+def _is_cache_read_only() -> bool:
+    return os.getenv(ENV_NT_CACHE_READ_ONLY, "0").lower() in ("1", "true", "yes")
+
+
+@contextlib.contextmanager
+def _file_lock(filename: str) -> Iterator[None]:
+    """
+    Exclusive lock shared between the processes of a node, held while the context
+    is open.
+    """
+    with open(filename, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _hash_file(filename: str) -> Tuple[str, str]:
+    """
+    Computes the MD5 and SHA256 digests of a file in a single pass.
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(_IO_BLOCK_SIZE), b""):
+            md5.update(block)
+            sha256.update(block)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def verify_sha256(filename: str) -> None:
+    """
+    Checks a downloaded file against the SHA256 digest recorded next to it by
+    download_from_s3_bucket. Files without a recorded digest are not checked.
+
+    Args:
+        filename: Path of the file.
+    """
+    checksum_filename = f"{filename}.sha256"
+    if not os.path.exists(checksum_filename):
+        return
+    with open(checksum_filename) as f:
+        expected_sha256 = f.read().strip()
+    _, sha256 = _hash_file(filename)
+    if sha256 != expected_sha256:
+        raise ValueError(
+            f"File {filename} is corrupted: its SHA256 is {sha256} while "
+            f"{expected_sha256} was recorded after its download. Delete it to "
+            "download it again."
+        )
+
+
 def download_from_s3_bucket(
-    s3_client: boto3.session.Session,
+    s3_client: "boto3.session.Session",
     bucket: str,
     key: str,
     filename: str,
     verbose: bool = True,
+    chunk_size: int = 64 * 2**20,
+    num_workers: int = 8,
 ) -> None:
     """
     Download data from the s3 bucket and display downloading progression bar.
 
+    The object is downloaded by chunks, with parallel ranged requests, into a
+    `.partial` file. The chunks already downloaded are recorded in a
+    `.partial.json` sidecar, so that an interrupted download resumes where it
+    stopped. A chunk is recorded only once all of its bytes are received. Once
+    complete, the size of the file and its MD5 (when the ETag is one, i.e. for
+    objects not uploaded in parts) are checked, its SHA256 is recorded in a
+    `.sha256` sidecar and the file is atomically renamed to filename: filename
+    never holds a partial download.
+
     Args:
         s3_client: Boto3 s3 client
         bucket: Bucket name.
         key: Path towards file in the bucket.
         filename: Path to save file locally.
         verbose: Whether or not to print the progress bar during the download.
+        chunk_size: Size in bytes of the ranged requests.
+        num_workers: Number of chunks downloaded in parallel.
     """
-    kwargs = {
-        "Bucket": bucket,
-        "Key": key,
-    }
-    object_size = s3_client.head_object(**kwargs)["ContentLength"]
-
-    if verbose:
-        with tqdm.tqdm(
-            total=object_size, unit="B", unit_scale=True, desc=filename
-        ) as pbar:
-            with open(filename, "wb") as f:
-                s3_client.download_fileobj(
-                    Bucket=bucket,
-                    Key=key,
-                    ExtraArgs=None,
-                    Fileobj=f,
-                    Callback=lambda bytes_transferred: pbar.update(bytes_transferred),
-                )
-    else:
-        with open(filename, "wb") as f:
-            s3_client.download_fileobj(
-                Bucket=bucket,
-                Key=key,
-                ExtraArgs=None,
-                Fileobj=f,
+    import tqdm
+
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    object_size = head["ContentLength"]
+    etag = head.get("ETag", "").strip('"')
+
+    partial_filename = f"{filename}.partial"
+    progress_filename = f"{filename}.partial.json"
+    num_chunks = -(-object_size // chunk_size)
+
+    # Resumes only if the remote object and the chunking did not change
+    completed_chunks: Set[int] = set()
+    if os.path.exists(partial_filename) and os.path.exists(progress_filename):
+        with open(progress_filename) as f:
+            progress = json.load(f)
+        if (
+            progress["size"] == object_size
+            and progress["etag"] == etag
+            and progress["chunk_size"] == chunk_size
+        ):
+            completed_chunks = set(progress["completed_chunks"])
+    if not completed_chunks:
+        with open(partial_filename, "wb") as f:
+            f.truncate(object_size)
+
+    lock = threading.Lock()
+
+    def record_progress() -> None:
+        progress = {
+            "size": object_size,
+            "etag": etag,
+            "chunk_size": chunk_size,
+            "completed_chunks": sorted(completed_chunks),
+        }
+        write_atomically(
+            progress_filename, lambda f: f.write(json.dumps(progress).encode())
+        )
+
+    record_progress()
+
+    pbar = tqdm.tqdm(
+        total=object_size,
+        initial=sum(
+            min(chunk_size, object_size - i * chunk_size) for i in completed_chunks
+        ),
+        unit="B",
+        unit_scale=True,
+        desc=filename,
+        disable=not verbose,
+    )
+
+    def download_chunk(chunk_index: int) -> None:
+        start = chunk_index * chunk_size
+        end = min(start + chunk_size, object_size) - 1
+        response = s3_client.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={start}-{end}"
+        )
+        written = 0
+        with open(partial_filename, "r+b") as f:
+            f.seek(start)
+            for block in response["Body"].iter_chunks(_IO_BLOCK_SIZE):
+                f.write(block)
+                written += len(block)
+                pbar.update(len(block))
+        # The partial file is preallocated, so a short response would go unnoticed
+        # by the size check below
+        if written != end - start + 1:
+            raise ValueError(
+                f"Received {written} bytes for the range {start}-{end} of {key} "
+                f"instead of {end - start + 1}."
             )
+        with lock:
+            completed_chunks.add(chunk_index)
+            record_progress()
+
+    with pbar, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        remaining_chunks = [i for i in range(num_chunks) if i not in completed_chunks]
+        # list() re-raises the exceptions of the workers
+        list(executor.map(download_chunk, remaining_chunks))
+
+    # Verifies the download before exposing it
+    downloaded_size = os.path.getsize(partial_filename)
+    if downloaded_size != object_size:
+        raise ValueError(
+            f"Downloaded {downloaded_size} bytes for {key} while the object has "
+            f"{object_size} bytes."
+        )
+    md5, sha256 = _hash_file(partial_filename)
+    # The ETag of an object uploaded in parts is not its MD5 and contains a "-"
+    if etag and "-" not in etag and md5 != etag:
+        os.remove(partial_filename)
+        os.remove(progress_filename)
+        raise ValueError(
+            f"MD5 of the download of {key} is {md5} while its ETag is {etag}. The "
+            "partial download has been deleted, please retry."
+        )
+
+    with open(f"{filename}.sha256", "w") as f:
+        f.write(sha256)
+    os.replace(partial_filename, filename)
+    os.remove(progress_filename)
+
+
+def cast_params(params: hk.Params, param_dtype: jnp.dtype) -> hk.Params:
+    """
+    Casts the floating point parameters to param_dtype, once at load time instead of
+    in every forward pass. The parameters of the normalization layers are kept in
+    float32, as the norm policy of the models computes them in float32.
+
+    Args:
+        params: Model parameters.
+        param_dtype: Type of the parameters.
+
+    Returns:
+        Cast parameters.
+    """
+    param_dtype = jnp.dtype(param_dtype)
+
+    def cast(module_name: str, param: np.ndarray) -> np.ndarray:
+        dtype = jnp.float32 if "norm" in module_name else param_dtype
+        if not jnp.issubdtype(param.dtype, jnp.floating) or param.dtype == dtype:
+            return param
+        return np.asarray(param).astype(dtype)
+
+    return {
+        module_name: {
+            name: cast(module_name, param) for name, param in module_params.items()
+        }
+        for module_name, module_params in params.items()
+    }
+
+
+def _load_hyperparams(model_name: str, verbose: bool = True) -> Dict[str, Any]:
+    """
+    Reads the hyperparameters of a model, downloading the model first if it is not
+    in the cache.
+    """
+    hyperparams_save_dir = os.path.join(_get_dir(), model_name, "hyperparams.json")
+    if not os.path.exists(hyperparams_save_dir):
+        return download_ckpt_and_hyperparams(model_name, verbose)[1]
+    with open(hyperparams_save_dir, "rb") as f:
+        return json.load(f)
 
 
 def download_ckpt_and_hyperparams(
-    model_name: str, verbose: bool = True
+    model_name: str,
+    verbose: bool = True,
+    use_memmap_checkpoint: bool = True,
+    param_dtype: jnp.dtype = jnp.float32,
 ) -> Tuple[hk.Params, Dict[str, Any]]:
     """
     Download checkpoint and hyperparams on kao datacenter.
 
+    The download is protected by a file lock in the cache directory: when several
+    processes load the same model, one downloads it while the others wait, then
+    they all load it. If the environment variable
+    NUCLEOTIDE_TRANSFORMER_CACHE_READ_ONLY is set to 1, the cache directory (which
+    NUCLEOTIDE_TRANSFORMER_CACHE_DIR may point to a shared filesystem) is only read.
+
     Args:
         model_name: Name of the model.
+        verbose: Whether or not to print the progress bar during the downloads.
+        use_memmap_checkpoint: If True, the joblib checkpoint is converted once to
+            the memory-mappable format of nucleotide_transformer.checkpoints, stored
+            alongside it, and the following loads map that file instead of
+            unpickling the joblib one.
+        param_dtype: Type of the returned parameters, see cast_params. With
+            use_memmap_checkpoint, the cast parameters are also stored in the
+            memory-mappable format, so that the cast is done once.
 
     Returns:
         Model parameters.
         Model hyperparameters' dict.
-        verbose: Whether or not to print the progress bar during the downloads.
-
-
     """
     # Get directories
     save_dir = os.path.join(_get_dir(), model_name)
 
     params_save_dir = os.path.join(save_dir, "ckpt.joblib")
+    memmap_params_save_dir = os.path.join(save_dir, "ckpt.npmm")
+    param_dtype = jnp.dtype(param_dtype)
+    cast_params_save_dir = os.path.join(save_dir, f"ckpt.{param_dtype.name}.npmm")
+    use_cast_checkpoint = use_memmap_checkpoint and param_dtype != jnp.float32
     hyperparams_save_dir = os.path.join(save_dir, "hyperparams.json")
 
-    if os.path.exists(hyperparams_save_dir) and os.path.exists(params_save_dir):
-        # Load locally
-        with open(hyperparams_save_dir, "rb") as f:
-            hyperparams = json.load(f)
-
-        with open(params_save_dir, "rb") as f:
-            params = joblib.load(f)
-
-        return params, hyperparams
-
-    else:
+    # Downloads and conversions are renamed into place once complete, so existing
+    # files can be loaded without taking the lock
+    params = None
+    if _is_cache_read_only():
+        if not os.path.exists(hyperparams_save_dir) or not (
+            os.path.exists(memmap_params_save_dir) or os.path.exists(params_save_dir)
+        ):
+            raise FileNotFoundError(
+                f"Checkpoint of {model_name} not found in the read-only cache "
+                f"{save_dir}. Download it beforehand, or unset "
+                f"{ENV_NT_CACHE_READ_ONLY}."
+            )
+    elif not os.path.exists(hyperparams_save_dir) or not os.path.exists(
+        memmap_params_save_dir if use_memmap_checkpoint else params_save_dir
+    ):
         os.makedirs(save_dir, exist_ok=True)
+        with _file_lock(os.path.join(save_dir, ".lock")):
+            # Another process may have completed the download while we waited
+            if not os.path.exists(params_save_dir) or not os.path.exists(
+                hyperparams_save_dir
+            ):
+                import boto3
+                from botocore import UNSIGNED
+                from botocore.config import Config
+
+                s3_endpoint = "https://s3.kao-prod.instadeep.io"
+
+                session = boto3.Session()
+                s3_client = session.client(
+                    service_name="s3",
+                    endpoint_url=s3_endpoint,
+                    config=Config(signature_version=UNSIGNED),
+                )
 
-        s3_endpoint = "https://s3.kao-prod.instadeep.io"
-
-        session = boto3.Session()
-        s3_client = session.client(
-            service_name="s3",
-            endpoint_url=s3_endpoint,
-            config=Config(signature_version=UNSIGNED),
-        )
-
-        # Download params and hyperparams
-        bucket = "nucleotide-transformer"
-        print("Downloading hyperparameters file...")
-        download_from_s3_bucket(
-            s3_client=s3_client,
-            bucket=bucket,
-            key=f"checkpoints/{model_name}/hyperparams.json",
-            filename=hyperparams_save_dir,
-            verbose=verbose,
-        )
-
-        print("Downloading model weights...")
-        download_from_s3_bucket(
-            s3_client=s3_client,
-            bucket=bucket,
-            key=f"checkpoints/{model_name}/ckpt.joblib",
-            filename=params_save_dir,
-            verbose=verbose,
-        )
-        print("Model weights downloaded.")
-
-        # Load locally
-        with open(hyperparams_save_dir, "rb") as f:
-            hyperparams = json.load(f)
-
-        with open(params_save_dir, "rb") as f:
-            params = joblib.load(f)
-
-        return params, hyperparams
+                # Download params and hyperparams
+                bucket = "nucleotide-transformer"
+                if not os.path.exists(hyperparams_save_dir):
+                    print("Downloading hyperparameters file...")
+                    download_from_s3_bucket(
+                        s3_client=s3_client,
+                        bucket=bucket,
+                        key=f"checkpoints/{model_name}/hyperparams.json",
+                        filename=hyperparams_save_dir,
+                        verbose=verbose,
+                    )
+
+                if not os.path.exists(params_save_dir):
+                    print("Downloading model weights...")
+                    download_from_s3_bucket(
+                        s3_client=s3_client,
+                        bucket=bucket,
+                        key=f"checkpoints/{model_name}/ckpt.joblib",
+                        filename=params_save_dir,
+                        verbose=verbose,
+                    )
+                    print("Model weights downloaded.")
+
+            if use_memmap_checkpoint and not os.path.exists(memmap_params_save_dir):
+                import joblib
+
+                verify_sha256(params_save_dir)
+                with open(params_save_dir, "rb") as f:
+                    params = joblib.load(f)
+                save_memmap_checkpoint(params, memmap_params_save_dir)
+
+    # Load locally
+    with open(hyperparams_save_dir, "rb") as f:
+        hyperparams = json.load(f)
+
+    if params is None and use_cast_checkpoint and os.path.exists(cast_params_save_dir):
+        return load_memmap_checkpoint(cast_params_save_dir), hyperparams
+
+    if params is None:
+        if use_memmap_checkpoint and os.path.exists(memmap_params_save_dir):
+            params = load_memmap_checkpoint(memmap_params_save_dir)
+        else:
+            import joblib
+
+            verify_sha256(params_save_dir)
+            with open(params_save_dir, "rb") as f:
+                params = joblib.load(f)
+
+    if param_dtype != jnp.float32:
+        if use_cast_checkpoint and not _is_cache_read_only():
+            # One process casts and writes the checkpoint, the others wait for it
+            with _file_lock(os.path.join(save_dir, ".lock")):
+                if os.path.exists(cast_params_save_dir):
+                    return load_memmap_checkpoint(cast_params_save_dir), hyperparams
+                params = cast_params(params, param_dtype)
+                save_memmap_checkpoint(params, cast_params_save_dir)
+        else:
+            params = cast_params(params, param_dtype)
+
+    return params, hyperparams
 
 
 def rename_modules_dcnuc(parameters: hk.Params, model_name: str) -> hk.Params:
@@ -211,6 +484,7 @@ def get_pretrained_model(
     attention_maps_to_save: Optional[Tuple[Tuple[int, int], ...]] = None,
     max_positions: int = 1024,
     verbose: bool = True,
+    load_parameters: bool = True,
 ) -> Tuple[
     hk.Params, Callable, FixedSizeNucleotidesKmersTokenizer, NucleotideTransformerConfig
 ]:
@@ -228,16 +502,20 @@ def get_pretrained_model(
             during the forward pass anyway. So in inference mode ( not training mode ),
             it is better to use params in fp16 if compute_dtype is fp16 too. During
             training, it is preferable to keep parameters in float32 for better
-            numerical stability.
+            numerical stability. The returned parameters are cast to this type,
+            except the ones of the normalization layers kept in float32.
         output_dtype: the output type of the model. it determines the float precioson
             of the gradient when training the model.
         embeddings_layers_to_save: Intermediate embeddings to return in the output.
         attention_maps_to_save: Intermediate attention maps to return in the output.
         max_positions: Maximum length of a token (for padding).
         verbose: If True, displays a progress bar during the model's weights download.
+        load_parameters: If False, only the hyperparameters are read and the returned
+            parameters are None, e.g. to build another forward function for
+            parameters already loaded.
 
     Returns:
-        Model parameters.
+        Model parameters, or None if load_parameters is False.
         Haiku function to call the model.
         Tokenizer.
         Model config (hyperparameters).
@@ -275,7 +553,12 @@ def get_pretrained_model(
         )
 
     # Download weights and hyperparams
-    parameters, hyperparams = download_ckpt_and_hyperparams(model_name, verbose)
+    if load_parameters:
+        parameters, hyperparams = download_ckpt_and_hyperparams(
+            model_name, verbose, param_dtype=param_dtype
+        )
+    else:
+        parameters, hyperparams = None, _load_hyperparams(model_name, verbose)
 
     if "v2" in model_name:
         tokens_to_ids, _ = compute_tokens_to_ids_v2(k_mers=hyperparams["k_for_kmers"])
@@ -357,7 +640,8 @@ def get_pretrained_model(
 
     # NOTE: module names are changed here, to validate !
     full_model_name = "nucleotide_transformer" + model_name
-    parameters = rename_modules_dcnuc(parameters, full_model_name)
+    if parameters is not None:
+        parameters = rename_modules_dcnuc(parameters, full_model_name)
 
     forward_fn = build_nucleotide_transformer_fn(
         model_config=config,
@@ -390,6 +674,51 @@ def rename_modules_segment_nt(parameters: hk.Params, model_name: str) -> hk.Para
     return parameters
 
 
+def select_segment_nt_features(
+    parameters: hk.Params,
+    head_name: str,
+    features: List[str],
+    features_subset: List[str],
+) -> hk.Params:
+    """
+    Slices the final projection of the Segment-NT head to a subset of its features,
+    so that the head only computes and returns these features. The projection
+    outputs, for each of the 6 nucleotides of a token, each feature and each class,
+    the column (nucleotide * num_features + feature) * 2 + class.
+
+    Args:
+        parameters: Segment-NT parameters.
+        head_name: Name of the UNetHead module.
+        features: Features predicted by the head.
+        features_subset: Features to keep, in the order of the returned logits.
+
+    Returns:
+        Parameters with a sliced head projection.
+    """
+    unknown_features = [f for f in features_subset if f not in features]
+    if unknown_features:
+        raise ValueError(
+            f"Unknown features {unknown_features}. Supported features are "
+            f"{features}."
+        )
+    num_features = len(features)
+    columns = np.asarray(
+        [
+            (nucleotide * num_features + features.index(feature)) * 2 + c
+            for nucleotide in range(6)
+            for feature in features_subset
+            for c in range(2)
+        ]
+    )
+    fc_name = f"{head_name}/~/fc"
+    parameters = dict(parameters)
+    parameters[fc_name] = {
+        "w": np.asarray(parameters[fc_name]["w"])[:, columns],
+        "b": np.asarray(parameters[fc_name]["b"])[columns],
+    }
+    return parameters
+
+
 def get_pretrained_segment_nt_model(
     model_name: str,
     rescaling_factor: Optional[float] = None,
@@ -400,6 +729,8 @@ def get_pretrained_segment_nt_model(
     attention_maps_to_save: Optional[Tuple[Tuple[int, int], ...]] = None,
     max_positions: int = 1024,
     verbose: bool = True,
+    features_subset: Optional[List[str]] = None,
+    load_parameters: bool = True,
 ) -> Tuple[
     hk.Params, Callable, FixedSizeNucleotidesKmersTokenizer, NucleotideTransformerConfig
 ]:
@@ -424,16 +755,25 @@ def get_pretrained_segment_nt_model(
             during the forward pass anyway. So in inference mode ( not training mode ),
             it is better to use params in fp16 if compute_dtype is fp16 too. During
             training, it is preferable to keep parameters in float32 for better
-            numerical stability.
+            numerical stability. The returned parameters are cast to this type,
+            except the ones of the normalization layers kept in float32.
         output_dtype: the output type of the model. it determines the float precioson
             of the gradient when training the model.
         embeddings_layers_to_save: Intermediate embeddings to return in the output.
         attention_maps_to_save: Intermediate attention maps to return in the output.
         max_positions: Maximum length of a token (for padding).
         verbose: If True, displays a progress bar during the model's weights download.
+        features_subset: Features to predict, among the features of the model. The
+            head projection is sliced at load time so that the cost and the output
+            memory of the head scale with the number of requested features. The
+            features of the returned config are the requested ones. If None, all
+            the features are predicted.
+        load_parameters: If False, only the hyperparameters are read and the returned
+            parameters are None, e.g. to build another forward function for
+            parameters already loaded.
 
     Returns:
-        Model parameters.
+        Model parameters, or None if load_parameters is False.
         Haiku function to call the model.
         Tokenizer.
         Model config (hyperparameters).
@@ -463,7 +803,12 @@ def get_pretrained_segment_nt_model(
         )
 
     # Download weights and hyperparams
-    parameters, hyperparams = download_ckpt_and_hyperparams(model_name, verbose)
+    if load_parameters:
+        parameters, hyperparams = download_ckpt_and_hyperparams(
+            model_name, verbose, param_dtype=param_dtype
+        )
+    else:
+        parameters, hyperparams = None, _load_hyperparams(model_name, verbose)
 
     tokens_to_ids, _ = compute_tokens_to_ids_v2(k_mers=hyperparams["k_for_kmers"])
     tokenizer = FixedSizeNucleotidesKmersTokenizer(
@@ -551,7 +896,20 @@ def get_pretrained_segment_nt_model(
 
     # NOTE: module names are changed here, to validate !
     full_model_name = "nucleotide_transformer" + model_name
-    parameters = rename_modules_segment_nt(parameters, full_model_name)
+    if parameters is not None:
+        parameters = rename_modules_segment_nt(parameters, full_model_name)
+
+    if features_subset is not None:
+        if parameters is not None:
+            # The head is the second module named full_model_name
+            parameters = select_segment_nt_features(
+                parameters,
+                head_name=full_model_name + "_1",
+                features=genomic_features,
+                features_subset=features_subset,
+            )
+        genomic_features = list(features_subset)
+        config = replace(config, features=genomic_features)
 
     # get segmentation model
     def head_fn() -> hk.Module:
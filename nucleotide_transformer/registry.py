@@ -0,0 +1,194 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process registry of pretrained models, for services switching between them."""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+
+from nucleotide_transformer.model import NucleotideTransformerConfig
+from nucleotide_transformer.pretrained import (
+    get_pretrained_model,
+    get_pretrained_segment_nt_model,
+)
+from nucleotide_transformer.tokenizers import FixedSizeNucleotidesKmersTokenizer
+
+SEGMENT_NT_MODELS = ["segment_nt", "segment_nt_multi_species"]
+
+
+class LoadedModel(NamedTuple):
+    """A pretrained model ready for inference."""
+
+    parameters: hk.Params
+    apply_fn: Callable
+    tokenizer: FixedSizeNucleotidesKmersTokenizer
+    config: NucleotideTransformerConfig
+
+
+def _params_nbytes(params: hk.Params) -> int:
+    # Counts the device buffers, i.e. each copy of replicated parameters
+    return sum(
+        shard.data.nbytes
+        for x in jax.tree_util.tree_leaves(params)
+        for shard in x.addressable_shards
+    )
+
+
+class ModelRegistry:
+    """
+    Caches the models returned by get_pretrained_model and
+    get_pretrained_segment_nt_model, along with their jitted apply function, per
+    model and dtype policy. The parameters are transferred to the device once, and
+    shared between the entries of the same model, param_dtype and features_subset,
+    e.g. requested with different embeddings to save: these entries are built
+    without reading the checkpoint again. Least recently used models are evicted
+    when the parameters exceed the device memory budget.
+
+    Example:
+        registry = ModelRegistry(max_memory_bytes=8 * 2**30)
+        parameters, apply_fn, tokenizer, config = registry.get(
+            "500M_multi_species_v2", embeddings_layers_to_save=(20,)
+        )
+        outs = apply_fn(parameters, random_key, tokens)
+    """
+
+    def __init__(self, max_memory_bytes: Optional[int] = None):
+        """
+        Args:
+            max_memory_bytes: Maximum number of bytes of device memory taken by the
+                parameters held by the registry. If None, models are never evicted.
+                The model requested last is always kept, even if it exceeds the
+                budget.
+        """
+        self._max_memory_bytes = max_memory_bytes
+        self._models: "OrderedDict[Tuple, LoadedModel]" = OrderedDict()
+        # Parameters shared between models, keyed by (model_name, param_dtype,
+        # features_subset)
+        self._parameters: Dict[Tuple, hk.Params] = {}
+        self._params_keys: Dict[Tuple, Tuple] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(_params_nbytes(params) for params in self._parameters.values())
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def get(
+        self,
+        model_name: str,
+        compute_dtype: jnp.dtype = jnp.float32,
+        param_dtype: jnp.dtype = jnp.float32,
+        output_dtype: jnp.dtype = jnp.float32,
+        embeddings_layers_to_save: Tuple[int, ...] = (),
+        attention_maps_to_save: Optional[Tuple[Tuple[int, int], ...]] = None,
+        max_positions: int = 1024,
+        **kwargs: Any,
+    ) -> LoadedModel:
+        """
+        Returns a pretrained model, loading it on the first request.
+
+        Args:
+            model_name: Name of the model, a Nucleotide Transformer or a Segment-NT
+                model.
+            compute_dtype: See get_pretrained_model.
+            param_dtype: See get_pretrained_model.
+            output_dtype: See get_pretrained_model.
+            embeddings_layers_to_save: See get_pretrained_model.
+            attention_maps_to_save: See get_pretrained_model.
+            max_positions: See get_pretrained_model.
+            **kwargs: Other arguments of the loading function, e.g. the
+                rescaling_factor of get_pretrained_segment_nt_model.
+
+        Returns:
+            Parameters, jitted apply function, tokenizer and config of the model.
+        """
+        key = (
+            model_name,
+            jnp.dtype(compute_dtype).name,
+            jnp.dtype(param_dtype).name,
+            jnp.dtype(output_dtype).name,
+            tuple(embeddings_layers_to_save),
+            tuple(attention_maps_to_save or ()),
+            max_positions,
+            tuple(
+                (name, tuple(value) if isinstance(value, list) else value)
+                for name, value in sorted(kwargs.items())
+            ),
+        )
+        # The head of Segment-NT models is sliced to the requested features
+        params_key = (
+            model_name,
+            jnp.dtype(param_dtype).name,
+            tuple(kwargs.get("features_subset") or ()),
+        )
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+            load_fn = (
+                get_pretrained_segment_nt_model
+                if model_name in SEGMENT_NT_MODELS
+                else get_pretrained_model
+            )
+            load_parameters = params_key not in self._parameters
+            parameters, forward_fn, tokenizer, config = load_fn(
+                model_name=model_name,
+                compute_dtype=compute_dtype,
+                param_dtype=param_dtype,
+                output_dtype=output_dtype,
+                embeddings_layers_to_save=embeddings_layers_to_save,
+                attention_maps_to_save=attention_maps_to_save,
+                max_positions=max_positions,
+                load_parameters=load_parameters,
+                **kwargs,
+            )
+
+            if load_parameters:
+                # Host arrays would be copied to the device at every call
+                self._parameters[params_key] = jax.device_put(parameters)
+            parameters = self._parameters[params_key]
+            self._params_keys[key] = params_key
+            model = LoadedModel(
+                parameters=parameters,
+                apply_fn=jax.jit(hk.transform(forward_fn).apply),
+                tokenizer=tokenizer,
+                config=config,
+            )
+            self._models[key] = model
+            self._evict()
+            return model
+
+    def _evict(self) -> None:
+        """Evicts the least recently used models until the budget is met."""
+        if self._max_memory_bytes is None:
+            return
+        while self.memory_bytes > self._max_memory_bytes and len(self._models) > 1:
+            evicted_key, _ = self._models.popitem(last=False)
+            params_key = self._params_keys.pop(evicted_key)
+            if params_key not in self._params_keys.values():
+                del self._parameters[params_key]
+
+    def clear(self) -> None:
+        """Evicts all the models."""
+        with self._lock:
+            self._models.clear()
+            self._parameters.clear()
+            self._params_keys.clear()
@@ -0,0 +1,224 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Masked language model scoring of sequences."""
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from nucleotide_transformer.tokenizers import StandardTokenizer
+
+
+def build_masked_copies(
+    tokens_ids: np.ndarray,
+    maskable: np.ndarray,
+    mask_token_id: int,
+    mask_stride: Optional[int] = None,
+    num_masked: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Builds the masked copies of a sequence used to compute its pseudo-log-likelihood.
+    By default, each copy masks a single token. With mask_stride=s, the maskable
+    tokens are split in s interleaved groups and each copy masks one group (every
+    s-th token), which approximates the pseudo-log-likelihood with s forward passes
+    instead of one per token.
+
+    Args:
+        tokens_ids: Token ids of the sequence, of shape (seq_len,).
+        maskable: Boolean array of shape (seq_len,), True for the tokens to score.
+        mask_token_id: Id of the mask token.
+        mask_stride: Optional distance between the tokens masked in a same copy. If
+            None, each copy masks a single token.
+        num_masked: Number of masked positions per copy, the positions are padded to
+            this size. Defaults to the number of maskable tokens divided by
+            mask_stride, rounded up.
+
+    Returns:
+        Masked token ids of shape (num_copies, seq_len).
+        Masked positions of shape (num_copies, num_masked).
+        Original token ids at the masked positions, of shape (num_copies, num_masked).
+        Validity mask of the masked positions, of shape (num_copies, num_masked).
+    """
+    maskable_positions = np.nonzero(maskable)[0]
+    num_maskable = len(maskable_positions)
+    num_copies = num_maskable if mask_stride is None else min(mask_stride, num_maskable)
+    if num_masked is None:
+        num_masked = -(-num_maskable // max(num_copies, 1))
+
+    positions = np.zeros((num_copies, num_masked), dtype=np.int32)
+    positions_mask = np.zeros((num_copies, num_masked), dtype=bool)
+    for copy in range(num_copies):
+        copy_positions = maskable_positions[copy::num_copies]
+        positions[copy, : len(copy_positions)] = copy_positions
+        positions_mask[copy, : len(copy_positions)] = True
+
+    masked_tokens = np.repeat(tokens_ids[None], num_copies, axis=0)
+    rows = np.repeat(np.arange(num_copies)[:, None], num_masked, axis=1)
+    masked_tokens[rows[positions_mask], positions[positions_mask]] = mask_token_id
+    targets = tokens_ids[positions]
+
+    return masked_tokens, positions, targets, positions_mask
+
+
+def build_masked_log_likelihood_fn(apply_fn: Callable) -> Callable:
+    """
+    Creates a jitted function returning the log-likelihood of the original tokens at
+    the masked positions. The masked positions are gathered before the LM head, so
+    only (batch_size, num_masked, vocabulary) logits are computed.
+
+    Args:
+        apply_fn: Apply function of the transformed Nucleotide Transformer.
+
+    Returns:
+        Function mapping (params, random_key, tokens, positions, targets,
+        positions_mask) to the summed log-likelihoods of shape (batch_size,).
+    """
+
+    def masked_log_likelihood_fn(
+        params: hk.Params,
+        random_key: jnp.ndarray,
+        tokens: jnp.ndarray,
+        positions: jnp.ndarray,
+        targets: jnp.ndarray,
+        positions_mask: jnp.ndarray,
+    ) -> jnp.ndarray:
+        outs = apply_fn(params, random_key, tokens, masked_positions=positions)
+        logits = outs["logits"]
+        log_probs = jax.nn.log_softmax(logits.astype(jnp.float32), axis=-1)
+        log_likelihoods = jnp.take_along_axis(log_probs, targets[:, :, None], axis=-1)
+        log_likelihoods = jnp.where(positions_mask, log_likelihoods[..., 0], 0.0)
+        return jnp.sum(log_likelihoods, axis=-1)
+
+    return jax.jit(masked_log_likelihood_fn)
+
+
+def _rebatch(
+    chunks: Iterator[Tuple[np.ndarray, ...]], batch_size: int
+) -> Iterator[Tuple[Tuple[np.ndarray, ...], int]]:
+    """
+    Regroups chunks of rows into batches of exactly batch_size rows. The last batch
+    is completed by repeating its last row.
+
+    Args:
+        chunks: Iterator over tuples of arrays sharing the same number of rows.
+        batch_size: Number of rows per batch.
+
+    Yields:
+        Tuple of arrays with batch_size rows.
+        Number of valid rows in the batch.
+    """
+    pending: Optional[Tuple[np.ndarray, ...]] = None
+    for chunk in chunks:
+        if pending is None:
+            pending = chunk
+        else:
+            pending = tuple(np.concatenate([a, b]) for a, b in zip(pending, chunk))
+        while pending[0].shape[0] >= batch_size:
+            yield tuple(a[:batch_size] for a in pending), batch_size
+            pending = tuple(a[batch_size:] for a in pending)
+
+    if pending is not None and pending[0].shape[0] > 0:
+        num_valid = pending[0].shape[0]
+        yield tuple(
+            np.concatenate([a, np.repeat(a[-1:], batch_size - num_valid, axis=0)])
+            for a in pending
+        ), num_valid
+
+
+def compute_pseudo_log_likelihoods(
+    apply_fn: Callable,
+    params: hk.Params,
+    tokenizer: StandardTokenizer,
+    sequences: List[str],
+    mask_stride: Optional[int] = None,
+    batch_size: int = 32,
+    random_key: Optional[jnp.ndarray] = None,
+) -> np.ndarray:
+    """
+    Computes the pseudo-log-likelihood of sequences under the masked language model,
+    i.e. the sum over their tokens of the log-probability of the token when it is
+    masked. The masked copies of all the sequences are streamed through the jitted
+    model in batches of batch_size rows, so memory stays bounded.
+
+    Args:
+        apply_fn: Apply function of the transformed Nucleotide Transformer.
+        params: Model parameters.
+        tokenizer: Tokenizer of the model.
+        sequences: Nucleotide sequences to score.
+        mask_stride: If None, the exact pseudo-log-likelihood is computed with one
+            forward pass per token. If s, every s-th token is masked at once, which
+            approximates it with s forward passes per sequence.
+        batch_size: Number of masked copies per forward pass.
+        random_key: Random key passed to apply_fn.
+
+    Returns:
+        Pseudo-log-likelihoods of shape (num_sequences,).
+
+    Example:
+        parameters, forward_fn, tokenizer, config = get_pretrained_model(
+            model_name="500M_multi_species_v2",
+        )
+        forward_fn = hk.transform(forward_fn)
+        scores = compute_pseudo_log_likelihoods(
+            forward_fn.apply, parameters, tokenizer, sequences, mask_stride=4,
+        )
+    """
+    if mask_stride is not None and mask_stride < 1:
+        raise ValueError(f"mask_stride should be positive, got {mask_stride}.")
+
+    all_tokens_ids = np.asarray(
+        [tokens_ids for _, tokens_ids in tokenizer.batch_tokenize(sequences)],
+        dtype=np.int32,
+    )
+    standard_tokens_ids = [
+        tokenizer.token_to_id(token) for token in tokenizer.standard_tokens
+    ]
+    maskable = np.isin(all_tokens_ids, standard_tokens_ids)
+    # Same number of masked positions for every sequence to keep static shapes
+    if mask_stride is None:
+        num_masked = 1
+    else:
+        num_masked = -(-int(maskable.sum(axis=-1).max()) // mask_stride)
+
+    def masked_copies() -> Iterator[Tuple[np.ndarray, ...]]:
+        for sequence_index in range(len(sequences)):
+            masked_tokens, positions, targets, positions_mask = build_masked_copies(
+                tokens_ids=all_tokens_ids[sequence_index],
+                maskable=maskable[sequence_index],
+                mask_token_id=tokenizer.mask_token_id,
+                mask_stride=mask_stride,
+                num_masked=num_masked,
+            )
+            sequence_indices = np.full(
+                (masked_tokens.shape[0],), sequence_index, dtype=np.int32
+            )
+            yield masked_tokens, positions, targets, positions_mask, sequence_indices
+
+    log_likelihood_fn = build_masked_log_likelihood_fn(apply_fn)
+    scores = np.zeros((len(sequences),), dtype=np.float64)
+    for batch, num_valid in _rebatch(masked_copies(), batch_size=batch_size):
+        masked_tokens, positions, targets, positions_mask, sequence_indices = batch
+        log_likelihoods = log_likelihood_fn(
+            params, random_key, masked_tokens, positions, targets, positions_mask
+        )
+        np.add.at(
+            scores,
+            sequence_indices[:num_valid],
+            np.asarray(log_likelihoods)[:num_valid],
+        )
+
+    return scores
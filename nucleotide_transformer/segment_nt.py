@@ -0,0 +1,494 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Segment-NT inference over sequences longer than its window, e.g. chromosomes."""
+import logging
+import os
+from itertools import product
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from nucleotide_transformer.constants import NUCLEOTIDES
+from nucleotide_transformer.tokenizers import StandardTokenizer
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_BLENDINGS = ["cosine", "center_crop"]
+
+# Segment-NT tokenizes sequences in non-overlapping 6-mers
+_K_MERS = 6
+
+
+def build_kmers_table(tokenizer: StandardTokenizer) -> np.ndarray:
+    """
+    Computes the token ids of the 6-mers, indexed by their base-4 encoding (A=0,
+    T=1, C=2, G=3 following NUCLEOTIDES), so that windows are tokenized with a
+    single gather.
+
+    Args:
+        tokenizer: Segment-NT tokenizer.
+
+    Returns:
+        Token ids of shape (4**6,).
+    """
+    return np.asarray(
+        [
+            tokenizer.token_to_id("".join(kmer))
+            for kmer in product(NUCLEOTIDES, repeat=_K_MERS)
+        ],
+        dtype=np.int32,
+    )
+
+
+def _encode_nucleotides(sequence: str) -> np.ndarray:
+    """Encodes A/T/C/G as 0..3 following NUCLEOTIDES and anything else as 4."""
+    lookup = np.full(256, len(NUCLEOTIDES), dtype=np.int32)
+    for i, nucleotide in enumerate(NUCLEOTIDES):
+        lookup[ord(nucleotide)] = i
+        lookup[ord(nucleotide.lower())] = i
+    return lookup[
+        np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)
+    ]
+
+
+def tokenize_window(
+    encoded_window: np.ndarray,
+    kmers_table: np.ndarray,
+    n_token_id: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Tokenizes a window in non-overlapping 6-mers. 6-mers containing an unknown
+    nucleotide (e.g. N) are mapped to the N token and their nucleotides are marked
+    invalid, as the head predictions there are not meaningful.
+
+    Args:
+        encoded_window: Window encoded by _encode_nucleotides, whose length is a
+            multiple of 6.
+        kmers_table: See build_kmers_table.
+        n_token_id: Id of the N token.
+
+    Returns:
+        Token ids of shape (window_length // 6,).
+        Validity of each nucleotide, of shape (window_length,).
+    """
+    kmers = encoded_window.reshape(-1, _K_MERS)
+    valid_kmers = np.all(kmers < len(NUCLEOTIDES), axis=-1)
+    kmer_indices = np.sum(
+        np.where(kmers < len(NUCLEOTIDES), kmers, 0)
+        * len(NUCLEOTIDES) ** np.arange(_K_MERS - 1, -1, -1),
+        axis=-1,
+    )
+    tokens_ids = np.where(valid_kmers, kmers_table[kmer_indices], n_token_id)
+    return tokens_ids.astype(np.int32), np.repeat(valid_kmers, _K_MERS)
+
+
+def compute_blend_weights(
+    window_length: int,
+    overlap: int,
+    blending: str,
+    is_first: bool = False,
+    is_last: bool = False,
+) -> np.ndarray:
+    """
+    Computes the weights of the predictions of a window when averaging overlapping
+    windows. "cosine" ramps the weights over the overlaps so that the weights of
+    two consecutive windows sum to one, "center_crop" keeps only the center of each
+    window. The outer side of the first and last windows is not down-weighted.
+
+    Args:
+        window_length: Number of nucleotides of the window.
+        overlap: Number of nucleotides shared by consecutive windows.
+        blending: Blending mode, one of SUPPORTED_BLENDINGS.
+        is_first: Whether the window starts the sequence.
+        is_last: Whether the window ends the sequence.
+
+    Returns:
+        Weights of shape (window_length,).
+    """
+    if blending not in SUPPORTED_BLENDINGS:
+        raise ValueError(
+            f"Blending {blending} not supported. Supported blendings are "
+            f"{SUPPORTED_BLENDINGS}."
+        )
+    weights = np.ones(window_length, dtype=np.float32)
+    if overlap == 0:
+        return weights
+
+    if blending == "cosine":
+        ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(overlap) + 0.5) / overlap)
+        left, right = ramp, ramp[::-1]
+    else:
+        left = np.zeros(overlap // 2, dtype=np.float32)
+        right = np.zeros(overlap - overlap // 2, dtype=np.float32)
+
+    if not is_first:
+        weights[: len(left)] = left
+    if not is_last:
+        weights[window_length - len(right) :] = right
+    return weights
+
+
+def build_probabilities_fn(apply_fn: Callable) -> Callable:
+    """
+    Creates a jitted function computing the Segment-NT probabilities, so that the
+    softmax runs on device and only the probabilities of the positive class are
+    transferred back to the host.
+
+    Args:
+        apply_fn: Apply function of the transformed Segment-NT model.
+
+    Returns:
+        Function mapping (params, random_key, tokens) to the probabilities of shape
+        (batch_size, 6 * num_tokens, num_features).
+    """
+
+    def probabilities_fn(
+        params: hk.Params, random_key: jnp.ndarray, tokens: jnp.ndarray
+    ) -> jnp.ndarray:
+        logits = apply_fn(params, random_key, tokens)["logits"]
+        return jax.nn.softmax(logits.astype(jnp.float32), axis=-1)[..., -1]
+
+    return jax.jit(probabilities_fn)
+
+
+def compute_intervals(
+    probabilities: jnp.ndarray, thresholds: jnp.ndarray, capacity: int
+) -> Dict[str, jnp.ndarray]:
+    """
+    Run-length encodes the positions where the probability of each feature is above
+    its threshold into intervals, in a fixed-capacity array so that it can be
+    jitted.
+
+    Args:
+        probabilities: Probabilities of shape (batch_size, seq_len, num_features).
+        thresholds: Threshold of each feature, of shape (num_features,), or a
+            scalar.
+        capacity: Maximum number of intervals returned per sequence and feature.
+
+    Returns:
+        Dictionary containing:
+            "starts": first position of each interval, of shape
+                (batch_size, num_features, capacity), -1 past the last interval.
+            "ends": position after the last one of each interval, same shape.
+            "scores": mean probability over each interval, same shape.
+            "num_intervals": number of intervals of shape (batch_size,
+                num_features). It may exceed capacity, in which case only the
+                first capacity intervals are returned.
+    """
+    probabilities = jnp.swapaxes(probabilities, 1, 2).astype(jnp.float32)
+    seq_len = probabilities.shape[-1]
+    above = probabilities >= jnp.reshape(jnp.asarray(thresholds), (-1, 1))
+    # Interval boundaries are where the padded indicator changes
+    padded = jnp.pad(above.astype(jnp.int32), ((0, 0), (0, 0), (1, 1)))
+    changes = jnp.diff(padded, axis=-1)
+    cumulative_probabilities = jnp.pad(
+        jnp.cumsum(probabilities, axis=-1), ((0, 0), (0, 0), (1, 0))
+    )
+
+    def encode(
+        row_changes: jnp.ndarray, row_cumulative: jnp.ndarray
+    ) -> Tuple[jnp.ndarray, ...]:
+        (starts,) = jnp.nonzero(row_changes == 1, size=capacity, fill_value=-1)
+        (ends,) = jnp.nonzero(row_changes == -1, size=capacity, fill_value=-1)
+        lengths = jnp.maximum(ends - starts, 1)
+        scores = (
+            row_cumulative[jnp.clip(ends, 0, seq_len)]
+            - row_cumulative[jnp.clip(starts, 0, seq_len)]
+        ) / lengths
+        scores = jnp.where(starts >= 0, scores, 0.0)
+        return starts, ends, scores, jnp.sum(row_changes == 1)
+
+    starts, ends, scores, num_intervals = jax.vmap(jax.vmap(encode))(
+        changes, cumulative_probabilities
+    )
+    return {
+        "starts": starts.astype(jnp.int32),
+        "ends": ends.astype(jnp.int32),
+        "scores": scores,
+        "num_intervals": num_intervals.astype(jnp.int32),
+    }
+
+
+def build_intervals_fn(
+    apply_fn: Callable,
+    thresholds: np.ndarray,
+    capacity: int,
+    softmax_dtype: jnp.dtype = jnp.bfloat16,
+) -> Callable:
+    """
+    Creates a jitted function returning the Segment-NT predictions as intervals,
+    so that only the intervals are transferred back to the host instead of the
+    (batch_size, 6 * num_tokens, num_features, 2) logits.
+
+    Args:
+        apply_fn: Apply function of the transformed Segment-NT model.
+        thresholds: Probability threshold of each feature, or a scalar.
+        capacity: Maximum number of intervals per sequence and feature.
+        softmax_dtype: Type in which the softmax is computed.
+
+    Returns:
+        Function mapping (params, random_key, tokens) to the intervals, see
+        compute_intervals.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+
+    def intervals_fn(
+        params: hk.Params, random_key: jnp.ndarray, tokens: jnp.ndarray
+    ) -> Dict[str, jnp.ndarray]:
+        logits = apply_fn(params, random_key, tokens)["logits"]
+        probabilities = jax.nn.softmax(logits.astype(softmax_dtype), axis=-1)[..., -1]
+        return compute_intervals(probabilities, thresholds, capacity)
+
+    return jax.jit(intervals_fn)
+
+
+def write_intervals(
+    intervals: Dict[str, np.ndarray],
+    features: List[str],
+    chromosome: str,
+    output_dir: str,
+    offsets: Optional[Sequence[int]] = None,
+    file_format: str = "bed",
+) -> None:
+    """
+    Appends intervals to one BED or bedGraph file per feature, named
+    <output_dir>/<feature>.bed or <feature>.bedGraph. The score column is the mean
+    probability over the interval, scaled to 0-1000 for BED.
+
+    Args:
+        intervals: Intervals returned by compute_intervals or build_intervals_fn.
+        features: Names of the features, e.g. the features of SegmentNTConfig.
+        chromosome: Chromosome name written in the first column.
+        output_dir: Directory of the files.
+        offsets: Genomic coordinate of the first position of each sequence of the
+            batch. Defaults to 0.
+        file_format: "bed" or "bedgraph".
+    """
+    if file_format not in ("bed", "bedgraph"):
+        raise ValueError(
+            f"File format {file_format} not supported, use 'bed' or 'bedgraph'."
+        )
+    starts = np.asarray(intervals["starts"])
+    ends = np.asarray(intervals["ends"])
+    scores = np.asarray(intervals["scores"], dtype=np.float32)
+    num_intervals = np.asarray(intervals["num_intervals"])
+    if offsets is None:
+        offsets = [0] * starts.shape[0]
+
+    if np.any(num_intervals > starts.shape[-1]):
+        logger.warning(
+            "Some sequences have more intervals than the capacity, the last ones "
+            "are dropped. Increase the capacity to keep them."
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+    extension = "bed" if file_format == "bed" else "bedGraph"
+    for feature_index, feature in enumerate(features):
+        lines = []
+        for batch_index, offset in enumerate(offsets):
+            valid = starts[batch_index, feature_index] >= 0
+            for start, end, score in zip(
+                starts[batch_index, feature_index][valid],
+                ends[batch_index, feature_index][valid],
+                scores[batch_index, feature_index][valid],
+            ):
+                start, end = start + offset, end + offset
+                if file_format == "bed":
+                    lines.append(
+                        f"{chromosome}\t{start}\t{end}\t{feature}\t"
+                        f"{int(round(1000 * float(score)))}\n"
+                    )
+                else:
+                    lines.append(f"{chromosome}\t{start}\t{end}\t{score:.4f}\n")
+        with open(os.path.join(output_dir, f"{feature}.{extension}"), "a") as f:
+            f.writelines(lines)
+
+
+def _window_starts(sequence_length: int, window_length: int, stride: int) -> List[int]:
+    """Starts of the windows, the last one aligned on the end of the sequence."""
+    if sequence_length <= window_length:
+        return [0]
+    starts = list(range(0, sequence_length - window_length, stride))
+    return starts + [sequence_length - window_length]
+
+
+def predict_long_sequence(
+    apply_fn: Callable,
+    params: hk.Params,
+    tokenizer: StandardTokenizer,
+    sequence: str,
+    num_features: int,
+    num_tokens_per_window: int,
+    overlap: int,
+    blending: str = "cosine",
+    batch_size: int = 8,
+    output_path: Optional[str] = None,
+    random_key: Optional[jnp.ndarray] = None,
+) -> np.ndarray:
+    """
+    Predicts the Segment-NT probabilities over a long sequence by sliding windows
+    of fixed size. The windows are batched through the model, and the predictions
+    of overlapping windows are averaged with the weights of compute_blend_weights.
+    Positions are written as soon as no further window covers them, so the memory
+    used does not grow with the sequence length when output_path is given.
+
+    Args:
+        apply_fn: Apply function of the transformed Segment-NT model.
+        params: Model parameters.
+        tokenizer: Segment-NT tokenizer. Its class token is prepended if it was
+            created with prepend_cls_token.
+        sequence: Nucleotide sequence, e.g. a whole chromosome.
+        num_features: Number of features predicted by the model.
+        num_tokens_per_window: Number of 6-mer tokens per window. Multiples of 2 to
+            the power of the number of UNet pooling layers avoid padding in the head.
+        overlap: Number of nucleotides shared by consecutive windows.
+        blending: Blending of overlapping windows, one of SUPPORTED_BLENDINGS.
+        batch_size: Number of windows per forward pass.
+        output_path: If given, the probabilities are streamed to this .npy file
+            and the returned array is a memory map of it.
+        random_key: Random key passed to the model.
+
+    Returns:
+        Probabilities of shape (len(sequence), num_features). Positions covered by
+        an unknown nucleotide only (e.g. N stretches) are NaN.
+
+    Example:
+        parameters, forward_fn, tokenizer, config = get_pretrained_segment_nt_model(
+            "segment_nt", max_positions=1001
+        )
+        apply_fn = hk.transform(forward_fn).apply
+        probabilities = predict_long_sequence(
+            apply_fn, parameters, tokenizer, chr20, len(config.features),
+            num_tokens_per_window=1000, overlap=1200, output_path="chr20.npy",
+        )
+    """
+    window_length = num_tokens_per_window * _K_MERS
+    if not 0 <= overlap < window_length:
+        raise ValueError(
+            f"overlap should be in [0, {window_length}) for windows of "
+            f"{num_tokens_per_window} tokens, got {overlap}."
+        )
+    if random_key is None:
+        random_key = jax.random.PRNGKey(0)
+
+    sequence_length = len(sequence)
+    if output_path is not None:
+        probabilities = np.lib.format.open_memmap(
+            output_path,
+            mode="w+",
+            dtype=np.float32,
+            shape=(sequence_length, num_features),
+        )
+    else:
+        probabilities = np.empty((sequence_length, num_features), dtype=np.float32)
+
+    probabilities_fn = build_probabilities_fn(apply_fn)
+    kmers_table = build_kmers_table(tokenizer)
+    n_token_id = tokenizer.token_to_id("N")
+    if sequence_length >= window_length:
+        spans = [
+            (start, window_length)
+            for start in _window_starts(
+                sequence_length, window_length, window_length - overlap
+            )
+        ]
+    else:
+        # A sequence shorter than a window is covered by its 6-mers from its start
+        # and from its end, as the last window of long sequences, so that the
+        # nucleotides of a trailing partial 6-mer are predicted too
+        span_length = sequence_length - sequence_length % _K_MERS
+        if span_length == 0:
+            raise ValueError(
+                f"The sequence has {sequence_length} nucleotides, fewer than a "
+                f"{_K_MERS}-mer."
+            )
+        spans = [(0, span_length)]
+        if span_length < sequence_length:
+            spans.append((sequence_length - span_length, span_length))
+
+    def windows() -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        for start, span_length in spans:
+            tokens_ids, valid = tokenize_window(
+                _encode_nucleotides(sequence[start : start + span_length]),
+                kmers_table,
+                n_token_id,
+            )
+            # Windows of short sequences are padded with pad tokens, which the
+            # model masks
+            num_pad_tokens = num_tokens_per_window - len(tokens_ids)
+            tokens_ids = np.pad(
+                tokens_ids, (0, num_pad_tokens), constant_values=tokenizer.pad_token_id
+            )
+            valid = np.pad(valid, (0, num_pad_tokens * _K_MERS))
+            if tokenizer.prepend_cls_token:
+                tokens_ids = np.concatenate([[tokenizer.class_token_id], tokens_ids])
+            weights = compute_blend_weights(
+                window_length,
+                overlap,
+                blending,
+                is_first=start == 0 or span_length < window_length,
+                is_last=start + window_length >= sequence_length,
+            )
+            yield start, tokens_ids, weights * valid
+
+    # Weighted sums of the windows not yet written, from position pending_start
+    pending_sum = np.zeros((window_length, num_features), dtype=np.float32)
+    pending_weight = np.zeros((window_length,), dtype=np.float32)
+    pending_start = 0
+
+    def flush(end: int) -> None:
+        nonlocal pending_sum, pending_weight, pending_start
+        num_positions = min(end, sequence_length) - pending_start
+        if num_positions <= 0:
+            return
+        with np.errstate(invalid="ignore", divide="ignore"):
+            probabilities[pending_start : pending_start + num_positions] = np.where(
+                pending_weight[:num_positions, None] > 0,
+                pending_sum[:num_positions] / pending_weight[:num_positions, None],
+                np.nan,
+            )
+        shift = end - pending_start
+        pending_sum = np.roll(pending_sum, -shift, axis=0)
+        pending_sum[-shift:] = 0.0
+        pending_weight = np.roll(pending_weight, -shift)
+        pending_weight[-shift:] = 0.0
+        pending_start = end
+
+    all_windows = windows()
+    while True:
+        batch = [window for _, window in zip(range(batch_size), all_windows)]
+        if not batch:
+            break
+        tokens = np.stack([tokens_ids for _, tokens_ids, _ in batch])
+        # Pads the last batch to keep a single compiled shape
+        tokens = np.pad(tokens, ((0, batch_size - len(batch)), (0, 0)), mode="edge")
+        batch_probabilities = np.asarray(
+            probabilities_fn(params, random_key, jnp.asarray(tokens))
+        )
+        for (start, _, weights), window_probabilities in zip(
+            batch, batch_probabilities
+        ):
+            # Windows are sorted, positions before this one are final
+            flush(start)
+            pending_sum += window_probabilities * weights[:, None]
+            pending_weight += weights
+
+    flush(sequence_length)
+    if isinstance(probabilities, np.memmap):
+        probabilities.flush()
+    return probabilities
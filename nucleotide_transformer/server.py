@@ -0,0 +1,489 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local HTTP server computing Nucleotide Transformer embeddings. Concurrent requests
+are gathered into micro-batches of similar lengths, so that throughput under load
+approaches offline batch inference.
+
+Endpoints:
+    POST /embed with body {"sequences": [...]} returns {"embeddings": [...]}.
+    GET /metrics returns the latency and batch size histograms.
+    GET /health returns {"status": "ok"}.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import haiku as hk
+import jax
+import numpy as np
+
+from nucleotide_transformer.inference import build_embedding_fn, pad_tokens_ids
+from nucleotide_transformer.tokenizers import StandardTokenizer
+
+DEFAULT_LENGTH_BUCKETS = (64, 128, 256, 512, 1024)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Error"}
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket boundaries.
+    """
+
+    def __init__(self, boundaries: Sequence[float]):
+        """
+        Args:
+            boundaries: Upper bounds of the buckets, in increasing order. A last
+                bucket collects the values above the largest boundary.
+        """
+        self._boundaries = list(boundaries)
+        self._counts = [0] * (len(self._boundaries) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        index = int(np.searchsorted(self._boundaries, value, side="left"))
+        self._counts[index] += 1
+        self._sum += value
+        self._count += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"<={b}" for b in self._boundaries] + [f">{self._boundaries[-1]}"]
+        return {
+            "buckets": dict(zip(labels, self._counts)),
+            "count": self._count,
+            "mean": self._sum / self._count if self._count else None,
+        }
+
+
+@dataclass
+class _PendingSequence:
+    """A sequence waiting to be embedded."""
+
+    tokens_ids: List[int]
+    future: asyncio.Future
+    arrival_time: float = field(default_factory=time.perf_counter)
+
+
+class EmbeddingServer:
+    """
+    Asyncio server gathering single-sequence requests into micro-batches.
+
+    Sequences are tokenized as they arrive and assigned to the smallest length bucket
+    that fits them. A bucket is sent to the model as soon as it holds max_batch_size
+    sequences, or when its oldest sequence has waited max_wait_ms. Each device runs
+    its own worker holding a copy of the parameters.
+    """
+
+    def __init__(
+        self,
+        params: hk.Params,
+        apply_fn: Callable,
+        tokenizer: StandardTokenizer,
+        embeddings_layer: int,
+        pooling: str = "mean",
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        length_buckets: Optional[Sequence[int]] = None,
+        max_length: int = 1000,
+        devices: Optional[List[Any]] = None,
+    ):
+        """
+        Args:
+            params: Model parameters.
+            apply_fn: Apply function of the transformed Nucleotide Transformer.
+            tokenizer: Tokenizer of the model.
+            embeddings_layer: Layer whose embeddings are returned. It must be among
+                the embeddings_layers_to_save of the model config.
+            pooling: Pooling of the embeddings, "mean" or "cls" (see
+                nucleotide_transformer.inference.pool_embeddings).
+            max_batch_size: Maximum number of sequences per micro-batch.
+            max_wait_ms: Maximum time a sequence waits for its micro-batch to fill.
+            length_buckets: Padded lengths (in tokens) of the micro-batches. Defaults
+                to powers of two up to max_length.
+            max_length: Maximum number of tokens of a sequence, including the class
+                token (at most the max_positions of the model).
+            devices: Devices running the model. Defaults to all local devices.
+        """
+        if pooling == "none":
+            raise ValueError("The server only returns pooled embeddings.")
+        if length_buckets is None:
+            length_buckets = [b for b in DEFAULT_LENGTH_BUCKETS if b < max_length]
+            length_buckets.append(max_length)
+        self._length_buckets = sorted(length_buckets)
+        self._tokenizer = tokenizer
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._devices = devices if devices is not None else jax.local_devices()
+
+        self._embedding_fn = build_embedding_fn(
+            apply_fn,
+            embeddings_layer=embeddings_layer,
+            pooling=pooling,
+            pad_token_id=tokenizer.pad_token_id,
+            class_token_id=tokenizer.class_token_id,
+        )
+        self._params_per_device = [
+            jax.device_put(params, device) for device in self._devices
+        ]
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1) for _ in range(len(self._devices))
+        ]
+
+        self._latency_histogram = Histogram(LATENCY_BUCKETS_MS)
+        self._batch_size_histogram = Histogram(
+            [2**i for i in range(int(np.log2(max(max_batch_size, 1))) + 1)]
+        )
+        self._num_sequences = 0
+
+        # Created in the event loop by start()
+        self._queue: Optional[asyncio.Queue] = None
+        self._free_devices: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+
+    def _bucket_length(self, num_tokens: int) -> int:
+        for length in self._length_buckets:
+            if num_tokens <= length:
+                return length
+        raise ValueError(
+            f"Found a sequence with {num_tokens} tokens that exceeds the maximum "
+            f"length ({self._length_buckets[-1]})."
+        )
+
+    def _padded_batch_size(self, num_sequences: int) -> int:
+        # Batch sizes are rounded up to powers of two to bound recompilations
+        return min(int(2 ** np.ceil(np.log2(num_sequences))), self._max_batch_size)
+
+    def _run_on_device(
+        self, device_index: int, tokens_ids: List[List[int]], length: int
+    ) -> np.ndarray:
+        """Embeds a micro-batch on one device, called from the device worker."""
+        tokens = pad_tokens_ids(
+            tokens_ids
+            + [[]] * (self._padded_batch_size(len(tokens_ids)) - len(tokens_ids)),
+            pad_token_id=self._tokenizer.pad_token_id,
+            length=length,
+        )
+        tokens = jax.device_put(tokens, self._devices[device_index])
+        embeddings = self._embedding_fn(
+            self._params_per_device[device_index], None, tokens
+        )
+        return np.asarray(embeddings, dtype=np.float32)[: len(tokens_ids)]
+
+    async def _process_batch(self, batch: List[_PendingSequence], length: int) -> None:
+        assert self._free_devices is not None
+        device_index = await self._free_devices.get()
+        try:
+            loop = asyncio.get_running_loop()
+            embeddings = await loop.run_in_executor(
+                self._executors[device_index],
+                self._run_on_device,
+                device_index,
+                [pending.tokens_ids for pending in batch],
+                length,
+            )
+        except Exception as exception:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(exception)
+            return
+        finally:
+            self._free_devices.put_nowait(device_index)
+
+        self._batch_size_histogram.observe(len(batch))
+        now = time.perf_counter()
+        for pending, embedding in zip(batch, embeddings):
+            self._latency_histogram.observe(1000 * (now - pending.arrival_time))
+            if not pending.future.done():
+                pending.future.set_result(embedding)
+
+    async def _batch_loop(self) -> None:
+        """Gathers the pending sequences into length-bucketed micro-batches."""
+        assert self._queue is not None
+        buckets: Dict[int, List[_PendingSequence]] = {}
+
+        def dispatch(length: int) -> None:
+            batch = buckets.pop(length)
+            asyncio.ensure_future(self._process_batch(batch, length))
+
+        while True:
+            now = time.perf_counter()
+            deadlines = [
+                pending[0].arrival_time + self._max_wait for pending in buckets.values()
+            ]
+            timeout = max(min(deadlines) - now, 0.0) if deadlines else None
+            try:
+                pending = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                length = self._bucket_length(len(pending.tokens_ids))
+                buckets.setdefault(length, []).append(pending)
+                if len(buckets[length]) >= self._max_batch_size:
+                    dispatch(length)
+            except asyncio.TimeoutError:
+                pass
+
+            now = time.perf_counter()
+            for length in list(buckets):
+                if buckets[length][0].arrival_time + self._max_wait <= now:
+                    dispatch(length)
+
+    async def embed(self, sequences: List[str]) -> List[np.ndarray]:
+        """
+        Embeds sequences through the micro-batching queue.
+
+        Args:
+            sequences: Nucleotide sequences.
+
+        Returns:
+            Pooled embedding of each sequence.
+        """
+        assert self._queue is not None, "The server is not started."
+        loop = asyncio.get_running_loop()
+        futures = []
+        for sequence in sequences:
+            _, tokens_ids = self._tokenizer.tokenize(sequence)
+            # Raises early for sequences that are too long
+            self._bucket_length(len(tokens_ids))
+            future = loop.create_future()
+            self._queue.put_nowait(_PendingSequence(tokens_ids, future))
+            futures.append(future)
+        self._num_sequences += len(sequences)
+        return list(await asyncio.gather(*futures))
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "num_sequences": self._num_sequences,
+            "num_devices": len(self._devices),
+            "latency_ms": self._latency_histogram.to_dict(),
+            "batch_size": self._batch_size_histogram.to_dict(),
+        }
+
+    async def _handle_request(
+        self, method: str, path: str, body: bytes
+    ) -> Tuple[int, Dict[str, Any]]:
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method == "POST" and path == "/embed":
+            try:
+                sequences = json.loads(body)["sequences"]
+                embeddings = await self.embed(sequences)
+            except (ValueError, KeyError, TypeError) as exception:
+                return 400, {"error": str(exception)}
+            return 200, {"embeddings": [e.tolist() for e in embeddings]}
+        return 404, {"error": f"Unknown endpoint {method} {path}"}
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Minimal HTTP/1.1 handling with keep-alive connections."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, response = await self._handle_request(method, path, body)
+                except Exception as exception:
+                    status, response = 500, {"error": str(exception)}
+                payload = json.dumps(response).encode()
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {_HTTP_REASONS[status]}\r\n"
+                        f"Content-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n\r\n"
+                    ).encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        unix_socket_path: Optional[str] = None,
+    ) -> asyncio.AbstractServer:
+        """
+        Starts the batching loop and listens for requests.
+
+        Args:
+            host: Host to listen on.
+            port: Port to listen on. If 0, a free port is chosen.
+            unix_socket_path: If specified, listens on this Unix socket instead.
+
+        Returns:
+            The asyncio server.
+        """
+        self._queue = asyncio.Queue()
+        self._free_devices = asyncio.Queue()
+        for device_index in range(len(self._devices)):
+            self._free_devices.put_nowait(device_index)
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+
+        if unix_socket_path is not None:
+            return await asyncio.start_unix_server(
+                self._handle_connection, path=unix_socket_path
+            )
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def serve_forever(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        unix_socket_path: Optional[str] = None,
+    ) -> None:
+        server = await self.start(host, port, unix_socket_path)
+        async with server:
+            await server.serve_forever()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, unix_socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self._unix_socket_path = unix_socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._unix_socket_path)
+
+
+class EmbeddingClient:
+    """
+    Client of the embedding server.
+
+    Example:
+        client = EmbeddingClient(port=8000)
+        embeddings = client.embed(["ATTCCGATTCCGATTCCG"])
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        unix_socket_path: Optional[str] = None,
+        timeout: float = 60.0,
+    ):
+        """
+        Args:
+            host: Host of the server.
+            port: Port of the server.
+            unix_socket_path: If specified, connects to this Unix socket instead.
+            timeout: Timeout of the requests, in seconds.
+        """
+        if unix_socket_path is not None:
+            self._connection: http.client.HTTPConnection = _UnixHTTPConnection(
+                unix_socket_path, timeout=timeout
+            )
+        else:
+            self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method: str, path: str, body: Optional[Dict] = None) -> Dict:
+        payload = json.dumps(body).encode() if body is not None else None
+        self._connection.request(
+            method, path, body=payload, headers={"Content-Type": "application/json"}
+        )
+        response = self._connection.getresponse()
+        content = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(
+                f"Request failed with status {response.status}: {content['error']}"
+            )
+        return content
+
+    def embed(self, sequences: List[str]) -> np.ndarray:
+        """
+        Args:
+            sequences: Nucleotide sequences.
+
+        Returns:
+            Embeddings of shape (num_sequences, embed_dim).
+        """
+        response = self._request("POST", "/embed", {"sequences": sequences})
+        return np.asarray(response["embeddings"], dtype=np.float32)
+
+    def metrics(self) -> Dict[str, Any]:
+        return self._request("GET", "/metrics")
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def main() -> None:
+    """Serves a pretrained model, see --help for the arguments."""
+    from nucleotide_transformer.pretrained import get_pretrained_model
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--model-name", required=True)
+    parser.add_argument("--embeddings-layer", type=int, required=True)
+    parser.add_argument("--pooling", default="mean", choices=["mean", "cls"])
+    parser.add_argument("--max-positions", type=int, default=1000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket-path", default=None)
+    args = parser.parse_args()
+
+    parameters, forward_fn, tokenizer, _ = get_pretrained_model(
+        model_name=args.model_name,
+        embeddings_layers_to_save=(args.embeddings_layer,),
+        max_positions=args.max_positions,
+    )
+    server = EmbeddingServer(
+        params=parameters,
+        apply_fn=hk.transform(forward_fn).apply,
+        tokenizer=tokenizer,
+        embeddings_layer=args.embeddings_layer,
+        pooling=args.pooling,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_length=args.max_positions,
+    )
+    asyncio.run(
+        server.serve_forever(
+            host=args.host, port=args.port, unix_socket_path=args.unix_socket_path
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,516 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Chunked on-disk store of embeddings.
+
+A store is a directory holding a manifest.json, describing the model, layers and
+pooling of the embeddings and the number of regions and chunks, a regions.txt with
+the name of each region, and a chunks/ directory. Regions are split into chunks of
+consecutive regions, each chunk holds one .npy file per layer and a .json marker
+written last, so that a chunk is complete if and only if its marker exists.
+Per-token embeddings of a chunk are stored concatenated, along with the number of
+tokens of each region.
+
+Embeddings are stored with one of the SUPPORTED_CODECS, each embedding vector being
+a row (a region, or a token for per-token embeddings):
+- "float32" stores the embeddings as computed.
+- "float16" halves the storage, the relative error of each value is below 2**-11.
+- "int8" divides the storage by 4: each row is scaled by max(|row|) / 127 and
+  rounded, the absolute error of each value is below max(|row|) / 254.
+Embeddings can also be projected on their first principal components before
+storage, see IncrementalPCA, e.g. 2560 dimensions projected on 128 components
+divide the storage by 20 before the codec. The fraction of the variance lost by the
+projection is saved with the projection.
+"""
+import functools
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import jax.numpy as jnp
+import numpy as np
+
+from nucleotide_transformer.utils import write_atomically
+
+MANIFEST_FILENAME = "manifest.json"
+REGIONS_FILENAME = "regions.txt"
+SUPPORTED_CODECS = ["float32", "float16", "int8"]
+_CHUNKS_DIRNAME = "chunks"
+_PROJECTIONS_DIRNAME = "projections"
+
+
+def _chunk_prefix(output_dir: str, chunk_index: int) -> str:
+    return os.path.join(output_dir, _CHUNKS_DIRNAME, f"chunk_{chunk_index:06d}")
+
+
+def _projection_filename(output_dir: str, name: str) -> str:
+    return os.path.join(output_dir, _PROJECTIONS_DIRNAME, f"{name}.npz")
+
+
+def _read_projection(output_dir: str, name: str) -> Optional["Projection"]:
+    filename = _projection_filename(output_dir, name)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as data:
+        return Projection(
+            mean=data["mean"],
+            components=data["components"],
+            explained_variance_ratio=float(data["explained_variance_ratio"]),
+        )
+
+
+def encode_embeddings(
+    embeddings: np.ndarray, codec: str
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Args:
+        embeddings: Embeddings whose last axis is the embedding dimension.
+        codec: One of SUPPORTED_CODECS.
+
+    Returns:
+        Encoded embeddings.
+        Scale of each row of the embeddings for the "int8" codec, else None.
+    """
+    if codec not in SUPPORTED_CODECS:
+        raise ValueError(
+            f"Codec {codec} not supported. Supported codecs are {SUPPORTED_CODECS}."
+        )
+    if codec != "int8":
+        return embeddings.astype(codec), None
+
+    embeddings = embeddings.astype(np.float32)
+    scales = np.max(np.abs(embeddings), axis=-1) / 127
+    values = np.round(embeddings / np.where(scales > 0, scales, 1)[..., None])
+    return values.astype(np.int8), scales
+
+
+def decode_embeddings(
+    values: np.ndarray,
+    scales: Optional[np.ndarray] = None,
+    projection: Optional["Projection"] = None,
+) -> np.ndarray:
+    """
+    Args:
+        values: Embeddings encoded with encode_embeddings.
+        scales: Scales returned by encode_embeddings for the "int8" codec.
+        projection: Projection the embeddings were computed with, if any. The
+            embeddings are then mapped back to the embedding space.
+
+    Returns:
+        Decoded embeddings, in float32.
+    """
+    embeddings = np.asarray(values, dtype=np.float32)
+    if scales is not None:
+        embeddings = embeddings * np.asarray(scales, dtype=np.float32)[..., None]
+    if projection is not None:
+        embeddings = embeddings @ projection.components + projection.mean
+    return embeddings
+
+
+class Projection(NamedTuple):
+    """Projection of embeddings on their first principal components."""
+
+    mean: np.ndarray
+    components: np.ndarray
+    explained_variance_ratio: float
+
+    def project(self, embeddings: jnp.ndarray) -> jnp.ndarray:
+        """
+        Projects embeddings, e.g. inside a jitted function so that only the
+        projections are transferred to the host.
+
+        Args:
+            embeddings: Embeddings whose last axis is the embedding dimension.
+
+        Returns:
+            Projected embeddings, whose last axis has num_components dimensions.
+        """
+        return (embeddings.astype(jnp.float32) - self.mean) @ self.components.T
+
+
+class IncrementalPCA:
+    """
+    Fits a Projection on batches of embeddings, e.g. computed on a sample of the
+    regions, without holding them in memory. Only the mean and the scatter matrix
+    of the embeddings are accumulated.
+    """
+
+    def __init__(self, num_components: int):
+        """
+        Args:
+            num_components: Number of principal components kept.
+        """
+        self._num_components = num_components
+        self._count = 0
+        self._mean: Optional[np.ndarray] = None
+        self._scatter: Optional[np.ndarray] = None
+
+    def partial_fit(self, embeddings: np.ndarray) -> None:
+        """
+        Args:
+            embeddings: Embeddings whose last axis is the embedding dimension.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        embeddings = embeddings.reshape(-1, embeddings.shape[-1])
+        if len(embeddings) == 0:
+            return
+        batch_count = len(embeddings)
+        batch_mean = np.mean(embeddings, axis=0)
+        centered = embeddings - batch_mean
+        batch_scatter = centered.T @ centered
+        if self._mean is None or self._scatter is None:
+            self._count, self._mean, self._scatter = (
+                batch_count,
+                batch_mean,
+                batch_scatter,
+            )
+            return
+
+        # Pairwise update of Chan et al., stable for embeddings far from zero
+        count = self._count + batch_count
+        delta = batch_mean - self._mean
+        self._scatter += batch_scatter + np.outer(delta, delta) * (
+            self._count * batch_count / count
+        )
+        self._mean += delta * batch_count / count
+        self._count = count
+
+    def projection(self) -> Projection:
+        """
+        Returns:
+            Projection on the first principal components of the embeddings seen.
+        """
+        if self._mean is None or self._scatter is None:
+            raise ValueError("partial_fit must be called before projection.")
+        if self._num_components > len(self._mean):
+            raise ValueError(
+                f"Cannot keep {self._num_components} components of embeddings of "
+                f"dimension {len(self._mean)}."
+            )
+        eigenvalues, eigenvectors = np.linalg.eigh(self._scatter)
+        order = np.argsort(eigenvalues)[::-1][: self._num_components]
+        return Projection(
+            mean=self._mean.astype(np.float32),
+            components=eigenvectors[:, order].T.astype(np.float32),
+            explained_variance_ratio=float(
+                np.sum(eigenvalues[order]) / max(np.sum(eigenvalues), 1e-30)
+            ),
+        )
+
+
+class LazyEmbeddings:
+    """
+    Read-only view on encoded embeddings, decoded when indexed, so that reading a
+    few rows of a memory-mapped chunk only reads and decodes those rows.
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        scales: Optional[np.ndarray] = None,
+        projection: Optional[Projection] = None,
+    ):
+        """
+        Args:
+            values: Encoded embeddings, see encode_embeddings.
+            scales: Scales of the rows for the "int8" codec.
+            projection: Projection to invert when decoding, if any.
+        """
+        self._values = values
+        self._scales = scales
+        self._projection = projection
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        if self._projection is None:
+            return self._values.shape
+        return self._values.shape[:-1] + self._projection.mean.shape
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __getitem__(self, key: Any) -> np.ndarray:
+        # Only rows are indexed before decoding, the last axis is needed whole
+        key = key if isinstance(key, tuple) else (key,)
+        rows_key, dims_key = key[: self._values.ndim - 1], key[self._values.ndim - 1 :]
+        decoded = decode_embeddings(
+            self._values[rows_key],
+            None if self._scales is None else self._scales[rows_key],
+            self._projection,
+        )
+        return decoded[(Ellipsis,) + dims_key] if dims_key else decoded
+
+    def __array__(self, dtype: Optional[np.dtype] = None) -> np.ndarray:
+        decoded = self[...]
+        return decoded if dtype is None else decoded.astype(dtype)
+
+
+class EmbeddingStoreWriter:
+    """
+    Writes the chunks of a store. Several processes can write to the same store
+    as long as they write different chunks, e.g. split by shard index.
+    """
+
+    def __init__(
+        self, output_dir: str, manifest: Dict[str, Any], region_names: List[str]
+    ):
+        """
+        Args:
+            output_dir: Directory of the store.
+            manifest: Description of the store, it must contain "chunk_size" and
+                "pooling", and optionally "codec" (float32 by default). If the store
+                already exists, its manifest must be identical, so that a resumed
+                job never mixes embeddings of different settings.
+            region_names: Name of each region, e.g. chr1:1000-2000.
+        """
+        self._output_dir = output_dir
+        regions = "".join(f"{name}\n" for name in region_names)
+        self._manifest = {"codec": "float32", **manifest}
+        if self._manifest["codec"] not in SUPPORTED_CODECS:
+            raise ValueError(
+                f"Codec {self._manifest['codec']} not supported. Supported codecs "
+                f"are {SUPPORTED_CODECS}."
+            )
+        self._manifest["num_regions"] = len(region_names)
+        self._manifest["regions_sha256"] = hashlib.sha256(regions.encode()).hexdigest()
+        self._manifest["num_chunks"] = -(
+            -len(region_names) // self._manifest["chunk_size"]
+        )
+
+        os.makedirs(os.path.join(output_dir, _CHUNKS_DIRNAME), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, _PROJECTIONS_DIRNAME), exist_ok=True)
+        manifest_filename = os.path.join(output_dir, MANIFEST_FILENAME)
+        if os.path.exists(manifest_filename):
+            with open(manifest_filename) as f:
+                existing_manifest = json.load(f)
+            if existing_manifest != self._manifest:
+                raise ValueError(
+                    f"The store in {output_dir} was created with a different "
+                    f"manifest: {existing_manifest}, expected {self._manifest}."
+                )
+        else:
+            write_atomically(
+                os.path.join(output_dir, REGIONS_FILENAME),
+                lambda f: f.write(regions.encode()),
+            )
+            write_atomically(
+                manifest_filename,
+                lambda f: f.write(json.dumps(self._manifest, indent=2).encode()),
+            )
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        return dict(self._manifest)
+
+    @property
+    def num_chunks(self) -> int:
+        return self._manifest["num_chunks"]
+
+    def chunk_regions(self, chunk_index: int) -> range:
+        """
+        Args:
+            chunk_index: Index of the chunk.
+
+        Returns:
+            Indices of the regions of the chunk.
+        """
+        chunk_size = self._manifest["chunk_size"]
+        start = chunk_index * chunk_size
+        return range(start, min(start + chunk_size, self._manifest["num_regions"]))
+
+    def is_chunk_complete(self, chunk_index: int) -> bool:
+        return os.path.exists(f"{_chunk_prefix(self._output_dir, chunk_index)}.json")
+
+    def write_projection(self, name: str, projection: Projection) -> None:
+        """
+        Saves the projection applied to the embeddings of a layer, before writing
+        any chunk.
+
+        Args:
+            name: Name of the layer, e.g. "embeddings_20".
+            projection: Projection of the embeddings.
+        """
+        write_atomically(
+            _projection_filename(self._output_dir, name),
+            lambda f: np.savez(f, **projection._asdict()),
+        )
+
+    def read_projection(self, name: str) -> Optional[Projection]:
+        return _read_projection(self._output_dir, name)
+
+    def write_chunk(
+        self,
+        chunk_index: int,
+        embeddings: Dict[str, List[np.ndarray]],
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Writes the embeddings of the regions of a chunk.
+
+        Args:
+            chunk_index: Index of the chunk.
+            embeddings: Embeddings of each region, per layer name, e.g.
+                "embeddings_20". Per-token embeddings are concatenated over the
+                regions.
+            metadata: Optional metadata saved in the marker of the chunk, e.g. the
+                time spent computing it.
+        """
+        prefix = _chunk_prefix(self._output_dir, chunk_index)
+        num_regions = len(self.chunk_regions(chunk_index))
+        for name, region_embeddings in embeddings.items():
+            if len(region_embeddings) != num_regions:
+                raise ValueError(
+                    f"Chunk {chunk_index} has {num_regions} regions, got "
+                    f"{len(region_embeddings)} embeddings for {name}."
+                )
+            if self._manifest["pooling"] == "none":
+                array = np.concatenate(region_embeddings)
+                lengths = np.asarray([len(e) for e in region_embeddings], np.int64)
+            else:
+                array = np.stack(region_embeddings)
+            values, scales = encode_embeddings(array, self._manifest["codec"])
+            if scales is not None:
+                write_atomically(
+                    f"{prefix}.{name}.scales.npy",
+                    functools.partial(np.save, arr=scales),
+                )
+            write_atomically(
+                f"{prefix}.{name}.npy", functools.partial(np.save, arr=values)
+            )
+        if self._manifest["pooling"] == "none":
+            write_atomically(
+                f"{prefix}.lengths.npy", functools.partial(np.save, arr=lengths)
+            )
+
+        marker = {"num_regions": num_regions, **(metadata or {})}
+        write_atomically(
+            f"{prefix}.json", lambda f: f.write(json.dumps(marker).encode())
+        )
+
+
+class EmbeddingStore:
+    """
+    Reads a store written by EmbeddingStoreWriter. Chunks are memory-mapped, so
+    that reading a region only reads its embeddings from disk.
+
+    Example:
+        store = EmbeddingStore("/data/embeddings")
+        embedding = store.read_region(12, "embeddings_20")
+    """
+
+    def __init__(self, output_dir: str):
+        """
+        Args:
+            output_dir: Directory of the store.
+        """
+        self._output_dir = output_dir
+        with open(os.path.join(output_dir, MANIFEST_FILENAME)) as f:
+            self._manifest: Dict[str, Any] = json.load(f)
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        return dict(self._manifest)
+
+    @property
+    def num_regions(self) -> int:
+        return self._manifest["num_regions"]
+
+    @property
+    def region_names(self) -> List[str]:
+        with open(os.path.join(self._output_dir, REGIONS_FILENAME)) as f:
+            return f.read().splitlines()
+
+    @property
+    def num_chunks(self) -> int:
+        return self._manifest["num_chunks"]
+
+    def missing_chunks(self) -> List[int]:
+        """
+        Returns:
+            Indices of the chunks that have not been written yet.
+        """
+        return [
+            i
+            for i in range(self.num_chunks)
+            if not os.path.exists(f"{_chunk_prefix(self._output_dir, i)}.json")
+        ]
+
+    def read_projection(self, name: str) -> Optional[Projection]:
+        """
+        Args:
+            name: Name of the layer, e.g. "embeddings_20".
+
+        Returns:
+            Projection applied to the embeddings of the layer, or None if they are
+            not projected.
+        """
+        return _read_projection(self._output_dir, name)
+
+    def read_chunk(
+        self, chunk_index: int, name: str, unproject: bool = False
+    ) -> LazyEmbeddings:
+        """
+        Args:
+            chunk_index: Index of the chunk.
+            name: Name of the layer, e.g. "embeddings_20".
+            unproject: Whether to map projected embeddings back to the embedding
+                space. Otherwise projected embeddings are returned as stored.
+
+        Returns:
+            Embeddings of the chunk, of shape (num_regions, ...), or (num_tokens,
+            embed_dim) for per-token embeddings. They are memory-mapped and decoded
+            to float32 when indexed.
+        """
+        prefix = _chunk_prefix(self._output_dir, chunk_index)
+        if not os.path.exists(f"{prefix}.json"):
+            raise FileNotFoundError(f"Chunk {chunk_index} has not been written.")
+        scales_filename = f"{prefix}.{name}.scales.npy"
+        return LazyEmbeddings(
+            np.load(f"{prefix}.{name}.npy", mmap_mode="r"),
+            (
+                np.load(scales_filename, mmap_mode="r")
+                if os.path.exists(scales_filename)
+                else None
+            ),
+            self.read_projection(name) if unproject else None,
+        )
+
+    def read_region(
+        self, region_index: int, name: str, unproject: bool = False
+    ) -> np.ndarray:
+        """
+        Args:
+            region_index: Index of the region, in the order of the manifest.
+            name: Name of the layer, e.g. "embeddings_20".
+            unproject: See read_chunk.
+
+        Returns:
+            Embedding of the region, in float32.
+        """
+        if not 0 <= region_index < self.num_regions:
+            raise ValueError(
+                f"Region {region_index} out of range, the store has "
+                f"{self.num_regions} regions."
+            )
+        chunk_index, offset = divmod(region_index, self._manifest["chunk_size"])
+        chunk = self.read_chunk(chunk_index, name, unproject=unproject)
+        if self._manifest["pooling"] != "none":
+            return chunk[offset]
+
+        prefix = _chunk_prefix(self._output_dir, chunk_index)
+        lengths = np.load(f"{prefix}.lengths.npy")
+        start = int(np.sum(lengths[:offset]))
+        return chunk[start : start + lengths[offset]]
@@ -276,6 +276,29 @@ class StandardTokenizer:
     def bos_token(self) -> str:
         return self._bos_token
 
+    @property
+    def prepend_cls_token(self) -> bool:
+        """
+        Property that returns whether the class token is prepended to the tokens.
+
+        Returns:
+            Whether the class token is prepended to the tokens.
+        """
+        return self._prepend_cls_token
+
+    def compute_nucleotide_lengths(self) -> np.ndarray:
+        """
+        Computes the number of nucleotides covered by each token of the vocabulary,
+        e.g. 6 for a 6-mer, 1 for a single nucleotide and 0 for special tokens.
+
+        Returns:
+            Number of nucleotides of each token id, of shape (vocabulary_size,).
+        """
+        lengths = np.zeros(self.vocabulary_size, dtype=np.int32)
+        for token in self.standard_tokens:
+            lengths[self.token_to_id(token)] = len(token)
+        return lengths
+
     def id_to_token(self, token_id: int) -> str:
         try:
             return self._ids_to_tokens[token_id]
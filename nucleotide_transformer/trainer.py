@@ -0,0 +1,518 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Data-parallel fine-tuning loop for Nucleotide Transformer models."""
+import functools
+import logging
+import operator
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import jmp
+import joblib
+import numpy as np
+import optax
+
+from nucleotide_transformer.adapters import partition_adapter_params
+from nucleotide_transformer.model import NucleotideTransformer
+from nucleotide_transformer.types import TransformerOutput
+from nucleotide_transformer.utils import write_atomically
+
+logger = logging.getLogger(__name__)
+
+Batch = Dict[str, np.ndarray]
+LossFn = Callable[[TransformerOutput, Dict[str, jnp.ndarray]], jnp.ndarray]
+
+# Name of the pmap axis along which the gradients are averaged.
+DEVICES_AXIS_NAME = "devices"
+
+
+class TrainingState(NamedTuple):
+    """
+    State of the training, replicated over the devices.
+
+    Args:
+        step: Number of optimizer updates done so far.
+        trainable_params: Parameters updated by the optimizer.
+        frozen_params: Parameters kept fixed during the training (pretrained weights
+            when fine-tuning adapters, empty otherwise).
+        optimizer_state: Optimizer state of the trainable parameters.
+        loss_scale: jmp loss scale, dynamic when training in float16.
+        random_key: Random key used in the forward pass.
+    """
+
+    step: jnp.ndarray
+    trainable_params: hk.Params
+    frozen_params: hk.Params
+    optimizer_state: optax.OptState
+    loss_scale: jmp.LossScale
+    random_key: jnp.ndarray
+
+
+def _shard(tree: Any, devices: List[Any]) -> Any:
+    """
+    Puts a pytree whose leaves have a leading axis of size len(devices) on the
+    devices, slice i on device i, as pmap expects its inputs.
+    """
+    if hasattr(jax, "device_put_sharded"):
+        return jax.device_put_sharded(
+            [
+                jax.tree_util.tree_map(operator.itemgetter(i), tree)
+                for i in range(len(devices))
+            ],
+            devices,
+        )
+
+    # Recent JAX versions removed device_put_sharded: the leaves are sharded over
+    # a mesh of the devices along their leading axis
+    sharding = jax.sharding.NamedSharding(
+        jax.sharding.Mesh(np.asarray(devices), (DEVICES_AXIS_NAME,)),
+        jax.sharding.PartitionSpec(DEVICES_AXIS_NAME),
+    )
+    return jax.tree_util.tree_map(lambda x: jax.device_put(x, sharding), tree)
+
+
+def _replicate(tree: Any, devices: List[Any]) -> Any:
+    """
+    Copies a pytree to each of the devices, along a new leading axis for pmap. Each
+    device receives its own copy directly, the stacked copies are never
+    materialized on a single device.
+    """
+    if hasattr(jax, "device_put_replicated"):
+        return jax.device_put_replicated(tree, devices)
+
+    # The leaves are broadcast on the host without copy
+    return _shard(
+        jax.tree_util.tree_map(
+            lambda x: np.broadcast_to(np.asarray(x), (len(devices),) + np.shape(x)),
+            tree,
+        ),
+        devices,
+    )
+
+
+def _unreplicate(tree: Any) -> Any:
+    """Takes the copy of a replicated pytree that lives on the first device."""
+    return jax.tree_util.tree_map(lambda x: x[0], tree)
+
+
+class Trainer:
+    """
+    Fine-tunes a model built with build_nucleotide_transformer_with_head_fn (or
+    build_nucleotide_transformer_fn). The train step is pmapped over the devices,
+    gradients are accumulated over micro-batches then averaged across devices. Loss
+    scaling follows the jmp policy set on NucleotideTransformer by the model builder:
+    dynamic loss scaling is used when the compute dtype is float16.
+
+    Example:
+        forward_fn = hk.transform(build_nucleotide_transformer_with_head_fn(...))
+
+        def loss_fn(outs, batch):
+            logits = outs["logits"]
+            return optax.softmax_cross_entropy_with_integer_labels(
+                logits, batch["labels"]
+            ).mean()
+
+        trainer = Trainer(
+            forward_fn=forward_fn, loss_fn=loss_fn, optimizer=optax.adamw(1e-4)
+        )
+        state = trainer.init(params, jax.random.PRNGKey(0))
+        state = trainer.fit(state, batches, num_steps=1000)
+    """
+
+    def __init__(
+        self,
+        forward_fn: hk.Transformed,
+        loss_fn: LossFn,
+        optimizer: optax.GradientTransformation,
+        num_accumulation_steps: int = 1,
+        trainable_modules: Optional[Tuple[str, ...]] = None,
+        devices: Optional[List[Any]] = None,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_every: Optional[int] = None,
+        log_every: int = 10,
+        initial_loss_scale: float = 2**15,
+    ):
+        """
+        Args:
+            forward_fn: Transformed model. Its apply function is called with the
+                "tokens" of the batch, and its "sequence_mask" and "masked_positions"
+                if present.
+            loss_fn: Function computing the scalar loss from the model outputs and the
+                batch of one device.
+            optimizer: Optax optimizer.
+            num_accumulation_steps: Number of micro-batches whose gradients are
+                accumulated before an optimizer update.
+            trainable_modules: If None, all parameters are trained. Otherwise only
+                the adapter parameters and the modules whose name contains one of
+                these strings are trained (see partition_adapter_params).
+            devices: Devices to train on. Defaults to all local devices.
+            checkpoint_dir: Directory where checkpoints are written.
+            checkpoint_every: Number of steps between two checkpoints. Checkpoints
+                are written in a background thread.
+            log_every: Number of steps between two logs of the loss and throughput.
+            initial_loss_scale: Initial loss scale when training in float16.
+        """
+        if num_accumulation_steps < 1:
+            raise ValueError(
+                f"num_accumulation_steps should be positive, got "
+                f"{num_accumulation_steps}."
+            )
+        if checkpoint_every is not None and checkpoint_dir is None:
+            raise ValueError("A checkpoint_dir is required to save checkpoints.")
+
+        self._forward_fn = forward_fn
+        self._loss_fn = loss_fn
+        self._optimizer = optimizer
+        self._num_accumulation_steps = num_accumulation_steps
+        self._trainable_modules = trainable_modules
+        self._devices = devices if devices is not None else jax.local_devices()
+        self._num_devices = len(self._devices)
+        self._checkpoint_dir = checkpoint_dir
+        self._checkpoint_every = checkpoint_every
+        self._log_every = log_every
+
+        policy = hk.mixed_precision.get_policy(NucleotideTransformer)
+        if policy is not None and policy.compute_dtype == jnp.float16:
+            self._initial_loss_scale: jmp.LossScale = jmp.DynamicLossScale(
+                jnp.asarray(initial_loss_scale, dtype=jnp.float32)
+            )
+        else:
+            self._initial_loss_scale = jmp.NoOpLossScale()
+
+        self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self._checkpoint_futures: List[Future] = []
+
+        self._train_step = jax.pmap(
+            self._update,
+            axis_name=DEVICES_AXIS_NAME,
+            devices=self._devices,
+            donate_argnums=(0,),
+        )
+
+    @property
+    def num_devices(self) -> int:
+        return self._num_devices
+
+    def init(self, params: hk.Params, random_key: jnp.ndarray) -> TrainingState:
+        """
+        Creates the replicated training state.
+
+        Args:
+            params: Initial model parameters (pretrained weights merged with the
+                randomly initialized head/adapters).
+            random_key: Random key.
+
+        Returns:
+            Training state, replicated over the devices.
+        """
+        if self._trainable_modules is None:
+            trainable_params, frozen_params = params, {}
+        else:
+            trainable_params, frozen_params = partition_adapter_params(
+                params, trainable_modules=self._trainable_modules
+            )
+
+        state = TrainingState(
+            step=jnp.zeros((), dtype=jnp.int32),
+            trainable_params=trainable_params,
+            frozen_params=frozen_params,
+            optimizer_state=self._optimizer.init(trainable_params),
+            loss_scale=self._initial_loss_scale,
+            random_key=random_key,
+        )
+        state = _replicate(state, self._devices)
+        # Each device uses its own random key
+        random_keys = jax.random.split(random_key, self._num_devices)
+        return state._replace(random_key=_shard(random_keys, self._devices))
+
+    def get_params(self, state: TrainingState) -> hk.Params:
+        """
+        Gathers the full model parameters from a replicated training state.
+
+        Args:
+            state: Replicated training state.
+
+        Returns:
+            Model parameters, on host.
+        """
+        state = jax.device_get(_unreplicate(state))
+        return hk.data_structures.merge(state.frozen_params, state.trainable_params)
+
+    def _compute_loss(
+        self,
+        trainable_params: hk.Params,
+        frozen_params: hk.Params,
+        loss_scale: jmp.LossScale,
+        random_key: jnp.ndarray,
+        batch: Dict[str, jnp.ndarray],
+    ) -> Tuple[jnp.ndarray, jnp.ndarray]:
+        """
+        Computes the scaled loss of one micro-batch, and the unscaled loss as aux.
+        """
+        params = hk.data_structures.merge(frozen_params, trainable_params)
+        inputs = {"tokens": batch["tokens"]}
+        for key in ("sequence_mask", "masked_positions"):
+            if key in batch:
+                inputs[key] = batch[key]
+        outs = self._forward_fn.apply(params, random_key, **inputs)
+        loss = self._loss_fn(outs, batch).astype(jnp.float32)
+        return loss_scale.scale(loss), loss
+
+    def _update(
+        self, state: TrainingState, batch: Dict[str, jnp.ndarray]
+    ) -> Tuple[TrainingState, Dict[str, jnp.ndarray]]:
+        """
+        Train step run on each device. The batch has a leading axis of size
+        num_accumulation_steps.
+        """
+        random_key, step_key = jax.random.split(state.random_key)
+        grad_fn = jax.grad(self._compute_loss, has_aux=True)
+
+        def accumulate(
+            carry: Tuple[hk.Params, jnp.ndarray], inputs: Any
+        ) -> Tuple[Tuple[hk.Params, jnp.ndarray], None]:
+            grads_sum, loss_sum = carry
+            micro_batch, micro_batch_key = inputs
+            grads, loss = grad_fn(
+                state.trainable_params,
+                state.frozen_params,
+                state.loss_scale,
+                micro_batch_key,
+                micro_batch,
+            )
+            grads_sum = jax.tree_util.tree_map(jnp.add, grads_sum, grads)
+            return (grads_sum, loss_sum + loss), None
+
+        zeros = jax.tree_util.tree_map(jnp.zeros_like, state.trainable_params)
+        micro_batch_keys = jax.random.split(step_key, self._num_accumulation_steps)
+        (grads, loss), _ = jax.lax.scan(
+            accumulate,
+            (zeros, jnp.zeros((), dtype=jnp.float32)),
+            (batch, micro_batch_keys),
+        )
+        grads = jax.tree_util.tree_map(
+            lambda g: g / self._num_accumulation_steps, grads
+        )
+        loss = loss / self._num_accumulation_steps
+
+        # All-reduce across devices, then unscale
+        grads = jax.lax.pmean(grads, axis_name=DEVICES_AXIS_NAME)
+        loss = jax.lax.pmean(loss, axis_name=DEVICES_AXIS_NAME)
+        grads = state.loss_scale.unscale(grads)
+
+        grads_finite = jmp.all_finite(grads)
+        loss_scale = state.loss_scale.adjust(grads_finite)
+
+        updates, optimizer_state = self._optimizer.update(
+            grads, state.optimizer_state, state.trainable_params
+        )
+        trainable_params = optax.apply_updates(state.trainable_params, updates)
+
+        # Skip the update when float16 gradients overflowed
+        trainable_params, optimizer_state = jmp.select_tree(
+            grads_finite,
+            (trainable_params, optimizer_state),
+            (state.trainable_params, state.optimizer_state),
+        )
+
+        new_state = TrainingState(
+            step=state.step + grads_finite.astype(jnp.int32),
+            trainable_params=trainable_params,
+            frozen_params=state.frozen_params,
+            optimizer_state=optimizer_state,
+            loss_scale=loss_scale,
+            random_key=random_key,
+        )
+        metrics = {
+            "loss": loss,
+            "grads_finite": grads_finite,
+            "grad_norm": optax.global_norm(grads),
+        }
+        return new_state, metrics
+
+    def _shard_batch(self, batch: Batch) -> Batch:
+        """
+        Reshapes a global batch of shape (batch_size, ...) into
+        (num_devices, num_accumulation_steps, micro_batch_size, ...).
+        """
+        num_splits = self._num_devices * self._num_accumulation_steps
+
+        def reshape(x: np.ndarray) -> np.ndarray:
+            if x.shape[0] % num_splits:
+                raise ValueError(
+                    f"The batch size {x.shape[0]} should be divisible by the number "
+                    f"of devices times the number of accumulation steps "
+                    f"({num_splits})."
+                )
+            return np.reshape(
+                x,
+                (self._num_devices, self._num_accumulation_steps, -1) + x.shape[1:],
+            )
+
+        return {key: reshape(np.asarray(value)) for key, value in batch.items()}
+
+    def train_step(
+        self, state: TrainingState, batch: Batch
+    ) -> Tuple[TrainingState, Dict[str, jnp.ndarray]]:
+        """
+        Runs one optimizer update.
+
+        Args:
+            state: Replicated training state. Its buffers are donated to the step.
+            batch: Global batch, a dictionary of arrays of shape (batch_size, ...)
+                containing at least the "tokens".
+
+        Returns:
+            Updated training state.
+            Metrics of the step, replicated over the devices.
+        """
+        return self._train_step(state, self._shard_batch(batch))  # type: ignore
+
+    def fit(
+        self,
+        state: TrainingState,
+        batches: Iterable[Batch],
+        num_steps: Optional[int] = None,
+    ) -> TrainingState:
+        """
+        Trains the model on a stream of batches.
+
+        Args:
+            state: Replicated training state.
+            batches: Iterable of global batches.
+            num_steps: Maximum number of steps. Defaults to the number of batches.
+
+        Returns:
+            Updated training state.
+        """
+        num_tokens, num_sequences = 0, 0
+        start_time = time.perf_counter()
+        for step, batch in enumerate(batches, start=1):
+            state, metrics = self.train_step(state, batch)
+            num_sequences += batch["tokens"].shape[0]
+            num_tokens += int(np.prod(batch["tokens"].shape))
+
+            if self._log_every and step % self._log_every == 0:
+                metrics = jax.device_get(_unreplicate(metrics))
+                elapsed_time = time.perf_counter() - start_time
+                logger.info(
+                    "step %d | loss %.4f | grad norm %.4f | %.1f sequences/s | "
+                    "%.1f tokens/s",
+                    step,
+                    metrics["loss"],
+                    metrics["grad_norm"],
+                    num_sequences / elapsed_time,
+                    num_tokens / elapsed_time,
+                )
+                num_tokens, num_sequences = 0, 0
+                start_time = time.perf_counter()
+
+            if self._checkpoint_every and step % self._checkpoint_every == 0:
+                self.save_checkpoint(state)
+
+            if num_steps is not None and step >= num_steps:
+                break
+
+        self.wait_for_checkpoints()
+        return state
+
+    def save_checkpoint(self, state: TrainingState) -> Future:
+        """
+        Writes the trainable parameters, optimizer state and loss scale in a
+        background thread. The frozen parameters are not saved.
+
+        Args:
+            state: Replicated training state.
+
+        Returns:
+            Future resolved once the checkpoint is written.
+        """
+        if self._checkpoint_dir is None:
+            raise ValueError("A checkpoint_dir is required to save checkpoints.")
+
+        # Copies are taken now as the state buffers are donated to the next step
+        checkpoint = jax.tree_util.tree_map(
+            np.asarray,
+            jax.device_get(
+                {
+                    "step": state.step[0],
+                    "trainable_params": _unreplicate(state.trainable_params),
+                    "optimizer_state": _unreplicate(state.optimizer_state),
+                    "loss_scale": _unreplicate(state.loss_scale),
+                }
+            ),
+        )
+        filename = os.path.join(
+            self._checkpoint_dir, f"checkpoint_{int(checkpoint['step'])}.joblib"
+        )
+
+        future = self._checkpoint_executor.submit(
+            _write_checkpoint, checkpoint, filename
+        )
+        self._checkpoint_futures.append(future)
+        return future
+
+    def wait_for_checkpoints(self) -> None:
+        """
+        Blocks until all the checkpoints being written are on disk.
+        """
+        for future in self._checkpoint_futures:
+            future.result()
+        self._checkpoint_futures = []
+
+    def restore_checkpoint(self, state: TrainingState, filename: str) -> TrainingState:
+        """
+        Restores a checkpoint written by save_checkpoint.
+
+        Args:
+            state: Replicated training state holding the frozen parameters.
+            filename: Path of the checkpoint.
+
+        Returns:
+            Replicated training state.
+        """
+        with open(filename, "rb") as f:
+            checkpoint = joblib.load(f)
+
+        restored = _replicate(
+            (
+                jnp.asarray(checkpoint["step"]),
+                checkpoint["trainable_params"],
+                checkpoint["optimizer_state"],
+                checkpoint["loss_scale"],
+            ),
+            self._devices,
+        )
+        return state._replace(
+            step=restored[0],
+            trainable_params=restored[1],
+            optimizer_state=restored[2],
+            loss_scale=restored[3],
+        )
+
+
+def _write_checkpoint(checkpoint: Dict[str, Any], filename: str) -> None:
+    """
+    Writes a checkpoint atomically, a crash while writing never leaves a truncated
+    checkpoint behind.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    write_atomically(filename, functools.partial(joblib.dump, checkpoint))
+    logger.info("Checkpoint saved at %s", filename)
@@ -1,4 +1,6 @@
-from typing import Callable
+import os
+import uuid
+from typing import IO, Any, Callable
 
 import jax
 import jax.numpy as jnp
@@ -28,3 +30,23 @@ def get_activation_fn(activation_name: str) -> Callable:
     else:
         activation_fn = getattr(jax.nn, activation_name)
     return activation_fn
+
+
+def write_atomically(filename: str, write_fn: Callable[[IO[bytes]], Any]) -> None:
+    """
+    Writes a file under a temporary name then renames it, so that readers never see
+    a partial file and a crash while writing never leaves a truncated file behind.
+
+    Args:
+        filename: Path of the file.
+        write_fn: Function writing the content to the binary file it is given.
+    """
+    tmp_filename = f"{filename}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            write_fn(f)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
@@ -30,7 +30,11 @@ setup(
         "joblib>=1.2.0",
         "tqdm>=4.56.0",
         "regex>=2022.1.18",
+        "optax>=0.1.4",
     ],
+    entry_points={
+        "console_scripts": ["nt-embed=nucleotide_transformer.cli:main"],
+    },
     dependency_links=[
         "https://storage.googleapis.com/jax-releases/jax_releases.html",
     ],
@@ -0,0 +1,165 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks the scheduled batch inference on a tiny random model."""
+
+from typing import Callable, List, Tuple
+
+import haiku as hk
+import jax
+import numpy as np
+import pytest
+
+from nucleotide_transformer.inference import (
+    build_embedding_fn,
+    build_strand_symmetric_fn,
+    reverse_complement,
+    run_scheduled,
+    schedule_batches,
+    tokenize_strands,
+)
+from nucleotide_transformer.model import (
+    NucleotideTransformerConfig,
+    build_nucleotide_transformer_fn,
+)
+from nucleotide_transformer.tokenizers import (
+    NucleotidesKmersTokenizer,
+    compute_tokens_to_ids_v2,
+)
+
+
+@pytest.fixture(scope="module")
+def model() -> Tuple[Callable, NucleotidesKmersTokenizer]:
+    tokens_to_ids, _ = compute_tokens_to_ids_v2(k_mers=6)
+    tokenizer = NucleotidesKmersTokenizer(
+        k_mers=6, prepend_cls_token=True, tokens_to_ids=tokens_to_ids
+    )
+    config = NucleotideTransformerConfig(
+        alphabet_size=tokenizer.vocabulary_size,
+        pad_token_id=tokenizer.pad_token_id,
+        mask_token_id=tokenizer.mask_token_id,
+        max_positions=64,
+        embed_dim=16,
+        ffn_embed_dim=32,
+        attention_heads=2,
+        num_layers=2,
+        embeddings_layers_to_save=(2,),
+    )
+    forward_fn = hk.transform(build_nucleotide_transformer_fn(config))
+    random_key = jax.random.PRNGKey(0)
+    params = forward_fn.init(
+        random_key, np.asarray([tokenizer.tokenize("ACGTAC")[1]], dtype=np.int32)
+    )
+    embedding_fn = build_embedding_fn(
+        forward_fn.apply,
+        2,
+        "mean",
+        tokenizer.pad_token_id,
+        class_token_id=tokenizer.class_token_id,
+    )
+    symmetric_fn = build_strand_symmetric_fn(embedding_fn)
+    return (
+        lambda *strands: symmetric_fn(params, random_key, *strands),
+        tokenizer,
+    )
+
+
+def _sequences() -> List[str]:
+    rng = np.random.default_rng(0)
+    sequences = [
+        "".join(rng.choice(list("ACGT"), size)) for size in (61, 36, 100, 7, 150)
+    ]
+    # Reverse complements, whose 6-mers start at other offsets than the forward ones
+    return sequences + [
+        reverse_complement(sequences[0]),
+        reverse_complement(sequences[3]),
+    ]
+
+
+def _run(
+    model: Tuple[Callable, NucleotidesKmersTokenizer],
+    sequences: List[str],
+    **kwargs,
+) -> Tuple[List[np.ndarray], dict]:
+    symmetric_fn, tokenizer = model
+    tokens_ids, reverse_tokens_ids, num_nucleotides = tokenize_strands(
+        tokenizer, sequences
+    )
+    return run_scheduled(
+        symmetric_fn,
+        tokens_ids,
+        tokenizer.pad_token_id,
+        max_tokens_per_batch=128,
+        length_multiple=8,
+        reverse_tokens_ids=reverse_tokens_ids,
+        num_nucleotides=num_nucleotides,
+        **kwargs,
+    )
+
+
+def test_reverse_complement_gets_identical_outputs(model) -> None:
+    sequences = _sequences()
+    outputs, _ = _run(model, sequences)
+    np.testing.assert_allclose(outputs[0], outputs[5], atol=1e-5)
+    np.testing.assert_allclose(outputs[3], outputs[6], atol=1e-5)
+    assert not np.allclose(outputs[0], outputs[1], atol=1e-3)
+
+    deduplicated_outputs, stats = _run(model, sequences, deduplicate_strands=True)
+    assert stats["dedup_ratio"] == pytest.approx(2 / len(sequences))
+    np.testing.assert_array_equal(deduplicated_outputs[0], deduplicated_outputs[5])
+    np.testing.assert_array_equal(deduplicated_outputs[3], deduplicated_outputs[6])
+    for output, deduplicated_output in zip(outputs, deduplicated_outputs):
+        np.testing.assert_allclose(output, deduplicated_output, atol=1e-5)
+
+
+def test_strand_symmetric_matches_single_batch(model) -> None:
+    symmetric_fn, tokenizer = model
+    sequences = _sequences()
+    outputs, _ = _run(model, sequences)
+    tokens_ids, reverse_tokens_ids, num_nucleotides = tokenize_strands(
+        tokenizer, sequences
+    )
+    for i in range(len(sequences)):
+        expected = symmetric_fn(
+            np.asarray([tokens_ids[i]], dtype=np.int32),
+            np.asarray([reverse_tokens_ids[i]], dtype=np.int32),
+            np.asarray([num_nucleotides[i]], dtype=np.int32),
+        )
+        np.testing.assert_allclose(outputs[i], expected[0], atol=1e-5)
+
+
+def test_deduplicate_strands_requires_strand_symmetric_mode(model) -> None:
+    _, tokenizer = model
+    tokens_ids = [tokens_ids for _, tokens_ids in tokenizer.batch_tokenize(["ACGT"])]
+    with pytest.raises(ValueError, match="strand-symmetric"):
+        run_scheduled(
+            lambda tokens: tokens,
+            tokens_ids,
+            tokenizer.pad_token_id,
+            max_tokens_per_batch=128,
+            deduplicate_strands=True,
+        )
+    with pytest.raises(ValueError, match="strand-symmetric"):
+        _run(model, ["ACGT"], deduplicate_strands=True, crop_to_length=True)
+
+
+def test_batch_sizes_are_capped_to_max_batch_size() -> None:
+    # 12 sequences of 64 tokens fit in max_tokens_per_batch, 16 would not
+    batches = schedule_batches(
+        [64] * 30, max_tokens_per_batch=12 * 64, max_batch_size=12
+    )
+    assert [len(batch.indices) for batch in batches] == [12, 12, 6]
+    assert [batch.batch_size for batch in batches] == [12, 12, 8]
+    for batch in batches:
+        assert batch.batch_size * batch.length <= 12 * 64
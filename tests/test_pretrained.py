@@ -0,0 +1,264 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks the checkpoint download against a local S3-compatible HTTP server."""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, List, Set
+
+import boto3
+import numpy as np
+import pytest
+from botocore import UNSIGNED
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from nucleotide_transformer import pretrained
+from nucleotide_transformer.pretrained import (
+    ENV_NT_CACHE_DIR,
+    download_ckpt_and_hyperparams,
+    download_from_s3_bucket,
+)
+
+BUCKET = "nucleotide-transformer"
+KEY = "checkpoints/test/ckpt.joblib"
+CHUNK_SIZE = 1024
+NUM_CHUNKS = 10
+
+
+class FakeS3:
+    """
+    Object served by the local server, with the faults to inject per chunk.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.etag = hashlib.md5(data).hexdigest()
+        self.failed_chunks: Set[int] = set()
+        self.corrupted_chunks: Set[int] = set()
+        self.truncated_chunks: Set[int] = set()
+        self.requested_chunks: List[int] = []
+        self.client: Any = None
+
+
+def _make_handler(s3: FakeS3) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:  # type: ignore
+            pass
+
+        def _check_path(self) -> bool:
+            if self.path.split("?")[0] != f"/{BUCKET}/{KEY}":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return False
+            return True
+
+        def do_HEAD(self) -> None:  # noqa: N802
+            if not self._check_path():
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(s3.data)))
+            self.send_header("ETag", f'"{s3.etag}"')
+            self.end_headers()
+
+        def do_GET(self) -> None:  # noqa: N802
+            if not self._check_path():
+                return
+            match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers["Range"])
+            start, end = int(match.group(1)), int(match.group(2))
+            chunk_index = start // CHUNK_SIZE
+            s3.requested_chunks.append(chunk_index)
+            if chunk_index in s3.failed_chunks:
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = s3.data[start : end + 1]
+            if chunk_index in s3.corrupted_chunks:
+                body = bytes(b ^ 0xFF for b in body)
+            if chunk_index in s3.truncated_chunks:
+                body = body[: len(body) // 2]
+            self.send_response(206)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(s3.data)}")
+            self.send_header("ETag", f'"{s3.etag}"')
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+@pytest.fixture
+def s3() -> Iterator[FakeS3]:
+    data = np.random.default_rng(0).bytes(NUM_CHUNKS * CHUNK_SIZE - 100)
+    s3 = FakeS3(data)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(s3))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    s3.client = boto3.Session().client(
+        service_name="s3",
+        endpoint_url=f"http://127.0.0.1:{server.server_port}",
+        region_name="us-east-1",
+        config=Config(
+            signature_version=UNSIGNED,
+            s3={"addressing_style": "path"},
+            retries={"total_max_attempts": 1},
+        ),
+    )
+    yield s3
+    server.shutdown()
+    server.server_close()
+
+
+def _download(s3: FakeS3, filename: str) -> None:
+    download_from_s3_bucket(
+        s3_client=s3.client,
+        bucket=BUCKET,
+        key=KEY,
+        filename=filename,
+        verbose=False,
+        chunk_size=CHUNK_SIZE,
+        num_workers=1,
+    )
+
+
+def _check_complete(s3: FakeS3, filename: str) -> None:
+    with open(filename, "rb") as f:
+        assert f.read() == s3.data
+    with open(f"{filename}.sha256") as f:
+        assert f.read() == hashlib.sha256(s3.data).hexdigest()
+    assert not os.path.exists(f"{filename}.partial")
+    assert not os.path.exists(f"{filename}.partial.json")
+
+
+def test_download(s3: FakeS3, tmp_path: str) -> None:
+    filename = os.path.join(tmp_path, "ckpt.joblib")
+    _download(s3, filename)
+    _check_complete(s3, filename)
+    assert sorted(s3.requested_chunks) == list(range(NUM_CHUNKS))
+
+
+def test_interrupted_download_resumes(s3: FakeS3, tmp_path: str) -> None:
+    filename = os.path.join(tmp_path, "ckpt.joblib")
+    s3.failed_chunks = {3, 7}
+    with pytest.raises(ClientError):
+        _download(s3, filename)
+    assert not os.path.exists(filename)
+    with open(f"{filename}.partial.json") as f:
+        completed_chunks = set(json.load(f)["completed_chunks"])
+    assert {0, 1, 2} <= completed_chunks and not {3, 7} & completed_chunks
+
+    s3.failed_chunks.clear()
+    s3.requested_chunks.clear()
+    _download(s3, filename)
+    _check_complete(s3, filename)
+    assert sorted(s3.requested_chunks) == sorted(
+        set(range(NUM_CHUNKS)) - completed_chunks
+    )
+
+
+def test_download_restarts_when_object_changed(s3: FakeS3, tmp_path: str) -> None:
+    filename = os.path.join(tmp_path, "ckpt.joblib")
+    s3.failed_chunks = {5}
+    with pytest.raises(ClientError):
+        _download(s3, filename)
+
+    s3.data = s3.data[::-1]
+    s3.etag = hashlib.md5(s3.data).hexdigest()
+    s3.failed_chunks.clear()
+    s3.requested_chunks.clear()
+    _download(s3, filename)
+    _check_complete(s3, filename)
+    assert sorted(s3.requested_chunks) == list(range(NUM_CHUNKS))
+
+
+def test_corrupted_chunk_is_rejected(s3: FakeS3, tmp_path: str) -> None:
+    filename = os.path.join(tmp_path, "ckpt.joblib")
+    s3.corrupted_chunks = {4}
+    with pytest.raises(ValueError, match="MD5"):
+        _download(s3, filename)
+    assert not os.path.exists(filename)
+    assert not os.path.exists(f"{filename}.partial")
+    assert not os.path.exists(f"{filename}.partial.json")
+
+    s3.corrupted_chunks.clear()
+    _download(s3, filename)
+    _check_complete(s3, filename)
+
+
+def test_truncated_chunk_is_not_recorded(s3: FakeS3, tmp_path: str) -> None:
+    filename = os.path.join(tmp_path, "ckpt.joblib")
+    s3.truncated_chunks = {NUM_CHUNKS - 1}
+    with pytest.raises(ValueError, match="Received"):
+        _download(s3, filename)
+    assert not os.path.exists(filename)
+    with open(f"{filename}.partial.json") as f:
+        assert NUM_CHUNKS - 1 not in json.load(f)["completed_chunks"]
+
+    s3.truncated_chunks.clear()
+    s3.requested_chunks.clear()
+    _download(s3, filename)
+    _check_complete(s3, filename)
+    assert s3.requested_chunks == [NUM_CHUNKS - 1]
+
+
+def _load_cast_checkpoint(log_filename: str) -> None:
+    # Runs in a separate process, records each write of the cast checkpoint
+    save_memmap_checkpoint = pretrained.save_memmap_checkpoint
+
+    def logged_save_memmap_checkpoint(params: Any, filename: str) -> None:
+        if "bfloat16" in filename:
+            with open(log_filename, "a") as f:
+                f.write(f"{os.getpid()}\n")
+        save_memmap_checkpoint(params, filename)
+
+    pretrained.save_memmap_checkpoint = logged_save_memmap_checkpoint
+    params, _ = download_ckpt_and_hyperparams("test", param_dtype="bfloat16")
+    assert params["test/linear"]["w"].dtype.name == "bfloat16"
+
+
+def test_concurrent_loads_cast_once(tmp_path: str, monkeypatch: Any) -> None:
+    import joblib
+
+    monkeypatch.setenv(ENV_NT_CACHE_DIR, str(tmp_path))
+    save_dir = os.path.join(tmp_path, "test")
+    os.makedirs(save_dir)
+    with open(os.path.join(save_dir, "hyperparams.json"), "w") as f:
+        json.dump({}, f)
+    rng = np.random.default_rng(0)
+    params = {"test/linear": {"w": rng.normal(size=(256, 256)).astype(np.float32)}}
+    with open(os.path.join(save_dir, "ckpt.joblib"), "wb") as f:
+        joblib.dump(params, f)
+
+    log_filename = os.path.join(tmp_path, "casts.log")
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_load_cast_checkpoint, args=(log_filename,))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    with open(log_filename) as f:
+        assert len(f.read().splitlines()) == 1
+    assert os.path.exists(os.path.join(save_dir, "ckpt.bfloat16.npmm"))
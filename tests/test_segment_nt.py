@@ -0,0 +1,119 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks the sliding-window Segment-NT inference on a tiny random model."""
+
+from typing import Any, Tuple
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from nucleotide_transformer.heads import UNetHead
+from nucleotide_transformer.model import (
+    SegmentNTConfig,
+    build_nucleotide_transformer_with_head_fn,
+)
+from nucleotide_transformer.segment_nt import predict_long_sequence
+from nucleotide_transformer.tokenizers import (
+    FixedSizeNucleotidesKmersTokenizer,
+    compute_tokens_to_ids_v2,
+)
+
+NUM_FEATURES = 3
+
+
+@pytest.fixture(scope="module")
+def model() -> Tuple[Any, hk.Params, FixedSizeNucleotidesKmersTokenizer]:
+    tokens_to_ids, _ = compute_tokens_to_ids_v2(k_mers=6)
+    tokenizer = FixedSizeNucleotidesKmersTokenizer(
+        k_mers=6,
+        fixed_length=17,
+        prepend_cls_token=True,
+        tokens_to_ids=tokens_to_ids,
+    )
+    config = SegmentNTConfig(
+        alphabet_size=tokenizer.vocabulary_size,
+        pad_token_id=tokenizer.pad_token_id,
+        mask_token_id=tokenizer.mask_token_id,
+        max_positions=32,
+        embed_dim=16,
+        ffn_embed_dim=32,
+        attention_heads=2,
+        num_layers=2,
+        use_rotary_embedding=True,
+        positional_embedding=None,
+        features=[f"feature_{i}" for i in range(NUM_FEATURES)],
+    )
+
+    def head_fn() -> UNetHead:
+        return UNetHead(num_features=NUM_FEATURES, embed_dimension=16, name="head")
+
+    forward_fn = hk.transform(
+        build_nucleotide_transformer_with_head_fn(config, head_fn, model_name="nt")
+    )
+    params = forward_fn.init(
+        jax.random.PRNGKey(0),
+        jnp.asarray([tokenizer.tokenize("A" * 96)[1]], dtype=jnp.int32),
+    )
+    return forward_fn.apply, params, tokenizer
+
+
+@pytest.mark.parametrize("num_tokens_per_window", [8, 16])
+def test_short_sequence_with_partial_kmer(model: Any, num_tokens_per_window) -> None:
+    apply_fn, params, tokenizer = model
+    rng = np.random.default_rng(0)
+    # 6k + 1 nucleotides, shorter than a window
+    sequence = "".join(rng.choice(list("ACGT"), 6 * 7 + 1))
+    probabilities = predict_long_sequence(
+        apply_fn,
+        params,
+        tokenizer,
+        sequence,
+        NUM_FEATURES,
+        num_tokens_per_window=num_tokens_per_window,
+        overlap=12,
+    )
+    assert probabilities.shape == (len(sequence), NUM_FEATURES)
+    assert not np.any(np.isnan(probabilities))
+
+
+def test_short_sequence_does_not_depend_on_window(model: Any) -> None:
+    apply_fn, params, tokenizer = model
+    rng = np.random.default_rng(1)
+    sequence = "".join(rng.choice(list("ACGT"), 6 * 7 + 1))
+    probabilities = [
+        predict_long_sequence(
+            apply_fn,
+            params,
+            tokenizer,
+            sequence,
+            NUM_FEATURES,
+            num_tokens_per_window=num_tokens_per_window,
+            overlap=12,
+        )
+        for num_tokens_per_window in (8, 16)
+    ]
+    # The windows of short sequences are padded with masked pad tokens
+    np.testing.assert_allclose(probabilities[0], probabilities[1], atol=1e-5)
+
+
+def test_sequence_shorter_than_a_kmer_is_rejected(model: Any) -> None:
+    apply_fn, params, tokenizer = model
+    with pytest.raises(ValueError, match="fewer than"):
+        predict_long_sequence(
+            apply_fn, params, tokenizer, "ACG", NUM_FEATURES, 8, overlap=12
+        )
@@ -0,0 +1,131 @@
+# Copyright 2022 InstaDeep Ltd
+#
+# Licensed under the Creative Commons BY-NC-SA 4.0 License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://creativecommons.org/licenses/by-nc-sa/4.0/
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks the fine-tuning loop on a tiny random model."""
+
+import os
+from typing import Any, Dict, List
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import pytest
+
+from nucleotide_transformer.model import (
+    NucleotideTransformerConfig,
+    build_nucleotide_transformer_fn,
+)
+from nucleotide_transformer.trainer import Trainer, TrainingState
+
+ALPHABET_SIZE = 16
+SEQUENCE_LENGTH = 8
+NUM_ACCUMULATION_STEPS = 2
+
+
+def _loss_fn(outs: Dict[str, jnp.ndarray], batch: Dict[str, jnp.ndarray]) -> Any:
+    return optax.softmax_cross_entropy_with_integer_labels(
+        outs["logits"], batch["tokens"]
+    ).mean()
+
+
+def _devices_of(state: TrainingState) -> List[Any]:
+    devices = set()
+    for leaf in jax.tree_util.tree_leaves(state):
+        devices |= leaf.devices()
+    return sorted(devices, key=lambda device: device.id)
+
+
+@pytest.fixture
+def trainer_and_params(tmp_path: str) -> Any:
+    config = NucleotideTransformerConfig(
+        alphabet_size=ALPHABET_SIZE,
+        pad_token_id=1,
+        mask_token_id=2,
+        max_positions=SEQUENCE_LENGTH,
+        embed_dim=16,
+        ffn_embed_dim=32,
+        attention_heads=2,
+        num_layers=1,
+    )
+    forward_fn = hk.transform(build_nucleotide_transformer_fn(config))
+    params = forward_fn.init(
+        jax.random.PRNGKey(0), jnp.zeros((1, SEQUENCE_LENGTH), dtype=jnp.int32)
+    )
+    # Trains on a subset of the devices that does not start at the first one
+    devices = jax.local_devices()[-2:]
+    trainer = Trainer(
+        forward_fn=forward_fn,
+        loss_fn=_loss_fn,
+        optimizer=optax.adam(1e-2),
+        num_accumulation_steps=NUM_ACCUMULATION_STEPS,
+        devices=devices,
+        checkpoint_dir=os.path.join(tmp_path, "checkpoints"),
+        log_every=0,
+    )
+    return trainer, params, devices
+
+
+def _batch(trainer: Trainer) -> Dict[str, np.ndarray]:
+    batch_size = 2 * trainer.num_devices * NUM_ACCUMULATION_STEPS
+    tokens = np.random.default_rng(0).integers(
+        3, ALPHABET_SIZE, (batch_size, SEQUENCE_LENGTH)
+    )
+    return {"tokens": tokens.astype(np.int32)}
+
+
+def test_loss_decreases(trainer_and_params: Any) -> None:
+    trainer, params, devices = trainer_and_params
+    state = trainer.init(params, jax.random.PRNGKey(1))
+    assert _devices_of(state) == devices
+
+    batch = _batch(trainer)
+    losses = []
+    for _ in range(10):
+        state, metrics = trainer.train_step(state, batch)
+        losses.append(float(metrics["loss"][0]))
+    assert losses[-1] < losses[0]
+    assert _devices_of(state) == devices
+    assert int(state.step[0]) == 10
+
+
+def test_checkpoint_round_trip(trainer_and_params: Any, tmp_path: str) -> None:
+    trainer, params, devices = trainer_and_params
+    batch = _batch(trainer)
+    state = trainer.init(params, jax.random.PRNGKey(1))
+    for _ in range(3):
+        state, _ = trainer.train_step(state, batch)
+    trainer.save_checkpoint(state).result()
+    saved_params = trainer.get_params(state)
+
+    restored = trainer.restore_checkpoint(
+        trainer.init(params, jax.random.PRNGKey(1)),
+        os.path.join(tmp_path, "checkpoints", "checkpoint_3.joblib"),
+    )
+    assert _devices_of(restored) == devices
+    assert int(restored.step[0]) == 3
+    jax.tree_util.tree_map(
+        np.testing.assert_array_equal, trainer.get_params(restored), saved_params
+    )
+
+    # The restored optimizer state continues the training as the original one
+    state, metrics = trainer.train_step(state, batch)
+    restored, restored_metrics = trainer.train_step(restored, batch)
+    np.testing.assert_allclose(metrics["loss"], restored_metrics["loss"], rtol=1e-6)
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-6),
+        trainer.get_params(restored),
+        trainer.get_params(state),
+    )